@@ -2,12 +2,13 @@
 Core модуль с общими компонентами проекта
 """
 from app.core.constants import VPNConstants, Messages
-from app.core.exceptions import VPNBotException, DatabaseError, APIError
+from app.core.exceptions import VPNBotException, DatabaseError, APIError, CircuitOpenError
 
 __all__ = [
     'VPNConstants',
     'Messages',
     'VPNBotException',
     'DatabaseError',
-    'APIError'
+    'APIError',
+    'CircuitOpenError'
 ]
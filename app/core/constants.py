@@ -31,6 +31,7 @@ class Messages:
     # Общие
     NO_SUBSCRIPTION = "❌ *У вас нет активной подписки*\n\nДля получения ключа доступа необходимо приобрести подписку."
     SERVER_UNAVAILABLE = "❌ Серверы VPN временно недоступны"
+    SERVER_BUSY = "⏳ Сервер VPN временно не отвечает. Ваша подписка активна - запросите ключ через минуту командой /mykey."
     ERROR_OCCURRED = "Произошла ошибка. Пожалуйста, попробуйте позже."
     
     # Подписка
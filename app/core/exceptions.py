@@ -31,3 +31,12 @@ class ValidationError(VPNBotException):
 class ServiceError(VPNBotException):
     """Ошибка сервиса"""
     pass
+
+
+class CircuitOpenError(ServiceError):
+    """Внешний сервис временно недоступен (circuit breaker открыт)"""
+    
+    def __init__(self, service: str, retry_after: float = 0.0):
+        self.service = service
+        self.retry_after = retry_after
+        super().__init__(f"{service} временно недоступен, повторите через {int(retry_after)}с")
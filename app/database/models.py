@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, Text, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, Boolean, Text, ForeignKey, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -79,4 +79,27 @@ class Payment(Base):
     paid_at = Column(DateTime)
     
     # Связи
-    user = relationship("User", back_populates="payments")
\ No newline at end of file
+    user = relationship("User", back_populates="payments")
+
+class TrafficStat(Base):
+    """Прирост трафика ключа за интервал синхронизации с панелью"""
+    __tablename__ = "traffic_stats"
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    key_uuid = Column(String(36), index=True)
+    up = Column(BigInteger, default=0)
+    down = Column(BigInteger, default=0)
+    recorded_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class TrafficCursor(Base):
+    """Последние прочитанные счетчики клиента на панели (для расчета прироста)"""
+    __tablename__ = "traffic_cursors"
+    __table_args__ = (UniqueConstraint("panel", "key_uuid"),)
+    
+    id = Column(Integer, primary_key=True)
+    panel = Column(String(200), nullable=False)
+    key_uuid = Column(String(36), nullable=False)
+    up = Column(BigInteger, default=0)
+    down = Column(BigInteger, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
@@ -1,7 +1,7 @@
 from aiogram import Dispatcher
 
 from app.handlers.user import start, payment, profile, v2ray
-from app.handlers.admin import free_vpn, cleanup
+from app.handlers.admin import free_vpn, cleanup, health, bulk_keys
 from app.handlers import errors
 
 
@@ -19,6 +19,8 @@ def register_all_handlers(dp: Dispatcher) -> None:
     # Регистрируем админские обработчики
     dp.include_router(free_vpn.router)
     dp.include_router(cleanup.router)
+    dp.include_router(health.router)
+    dp.include_router(bulk_keys.router)
     
     # Регистрируем обработчик ошибок последним
     dp.include_router(errors.router)
@@ -0,0 +1,122 @@
+from aiogram import Router, F
+from aiogram.types import Message
+from app.core.exceptions import CircuitOpenError
+from app.services.vpn import V2RayService
+from app.services.database import db
+from config.settings import settings
+from loguru import logger
+
+router = Router()
+
+v2ray_service = V2RayService(db)
+
+USAGE = (
+    "Использование:\n"
+    "`/bulk_keys <сервер> all` - все пользователи с активными ключами\n"
+    "`/bulk_keys <сервер> from <сервер>` - пользователи с активными ключами на другом сервере\n"
+    "`/bulk_keys <сервер> <user_id> <user_id> ...` - указанные пользователи\n\n"
+    "Сервер - номер в VPN\\_SERVERS (с 1). Добавьте `confirm` в конце, чтобы выпустить ключи."
+)
+
+
+def _server_by_number(value: str):
+    """Сервер из VPN_SERVERS по номеру (с 1)"""
+    if not value.isdigit() or not 1 <= int(value) <= len(settings.VPN_SERVERS):
+        raise ValueError(f"нет сервера с номером {value} (всего серверов: {len(settings.VPN_SERVERS)})")
+    return settings.VPN_SERVERS[int(value) - 1]
+
+
+async def _select_users(args) -> list:
+    """Пользователи для выпуска ключей по аргументам команды"""
+    from sqlalchemy import select
+    from app.database.models import V2RayKey
+
+    if args[0] in ("all", "from"):
+        stmt = select(V2RayKey.user_id).where(V2RayKey.is_active == True).distinct()
+        if args[0] == "from":
+            if len(args) < 2:
+                raise ValueError("укажите номер сервера после from")
+            source = _server_by_number(args[1])
+            stmt = stmt.where(
+                V2RayKey.server_address == source["address"],
+                V2RayKey.server_port == source["port"]
+            )
+        async with db.session_maker() as session:
+            result = await session.execute(stmt)
+            return [user_id for user_id in result.scalars().all() if user_id is not None]
+
+    if not all(arg.isdigit() for arg in args):
+        raise ValueError("user_id должны быть числами")
+    return [int(arg) for arg in args]
+
+
+@router.message(F.text, F.text.regexp(r"^/bulk_keys").as_("cmd"))
+async def cmd_bulk_keys(message: Message):
+    """Массовый выпуск ключей на сервере (миграция узла, перевыпуск; только для админов)"""
+    user_id = message.from_user.id
+
+    # Проверяем, что пользователь - админ
+    if user_id not in settings.ADMIN_IDS:
+        await message.answer("❌ Эта команда доступна только администраторам")
+        return
+
+    args = message.text.split()[1:]
+    confirm = bool(args) and args[-1] == "confirm"
+    if confirm:
+        args = args[:-1]
+    if len(args) < 2:
+        await message.answer(USAGE, parse_mode="Markdown")
+        return
+
+    try:
+        try:
+            server_config = _server_by_number(args[0])
+            user_ids = list(dict.fromkeys(await _select_users(args[1:])))
+        except ValueError as e:
+            await message.answer(f"❌ {e}\n\n{USAGE}", parse_mode="Markdown")
+            return
+
+        server_name = f"{server_config.get('location', 'Сервер')} ({server_config['address']}:{server_config['port']})"
+        if not user_ids:
+            await message.answer("📭 Нет пользователей для выпуска ключей")
+            return
+
+        if not confirm:
+            await message.answer(
+                f"📋 Будет выпущено ключей: {len(user_ids)}\n"
+                f"🌍 Сервер: {server_name}\n\n"
+                "Старые ключи этих пользователей будут деактивированы.\n"
+                f"💡 Повторите команду с `confirm` в конце, чтобы продолжить.",
+                parse_mode="Markdown"
+            )
+            return
+
+        status = await message.answer(f"🔄 Выпускаю {len(user_ids)} ключей на сервере {server_name}...")
+
+        async def report_progress(done: int, total: int):
+            try:
+                await status.edit_text(f"🔄 Сервер {server_name}: обработано {done} из {total}...")
+            except Exception as e:
+                logger.debug(f"Не удалось обновить прогресс /bulk_keys: {e}")
+
+        result = await v2ray_service.create_keys_bulk(user_ids, server_config, progress=report_progress)
+
+        lines = [
+            f"✅ Выпущено ключей: {len(result['keys'])} из {len(user_ids)}",
+            f"🌍 Сервер: {server_name}"
+        ]
+        if result["failed"]:
+            lines.append(f"⚠️ Ключи не выпущены, старые сохранены: {len(result['failed'])}")
+            lines.append("    user_id: " + ", ".join(str(failed_id) for failed_id in result["failed"][:20]))
+            if len(result["failed"]) > 20:
+                lines.append(f"    ... и еще {len(result['failed']) - 20}")
+            lines.append("💡 Повторите команду для этих пользователей")
+        lines.append("\n💡 Клиенты старых ключей удаляются с панелей командой /cleanup confirm")
+        await status.edit_text("\n".join(lines))
+        logger.info(f"Админ {user_id} выпустил {len(result['keys'])} ключей на сервере {server_name}")
+
+    except CircuitOpenError as e:
+        await message.answer(f"⛔ Панель сервера недоступна, повторите через {e.retry_after:.0f}с")
+    except Exception as e:
+        logger.error(f"Ошибка в /bulk_keys: {e}")
+        await message.answer(f"❌ Ошибка: {e}")
@@ -1,3 +1,5 @@
+import asyncio
+import html
 from aiogram import Router, F
 from aiogram.types import Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
@@ -37,18 +39,56 @@ async def cmd_cleanup(message: Message):
         
         logger.info(f"Найдено {len(active_uuids)} активных UUID в базе данных бота")
         
-        # Здесь можно добавить логику получения всех клиентов из 3x-ui
-        # и удаления тех, которых нет в active_uuids
+        if not vps_service.use_x3ui:
+            await message.answer(
+                f"📊 Найдено {len(active_uuids)} активных подключений в базе данных бота.\n\n"
+                "💡 Сверка с панелями доступна только при работе через 3x-ui API."
+            )
+            return
+        
+        confirm = message.text.split()[1:2] == ["confirm"]
+        
+        async def find_orphans(panel):
+            """Клиенты бота (email user_*) на панели, ключей которых нет среди активных"""
+            index = await panel.get_client_index(force_refresh=True)
+            if index is None:
+                raise RuntimeError("не удалось получить список клиентов")
+            orphans = [
+                client.get("id") for client in index.clients()
+                if (client.get("email") or "").startswith("user_") and client.get("id") not in active_uuids
+            ]
+            removed = 0
+            if confirm and orphans:
+                # Очередь объединит удаления в один пакет с одним перезапуском Xray
+                queue = vps_service.panel_registry.queue_for(panel)
+                results = await asyncio.gather(*(queue.remove_client(uuid) for uuid in orphans))
+                removed = sum(1 for ok in results if ok)
+            return len(index), orphans, removed
         
-        await message.answer(
-            f"📊 Найдено {len(active_uuids)} активных подключений в базе данных бота.\n\n"
-            "💡 Используйте команду `/cleanup_remove <email>` для удаления конкретного клиента.",
-            parse_mode="Markdown"
-        )
+        # Все панели сверяются одновременно (с ограничением параллельности)
+        results = await vps_service.panel_registry.fan_out(find_orphans)
         
+        lines = [f"📊 Активных подключений в базе данных бота: {len(active_uuids)}\n"]
+        total_orphans = 0
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                lines.append(f"❌ {html.escape(name)}: {html.escape(str(result))}")
+                continue
+            total, orphans, removed = result
+            total_orphans += len(orphans)
+            line = f"🖥 {html.escape(name)}: клиентов {total}, лишних {len(orphans)}"
+            if confirm:
+                line += f", удалено {removed}"
+            lines.append(line)
+        
+        if total_orphans and not confirm:
+            lines.append("\n💡 Используйте <code>/cleanup confirm</code> для удаления лишних клиентов.")
+        
+        await message.answer("\n".join(lines))
+    
     except Exception as e:
         logger.error(f"Ошибка в /cleanup: {e}")
-        await message.answer(f"❌ Ошибка: {e}")
+        await message.answer(f"❌ Ошибка: {html.escape(str(e))}")
 
 
 @router.message(F.text, F.text.regexp(r"^/remove_client (.+)").as_("cmd"))
@@ -67,24 +107,23 @@ async def cmd_remove_client(message: Message, cmd: str):
         if len(parts) < 2:
             await message.answer(
                 "❌ Укажите UUID клиента для удаления\n\n"
-                "Использование: `/remove_client <uuid>`",
-                parse_mode="Markdown"
+                "Использование: <code>/remove_client &lt;uuid&gt;</code>"
             )
             return
         
         uuid = parts[1].strip()
         
-        await message.answer(f"🔄 Удаляю клиента {uuid[:8]}...")
+        await message.answer(f"🔄 Удаляю клиента {html.escape(uuid[:8])}...")
         
         # Удаляем клиента
         success = await vps_service.remove_user_from_v2ray(uuid)
         
         if success:
-            await message.answer(f"✅ Клиент {uuid[:8]}... успешно удален из 3x-ui")
+            await message.answer(f"✅ Клиент {html.escape(uuid[:8])}... успешно удален из 3x-ui")
             logger.info(f"Админ {user_id} удалил клиента {uuid}")
         else:
-            await message.answer(f"❌ Не удалось удалить клиента {uuid[:8]}...")
-            
+            await message.answer(f"❌ Не удалось удалить клиента {html.escape(uuid[:8])}...")
+    
     except Exception as e:
         logger.error(f"Ошибка в /remove_client: {e}")
-        await message.answer(f"❌ Ошибка: {e}")
+        await message.answer(f"❌ Ошибка: {html.escape(str(e))}")
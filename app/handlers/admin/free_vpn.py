@@ -1,7 +1,7 @@
 from aiogram import Router, F
 from aiogram.types import Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from app.services.vpn import V2RayService
+from app.services.vpn import V2RayService, health_prober
 from app.services.user import SubscriptionService
 from app.services.database import db
 from config.settings import settings
@@ -85,7 +85,7 @@ async def cmd_free_vpn(message: Message):
             await message.answer("❌ Серверы VPN не настроены в .env")
             return
         
-        server_config = settings.VPN_SERVERS[0]
+        server_config = health_prober.pick_server()
         key_data = await v2ray_service.create_key(user_id, server_config)
         
         uuid = key_data.get("uuid", "")
@@ -0,0 +1,68 @@
+import time
+from aiogram import Router, F
+from aiogram.types import Message
+from app.services.vpn import health_prober, panel_registry, restart_scheduler
+from config.settings import settings
+from loguru import logger
+
+router = Router()
+
+
+def _format_ms(value) -> str:
+    return f"{value:.0f}мс" if value is not None else "—"
+
+
+@router.message(F.text, F.text.regexp(r"^/health").as_("cmd"))
+async def cmd_health(message: Message):
+    """Состояние панелей 3x-ui и серверов (только для админов)"""
+    user_id = message.from_user.id
+
+    # Проверяем, что пользователь - админ
+    if user_id not in settings.ADMIN_IDS:
+        await message.answer("❌ Эта команда доступна только администраторам")
+        return
+
+    try:
+        # До первой фоновой проверки проверяем сразу, чтобы отчет не был пустым
+        if not health_prober.targets():
+            await health_prober.probe_all()
+
+        now = time.time()
+        lines = ["🩺 Состояние панелей и серверов\n"]
+        for health in health_prober.targets():
+            if health.up is None:
+                status = "⚪"
+            else:
+                status = "🟢" if health.up else "🔴"
+            kind = "Панель" if health.kind == "panel" else "Сервер"
+            histogram = health.histogram
+            lines.append(
+                f"{status} {kind} {health.name}: p50 {_format_ms(histogram.percentile(50))}, "
+                f"p99 {_format_ms(histogram.percentile(99))} ({len(histogram)} замеров)"
+            )
+            if health.last_error:
+                lines.append(f"    ошибка: {health.last_error}")
+            if health.checked_at:
+                lines.append(f"    проверено {now - health.checked_at:.0f}с назад")
+
+        for panel in panel_registry.panels():
+            if panel.breaker.state != panel.breaker.CLOSED:
+                lines.append(
+                    f"⛔ Circuit breaker {panel.name}: {panel.breaker.state}, "
+                    f"повтор через {panel.breaker.retry_after():.0f}с"
+                )
+
+        pending_restarts = restart_scheduler.pending()
+        if pending_restarts:
+            lines.append("\n🔄 Запланированные перезапуски Xray:")
+            for pending in pending_restarts:
+                lines.append(
+                    f"    {pending['name']}: изменений {pending['requests']}, "
+                    f"ждет {pending['waiting']:.0f}с, перезапуск через {pending['due_in']:.0f}с"
+                )
+
+        await message.answer("\n".join(lines))
+
+    except Exception as e:
+        logger.error(f"Ошибка в /health: {e}")
+        await message.answer(f"❌ Ошибка: {e}")
@@ -3,6 +3,7 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from app.services.user import SubscriptionService
 from app.services.database import db
+from app.services.vpn import traffic_sync
 from datetime import datetime
 from loguru import logger
 
@@ -102,3 +103,42 @@ async def callback_get_key(callback: CallbackQuery):
         await callback.message.answer("❌ Ошибка получения ключа. Попробуйте позже.")
 
 
+def format_traffic(size: int) -> str:
+    """Объем трафика в читаемом виде"""
+    if size < 1024:
+        return f"{size} Б"
+    value = float(size)
+    for unit in ("КБ", "МБ", "ГБ"):
+        value /= 1024
+        if value < 1024:
+            return f"{value:.1f} {unit}"
+    return f"{value / 1024:.2f} ТБ"
+
+
+@router.callback_query(F.data == "show_stats")
+async def callback_show_stats(callback: CallbackQuery):
+    """Статистика трафика из локальной таблицы (без запроса к панели)"""
+    user_id = callback.from_user.id
+
+    try:
+        await callback.answer()
+
+        total_up, total_down, month_up, month_down = await traffic_sync.get_user_traffic(user_id)
+        synced_at = traffic_sync.last_sync_at
+        synced_text = synced_at.strftime('%d.%m.%Y %H:%M') + " UTC" if synced_at else "ожидается"
+
+        await callback.message.answer(
+            "📊 *Статистика трафика*\n\n"
+            f"*За 30 дней:*\n"
+            f"⬆️ Отправлено: {format_traffic(month_up)}\n"
+            f"⬇️ Получено: {format_traffic(month_down)}\n\n"
+            f"*За все время:*\n"
+            f"⬆️ Отправлено: {format_traffic(total_up)}\n"
+            f"⬇️ Получено: {format_traffic(total_down)}\n\n"
+            f"🕒 Обновлено: {synced_text}",
+            parse_mode="Markdown"
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики: {e}")
+        await callback.message.answer("❌ Ошибка получения статистики. Попробуйте позже.")
@@ -1,9 +1,11 @@
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from app.services.vpn import V2RayService
+from app.services.vpn import V2RayService, health_prober
 from app.services.user import SubscriptionService
 from app.services.database import db
+from app.core.constants import Messages
+from app.core.exceptions import CircuitOpenError
 from config.settings import settings
 import base64
 from io import BytesIO
@@ -53,7 +55,7 @@ async def cmd_mykey(message: Message):
                 await message.answer("❌ Серверы VPN временно недоступны")
                 return
 
-            server_config = settings.VPN_SERVERS[0]  # Берем первый сервер
+            server_config = health_prober.pick_server()  # Первый доступный сервер
             key_data = await v2ray_service.create_key(user_id, server_config)
 
         # Удаляем сообщение о обработке
@@ -65,6 +67,14 @@ async def cmd_mykey(message: Message):
         # Отправляем ключ пользователю
         await send_key_to_user(message.from_user.id, key_data)
 
+    except CircuitOpenError as e:
+        # Панель недоступна - отвечаем сразу, не дожидаясь таймаутов
+        logger.warning(f"/mykey для user_id={user_id}: {e}")
+        try:
+            await processing_msg.delete()
+        except:
+            pass
+        await message.answer(Messages.SERVER_BUSY)
     except Exception as e:
         logger.error(f"Ошибка в /mykey: {e}")
         await message.answer("Произошла ошибка при получении ключа. Попробуйте позже.")
@@ -87,12 +97,19 @@ async def send_v2ray_key_to_user(user_id: int):
             if not settings.VPN_SERVERS:
                 return
 
-            server_config = settings.VPN_SERVERS[0]
+            server_config = health_prober.pick_server()
             key_data = await v2ray_service.create_key(user_id, server_config)
 
         # Отправляем ключ
         await send_key_to_user(user_id, key_data)
 
+    except CircuitOpenError as e:
+        logger.warning(f"Ключ для user_id={user_id} не выдан после оплаты: {e}")
+        try:
+            from app.bot.loader import bot
+            await bot.send_message(user_id, Messages.SERVER_BUSY)
+        except Exception as send_error:
+            logger.error(f"Не удалось уведомить пользователя {user_id}: {send_error}")
     except Exception as e:
         logger.error(f"Ошибка отправки ключа: {e}")
 
@@ -0,0 +1,126 @@
+import random
+import time
+from typing import Optional
+from loguru import logger
+
+
+class CircuitBreaker:
+    """Автомат защиты (circuit breaker) для внешнего сервиса
+    
+    closed    - запросы проходят, подряд идущие ошибки считаются;
+    open      - после failure_threshold ошибок запросы сразу отклоняются
+                в течение recovery_timeout секунд;
+    half_open - затем пропускается один пробный запрос: успех закрывает
+                автомат, ошибка снова открывает его.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+    
+    @property
+    def state(self) -> str:
+        """Текущее состояние (open переходит в half_open по истечении recovery_timeout)"""
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_in_flight = False
+        return self._state
+    
+    @property
+    def is_open(self) -> bool:
+        """Отклоняются ли сейчас запросы без попытки"""
+        state = self.state
+        return state == self.OPEN or (state == self.HALF_OPEN and self._trial_in_flight)
+    
+    def retry_after(self) -> float:
+        """Через сколько секунд автомат пропустит пробный запрос"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.recovery_timeout - (time.monotonic() - self._opened_at))
+    
+    def allow_request(self) -> bool:
+        """Можно ли выполнить запрос (в half_open пропускается только один пробный)"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+    
+    def record_success(self):
+        """Успешный запрос"""
+        if self._state != self.CLOSED:
+            logger.info(f"✅ Circuit breaker '{self.name}': сервис снова доступен")
+        self._state = self.CLOSED
+        self._failures = 0
+        self._trial_in_flight = False
+    
+    def record_failure(self):
+        """Неудачный запрос (сетевая ошибка, таймаут, 5xx)"""
+        self._failures += 1
+        if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                logger.warning(
+                    f"⛔ Circuit breaker '{self.name}' открыт после {self._failures} ошибок подряд, "
+                    f"запросы отклоняются {self.recovery_timeout:.0f}с"
+                )
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+    
+    def release_trial(self):
+        """Пробный запрос завершился без результата (например, отменен)"""
+        self._trial_in_flight = False
+
+
+class AdaptiveTimeout:
+    """Таймаут по наблюдаемой задержке (как RTO в TCP)
+    
+    Сглаженная задержка и ее разброс считаются экспоненциальным скользящим
+    средним; таймаут = srtt + 4 * rttvar в пределах [minimum, maximum].
+    Пока наблюдений нет, используется maximum.
+    """
+    
+    ALPHA = 0.125
+    BETA = 0.25
+    
+    def __init__(self, minimum: float, maximum: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self._srtt: Optional[float] = None
+        self._rttvar = 0.0
+    
+    def observe(self, latency: float):
+        """Учет задержки успешного запроса (секунды)"""
+        if self._srtt is None:
+            self._srtt = latency
+            self._rttvar = latency / 2
+        else:
+            self._rttvar = (1 - self.BETA) * self._rttvar + self.BETA * abs(self._srtt - latency)
+            self._srtt = (1 - self.ALPHA) * self._srtt + self.ALPHA * latency
+    
+    def current(self) -> float:
+        """Текущий таймаут (секунды)"""
+        if self._srtt is None:
+            return self.maximum
+        return min(self.maximum, max(self.minimum, self._srtt + 4 * self._rttvar))
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Задержка перед повтором с экспоненциальным ростом и полным джиттером
+    
+    Случайная задержка из [0, min(cap, base * 2^attempt)] разносит повторы
+    одновременных запросов во времени.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
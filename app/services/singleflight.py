@@ -0,0 +1,37 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов
+    
+    Пока запрос с ключом выполняется, остальные вызовы с тем же ключом не создают
+    новый запрос, а ждут результат текущего. Ключ обычно составляется из имени
+    endpoint и параметров запроса.
+    
+    Результат общий для всех ожидающих, поэтому изменять его нельзя (при необходимости - копировать).
+    """
+    
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+    
+    async def do(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Выполнение func(*args, **kwargs) или ожидание уже идущего вызова с тем же ключом"""
+        task = self._calls.get(key)
+        if task is None:
+            # Запрос выполняется в отдельной задаче, чтобы отмена первого вызывающего не отменяла его для остальных
+            task = asyncio.create_task(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+    
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Помечаем исключение как полученное, даже если все ожидающие были отменены
+            task.exception()
+    
+    def in_flight(self, key: Hashable) -> bool:
+        """Выполняется ли сейчас запрос с этим ключом"""
+        return key in self._calls
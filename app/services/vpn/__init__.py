@@ -3,6 +3,16 @@ VPN сервисы для работы с V2Ray и 3x-ui
 """
 from app.services.vpn.v2ray_service import V2RayService
 from app.services.vpn.vps_service import VPSService
-from app.services.vpn.x3ui_service import X3UIService
+from app.services.vpn.x3ui_service import X3UIService, x3ui_service
+from app.services.vpn.provisioning_queue import ProvisioningQueue, provisioning_queue
+from app.services.vpn.panel_registry import PanelRegistry, panel_registry
+from app.services.vpn.traffic_sync import TrafficSyncService, traffic_sync
+from app.services.vpn.health_prober import HealthProber, health_prober
+from app.services.vpn.ssh_pool import SSHPool, ssh_pool
+from app.services.vpn.xray_grpc import XrayGrpcService
+from app.services.vpn.restart_scheduler import RestartScheduler, restart_scheduler
+from app.services.vpn.client_index import ClientIndex
+from app.services.vpn.inbound_codec import InboundCodec, inbound_codec
+from app.services.vpn.link_templates import LinkTemplateCache, link_templates
 
-__all__ = ['V2RayService', 'VPSService', 'X3UIService']
+__all__ = ['V2RayService', 'VPSService', 'X3UIService', 'x3ui_service', 'ProvisioningQueue', 'provisioning_queue', 'PanelRegistry', 'panel_registry', 'TrafficSyncService', 'traffic_sync', 'HealthProber', 'health_prober', 'SSHPool', 'ssh_pool', 'XrayGrpcService', 'RestartScheduler', 'restart_scheduler', 'ClientIndex', 'InboundCodec', 'inbound_codec', 'LinkTemplateCache', 'link_templates']
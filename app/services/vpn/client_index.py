@@ -0,0 +1,70 @@
+from typing import Optional, Dict, List, Iterable, Any
+
+
+class ClientIndex:
+    """Индекс клиентов одного inbound по UUID и email
+    
+    Строится один раз из списка клиентов снимка inbounds и затем поддерживается
+    при записях (add/update/remove), поэтому проверки существования, поиск клиента
+    и проверка занятости email выполняются за O(1) без перебора списка.
+    """
+    
+    def __init__(self, clients: Iterable[Dict] = (), source: Any = None):
+        self._by_id: Dict[str, Dict] = {}
+        self._by_email: Dict[str, str] = {}  # email в нижнем регистре -> uuid
+        # Объект снимка, из которого построен индекс (для проверки актуальности)
+        self.source = source
+        for client in clients:
+            self.add(client)
+    
+    @staticmethod
+    def _email_key(email: Optional[str]) -> Optional[str]:
+        return email.strip().lower() if email else None
+    
+    def __len__(self) -> int:
+        return len(self._by_id)
+    
+    def __contains__(self, uuid: str) -> bool:
+        return uuid in self._by_id
+    
+    def get(self, uuid: str) -> Optional[Dict]:
+        """Клиент по UUID"""
+        return self._by_id.get(uuid)
+    
+    def get_by_email(self, email: str) -> Optional[Dict]:
+        """Клиент по email (без учета регистра)"""
+        uuid = self._by_email.get(self._email_key(email))
+        return self._by_id.get(uuid) if uuid else None
+    
+    def email_taken(self, email: str, uuid: str = None) -> bool:
+        """Занят ли email другим клиентом (3x-ui не допускает повторяющихся email)"""
+        owner = self._by_email.get(self._email_key(email))
+        return owner is not None and owner != uuid
+    
+    def add(self, client: Dict):
+        """Добавление или замена клиента"""
+        uuid = client.get("id")
+        if not uuid:
+            return
+        self.remove(uuid)
+        self._by_id[uuid] = client
+        email = self._email_key(client.get("email"))
+        if email:
+            self._by_email[email] = uuid
+    
+    def update(self, client: Dict):
+        """Обновление клиента (email может измениться)"""
+        self.add(client)
+    
+    def remove(self, uuid: str) -> Optional[Dict]:
+        """Удаление клиента; возвращает удаленного клиента или None"""
+        client = self._by_id.pop(uuid, None)
+        if client is not None:
+            email = self._email_key(client.get("email"))
+            if email and self._by_email.get(email) == uuid:
+                del self._by_email[email]
+        return client
+    
+    def clients(self) -> List[Dict]:
+        """Все клиенты индекса"""
+        return list(self._by_id.values())
@@ -0,0 +1,186 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+from loguru import logger
+from config.settings import settings
+from app.utils.metrics import metrics, LatencyHistogram
+from app.utils.notify import notify_admins
+from app.services.vpn.panel_registry import panel_registry
+from app.services.vpn.x3ui_service import X3UIService
+
+
+class TargetHealth:
+    """Состояние одной проверяемой цели (панель или порт VPN-сервера)"""
+    
+    def __init__(self, name: str, kind: str):
+        self.name = name
+        self.kind = kind  # "panel" или "server"
+        self.up: Optional[bool] = None  # None - еще не проверялась
+        self.last_error: Optional[str] = None
+        self.checked_at: float = 0.0
+        self.changed_at: float = time.time()
+        self.failures = 0  # Неудачных проверок подряд
+        self.histogram: LatencyHistogram = metrics.histogram(f"health_{kind}:{name}")
+
+
+class HealthProber:
+    """Фоновая проверка панелей 3x-ui и TCP-портов VPN-серверов
+    
+    Раз в HEALTH_PROBE_INTERVAL секунд каждая панель проверяется запросом
+    страницы логина, а каждый сервер из VPN_SERVERS - TCP-подключением к порту.
+    Задержки копятся в скользящих гистограммах, состояние up/down хранится в памяти.
+    Цель считается недоступной после HEALTH_PROBE_FAILURES неудач подряд.
+    
+    Проверки панели учитываются ее circuit breaker'ом: недоступная панель
+    отключается до прихода запросов пользователей, а восстановившаяся снова
+    включается, не дожидаясь пробного запроса пользователя; pick_server выбирает для новых ключей сервер, который сейчас доступен.
+    """
+    
+    def __init__(self, interval: float = None, timeout: float = None):
+        self.interval = interval or settings.HEALTH_PROBE_INTERVAL
+        self.timeout = timeout or settings.HEALTH_PROBE_TIMEOUT
+        self._panels: Dict[str, TargetHealth] = {}
+        self._servers: Dict[str, TargetHealth] = {}
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Запуск фоновых проверок"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"🩺 Проверка доступности запущена (каждые {self.interval:.0f}с)")
+    
+    async def close(self):
+        """Остановка фоновых проверок"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.probe_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка проверки доступности: {e}")
+            await asyncio.sleep(self.interval)
+    
+    async def probe_all(self):
+        """Одна проверка всех панелей и серверов (параллельно)"""
+        semaphore = asyncio.Semaphore(settings.X3UI_FANOUT_CONCURRENCY)
+        
+        async def bounded(coro):
+            async with semaphore:
+                await coro
+        
+        await asyncio.gather(
+            panel_registry.fan_out(self._probe_panel),
+            *(bounded(self._probe_server(server)) for server in settings.VPN_SERVERS)
+        )
+    
+    async def _probe_panel(self, panel: X3UIService):
+        health = self._panels.get(panel.name)
+        if health is None:
+            health = self._panels[panel.name] = TargetHealth(panel.name, "panel")
+        try:
+            latency = await panel.probe(self.timeout)
+        except Exception as e:
+            panel.breaker.record_failure()
+            await self._record(health, None, str(e) or type(e).__name__)
+        else:
+            # Панель снова отвечает - открытый автомат закрывается, не дожидаясь рабочего
+            # запроса. Ошибки рабочих запросов в закрытом автомате проверка не обнуляет
+            if panel.breaker.state != panel.breaker.CLOSED:
+                panel.breaker.record_success()
+            await self._record(health, latency)
+    
+    async def _probe_server(self, server: Dict):
+        key = panel_registry.server_key(server)
+        health = self._servers.get(key)
+        if health is None:
+            health = self._servers[key] = TargetHealth(server.get("location") or key, "server")
+        
+        started = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(server.get("address"), server.get("port", 443)),
+                timeout=self.timeout
+            )
+        except Exception as e:
+            await self._record(health, None, str(e) or type(e).__name__)
+            return
+        latency = time.monotonic() - started
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        await self._record(health, latency)
+    
+    async def _record(self, health: TargetHealth, latency: Optional[float], error: str = None):
+        """Учет результата проверки и уведомление админов при смене состояния"""
+        health.checked_at = time.time()
+        if latency is not None:
+            health.histogram.observe(latency)
+            health.failures = 0
+            health.last_error = None
+            up = True
+        else:
+            health.failures += 1
+            health.last_error = error
+            metrics.inc(f"health_{health.kind}_failures")
+            up = health.up is not False and health.failures < settings.HEALTH_PROBE_FAILURES
+        
+        if up == health.up:
+            return
+        previous, health.up, health.changed_at = health.up, up, time.time()
+        if up and previous is None:
+            return
+        
+        if health.kind == "panel":
+            target, available, unavailable = "Панель 3x-ui", "доступна", "недоступна"
+        else:
+            target, available, unavailable = "Сервер", "доступен", "недоступен"
+        if up:
+            text = f"✅ {target} {health.name} снова {available}"
+            logger.info(text)
+        else:
+            text = f"⛔ {target} {health.name} {unavailable}: {error}"
+            logger.warning(text)
+        await notify_admins(text)
+    
+    def is_server_up(self, server: Dict) -> bool:
+        """Доступен ли сервер для новых ключей (порт и панель; еще не проверенные считаются доступными)"""
+        health = self._servers.get(panel_registry.server_key(server))
+        if health is not None and health.up is False:
+            return False
+        panel = panel_registry.for_server(server)
+        panel_health = self._panels.get(panel.name)
+        if panel_health is not None and panel_health.up is False:
+            return False
+        return panel.is_available
+    
+    def pick_server(self, servers: List[Dict] = None) -> Optional[Dict]:
+        """Сервер для нового ключа: первый доступный в порядке VPN_SERVERS
+        
+        Если доступных нет, возвращается первый сервер (ошибка проявится при создании ключа).
+        """
+        servers = settings.VPN_SERVERS if servers is None else servers
+        if not servers:
+            return None
+        for server in servers:
+            if self.is_server_up(server):
+                return server
+        return servers[0]
+    
+    def targets(self) -> List[TargetHealth]:
+        """Все проверяемые цели (сначала панели, потом серверы)"""
+        return list(self._panels.values()) + list(self._servers.values())
+
+
+# Создаем глобальный экземпляр
+health_prober = HealthProber()
@@ -0,0 +1,128 @@
+import json
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from loguru import logger
+from config.settings import settings
+
+# Быстрый JSON-бэкенд (ujson), если установлен; иначе стандартный json
+try:
+    import ujson
+    
+    def _loads(raw: str) -> Any:
+        return ujson.loads(raw)
+    
+    def _dumps(obj: Any, indent: int = 0) -> str:
+        # escape_forward_slashes=False: ссылки (spiderX, dest) остаются в том же виде, что и у панели
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, indent=indent)
+    
+    JSON_BACKEND = "ujson"
+except ImportError:
+    def _loads(raw: str) -> Any:
+        return json.loads(raw)
+    
+    def _dumps(obj: Any, indent: int = 0) -> str:
+        return json.dumps(obj, ensure_ascii=False, indent=indent or None)
+    
+    JSON_BACKEND = "json"
+
+
+def loads(raw: str) -> Any:
+    """Разбор JSON быстрым бэкендом"""
+    return _loads(raw)
+
+
+def dumps(obj: Any, indent: int = 0) -> str:
+    """Сериализация JSON быстрым бэкендом (без экранирования не-ASCII символов и '/')"""
+    return _dumps(obj, indent)
+
+
+class InboundCodec:
+    """Разбор вложенных JSON-полей inbound 3x-ui (settings, streamSettings, sniffing)
+    
+    Панель отдает эти поля строками JSON внутри JSON. Результат разбора запоминается
+    по содержимому строки (LRU), поэтому каждое поле снимка разбирается один раз,
+    сколько бы раз его ни читали. Разобранные значения общие - изменять их нельзя
+    (для изменения используется copy_field).
+    
+    Кэш ограничен суммарным размером строк (X3UI_CODEC_CACHE_MB): settings inbound
+    с десятками тысяч клиентов занимает мегабайты, а каждая запись клиентов дает
+    новый снимок. Разобранные объекты занимают в памяти в несколько раз больше строк.
+    Последняя запись не вытесняется, даже если она одна больше лимита.
+    """
+    
+    NESTED_FIELDS = ("settings", "streamSettings", "sniffing")
+    
+    def __init__(self, max_bytes: int = None, max_entries: int = 256):
+        self.max_bytes = settings.X3UI_CODEC_CACHE_MB * 1024 * 1024 if max_bytes is None else max_bytes
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, Any]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def decode(self, raw: Any) -> Any:
+        """Разбор строки JSON с запоминанием (не-строки возвращаются как есть)"""
+        if not isinstance(raw, str):
+            return raw
+        cached = self._cache.get(raw)
+        if cached is not None:
+            self.hits += 1
+            self._cache.move_to_end(raw)
+            return cached
+        
+        self.misses += 1
+        value = _loads(raw)
+        self._cache[raw] = value
+        self._bytes += len(raw)
+        while len(self._cache) > 1 and (len(self._cache) > self.max_entries or self._bytes > self.max_bytes):
+            evicted, _ = self._cache.popitem(last=False)
+            self._bytes -= len(evicted)
+        return value
+    
+    @property
+    def size_bytes(self) -> int:
+        """Суммарный размер закэшированных строк"""
+        return self._bytes
+    
+    def field(self, inbound: Dict, name: str) -> Dict:
+        """Разобранное поле inbound (общий объект, только для чтения); {} если поле пустое или битое"""
+        raw = inbound.get(name)
+        if not raw:
+            return {}
+        try:
+            value = self.decode(raw)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось разобрать {name} inbound {inbound.get('id')}: {e}")
+            return {}
+        return value if isinstance(value, dict) else {}
+    
+    def copy_field(self, inbound: Dict, name: str) -> Dict:
+        """Поле inbound для изменения: копия верхнего уровня и списка clients"""
+        value = dict(self.field(inbound, name))
+        if isinstance(value.get("clients"), list):
+            value["clients"] = list(value["clients"])
+        return value
+    
+    def decode_inbound(self, inbound: Dict) -> Dict:
+        """Копия inbound с разобранными вложенными полями"""
+        decoded = dict(inbound)
+        for name in self.NESTED_FIELDS:
+            if isinstance(inbound.get(name), str):
+                decoded[name] = self.field(inbound, name)
+        return decoded
+    
+    def encode_field(self, value: Any, original: Optional[Any] = None) -> str:
+        """Сериализация поля для отправки в панель
+        
+        Если значение не менялось (это тот же объект, что получен разбором original),
+        возвращается исходная строка без повторной сериализации.
+        """
+        if isinstance(original, str) and self._cache.get(original) is value:
+            return original
+        if isinstance(value, str):
+            return value
+        return _dumps(value) if value else "{}"
+
+
+# Создаем глобальный экземпляр (общий кэш разбора для всех сервисов)
+inbound_codec = InboundCodec()
@@ -0,0 +1,145 @@
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Tuple
+from loguru import logger
+
+# Поля server_config, от которых зависит ссылка VLESS. Их значения - версия профиля:
+# если параметры inbound изменились (например, новые Reality-ключи), шаблон компилируется заново
+VLESS_PROFILE_FIELDS = (
+    "network", "path", "security", "flow", "sni", "address", "port", "location",
+    "server_name", "fingerprint", "reality_pbk", "pbk", "reality_sid", "sid", "spiderx"
+)
+
+
+class LinkTemplate(NamedTuple):
+    """Скомпилированная ссылка сервера: меняется только UUID пользователя"""
+    prefix: str  # "vless://"
+    suffix: str  # "@host:port?query#remark"
+    
+    def render(self, user_uuid: str) -> str:
+        return self.prefix + user_uuid + self.suffix
+
+
+def compile_vless(server_config: Dict) -> LinkTemplate:
+    """Сборка параметров VLESS URL для профиля сервера (выполняется один раз на версию профиля)"""
+    network = server_config.get("network", "tcp")
+    path = server_config.get("path", "")
+    security = server_config.get("security", "none")  # none, tls, reality
+    flow = server_config.get("flow", "")  # для xtls-rprx-vision
+    sni = server_config.get("sni", server_config.get("address", ""))
+    host = server_config.get("address", "")
+    port = server_config["port"]
+    remark = server_config.get("location", "VPN Server")
+    
+    # Формируем параметры для VLESS URL
+    params = []
+    
+    # Encryption (обычно none для VLESS)
+    params.append("encryption=none")
+    
+    # Security
+    if security == "tls":
+        params.append("security=tls")
+        if sni:
+            params.append(f"sni={sni}")
+    elif security == "reality":
+        params.append("security=reality")
+        # Server Name (SNI) для Reality - обязательный параметр
+        server_name = server_config.get("server_name", server_config.get("sni", ""))
+        if server_name:
+            params.append(f"sni={server_name}")
+        else:
+            logger.warning(f"⚠️ server_name отсутствует для Reality! Ключ может быть неполным.")
+        # Fingerprint для Reality - опциональный параметр (если не указан, клиент использует значение по умолчанию)
+        fingerprint = server_config.get("fingerprint", "")
+        if fingerprint:
+            params.append(f"fp={fingerprint}")
+        else:
+            logger.debug(f"ℹ️ fingerprint не указан для Reality, будет использовано значение по умолчанию")
+        # Public Key (pbk) для Reality - обязательный параметр
+        public_key = server_config.get("reality_pbk", server_config.get("pbk", ""))
+        if public_key:
+            params.append(f"pbk={public_key}")
+        else:
+            logger.error(f"❌ reality_pbk отсутствует для Reality! Ключ будет неполным и не будет работать!")
+            logger.error(f"   Убедитесь, что reality_pbk указан в VPN_SERVERS в .env или извлекается из inbound")
+        # Short ID (sid) для Reality - обязательный параметр
+        short_id = server_config.get("reality_sid", server_config.get("sid", ""))
+        if short_id:
+            # Берем только первый Short ID, если указано несколько через запятую
+            short_id = short_id.split(",")[0].strip()
+            params.append(f"sid={short_id}")
+        else:
+            logger.error(f"❌ reality_sid отсутствует для Reality! Ключ будет неполным и не будет работать!")
+        # SpiderX для обхода блокировок (добавляем только если указан)
+        spiderx = server_config.get("spiderx", "")
+        if spiderx and spiderx.strip():
+            params.append(f"spx={spiderx}")
+    else:
+        params.append("security=none")
+    
+    # Flow (для xtls-rprx-vision)
+    if flow:
+        params.append(f"flow={flow}")
+    
+    # Network type
+    params.append(f"type={network}")
+    
+    # Header type
+    if network == "tcp":
+        params.append("headerType=none")
+    elif network == "ws":
+        params.append("headerType=none")
+        if path:
+            params.append(f"path={path}")
+        if sni:
+            params.append(f"host={sni}")
+    
+    query_string = "&".join(params)
+    if security == "reality":
+        logger.debug(f"🔍 Шаблон ссылки Reality для {host}:{port}: {query_string}")
+    return LinkTemplate("vless://", f"@{host}:{port}?{query_string}#{remark}")
+
+
+class LinkTemplateCache:
+    """Шаблоны ссылок по версиям профилей серверов (LRU)
+    
+    У пользователей одного сервера ссылки отличаются только UUID, поэтому
+    параметры профиля разбираются (и предупреждения о неполном профиле
+    пишутся в лог) один раз, а генерация ключа - это подстановка UUID.
+    """
+    
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[Tuple, LinkTemplate]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def profile_version(server_config: Dict) -> Tuple:
+        """Версия профиля VLESS: значения полей, от которых зависит ссылка"""
+        return tuple(server_config.get(field) for field in VLESS_PROFILE_FIELDS)
+    
+    def vless(self, server_config: Dict) -> LinkTemplate:
+        """Шаблон ссылки VLESS для профиля сервера"""
+        version = self.profile_version(server_config)
+        template = self._cache.get(version)
+        if template is not None:
+            self.hits += 1
+            self._cache.move_to_end(version)
+            return template
+        
+        self.misses += 1
+        template = compile_vless(server_config)
+        self._cache[version] = template
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        logger.info(f"🧩 Скомпилирован шаблон ссылки VLESS для {server_config.get('address')}:{server_config.get('port')}")
+        return template
+    
+    def clear(self):
+        """Сброс шаблонов (следующая генерация скомпилирует их заново)"""
+        self._cache.clear()
+
+
+# Создаем глобальный экземпляр (общий для всех генераторов ключей)
+link_templates = LinkTemplateCache()
@@ -0,0 +1,175 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from loguru import logger
+from config.settings import settings
+from app.services.vpn.x3ui_service import X3UIService, x3ui_service
+from app.services.vpn.provisioning_queue import ProvisioningQueue, provisioning_queue
+from app.services.vpn.xray_grpc import XrayGrpcService, GRPC_AVAILABLE
+from app.services.vpn.restart_scheduler import restart_scheduler
+
+
+class PanelRegistry:
+    """Реестр панелей 3x-ui: у каждого сервера из VPN_SERVERS - своя панель
+    
+    Сервер может указать собственную панель полями panel_url, panel_username,
+    panel_password и inbound_id. Серверы без panel_url используют панель по
+    умолчанию (X3UI_* из настроек, общий x3ui_service). Серверы с одинаковым
+    panel_url и inbound_id делят один X3UIService (одна пулированная сессия на панель).
+    
+    Если для панели задан адрес gRPC API Xray (XRAY_GRPC_ADDRESS для панели по
+    умолчанию или xray_grpc_address у сервера, в том числе у сервера без panel_url), клиенты меняются через него без
+    перезапуска Xray, а панель получает изменения позже (см. XrayGrpcService)
+    или перед ближайшим перезапуском Xray этой панели.
+    """
+    
+    def __init__(self):
+        self._panels: Dict[str, X3UIService] = {}  # URL панели и inbound -> сервис
+        self._queues: Dict[str, ProvisioningQueue] = {}  # URL панели и inbound -> очередь изменений
+        self._by_server: Dict[str, X3UIService] = {}  # "address:port" -> сервис
+        self._grpc: Dict[str, XrayGrpcService] = {}  # URL панели и inbound -> gRPC API Xray
+        self._built = False
+    
+    @staticmethod
+    def panel_key(service: X3UIService) -> str:
+        """Ключ панели в реестре: URL панели и inbound"""
+        return f"{service._panel_key}#{service.inbound_id}"
+    
+    @staticmethod
+    def server_key(server_config: Dict) -> str:
+        """Ключ сервера в реестре"""
+        return f"{server_config.get('address')}:{server_config.get('port', 443)}"
+    
+    def _build(self):
+        """Создание сервисов по VPN_SERVERS (один раз)"""
+        if self._built:
+            return
+        self._built = True
+        
+        default_key = self.panel_key(x3ui_service)
+        self._panels[default_key] = x3ui_service
+        self._queues[default_key] = provisioning_queue
+        if settings.XRAY_GRPC_ADDRESS:
+            self._add_grpc(x3ui_service, settings.XRAY_GRPC_ADDRESS, settings.XRAY_GRPC_INBOUND_TAG)
+        
+        for server in settings.VPN_SERVERS:
+            panel_url = server.get("panel_url")
+            if not panel_url:
+                self._by_server[self.server_key(server)] = x3ui_service
+                if server.get("xray_grpc_address"):
+                    # Сервер на панели по умолчанию: gRPC API - у ее Xray
+                    self._add_grpc(
+                        x3ui_service,
+                        server["xray_grpc_address"],
+                        server.get("xray_grpc_inbound_tag") or settings.XRAY_GRPC_INBOUND_TAG,
+                        server.get("protocol", "vless")
+                    )
+                continue
+            
+            service = X3UIService(
+                api_url=panel_url,
+                username=server.get("panel_username"),
+                password=server.get("panel_password"),
+                inbound_id=server.get("inbound_id"),
+                name=server.get("location") or server.get("address")
+            )
+            key = self.panel_key(service)
+            existing = self._panels.get(key)
+            if existing is None:
+                self._panels[key] = service
+                self._queues[key] = ProvisioningQueue(service)
+                existing = service
+            self._by_server[self.server_key(server)] = existing
+            if server.get("xray_grpc_address"):
+                self._add_grpc(
+                    existing,
+                    server["xray_grpc_address"],
+                    server.get("xray_grpc_inbound_tag") or settings.XRAY_GRPC_INBOUND_TAG,
+                    server.get("protocol", "vless")
+                )
+        
+        logger.info(f"📋 Панелей 3x-ui: {len(self._panels)}, серверов: {len(self._by_server)}, gRPC API Xray: {len(self._grpc)}")
+        if self._grpc and not GRPC_AVAILABLE:
+            logger.warning("⚠️ gRPC API Xray настроен, но grpcio не установлен - клиенты меняются через панель")
+    
+    def _add_grpc(self, service: X3UIService, address: str, inbound_tag: str, protocol: str = "vless"):
+        key = self.panel_key(service)
+        existing = self._grpc.get(key)
+        if existing is not None:
+            if (existing.address, existing.inbound_tag) != (address, inbound_tag):
+                logger.warning(
+                    f"⚠️ gRPC API Xray {address} ({inbound_tag}) пропущен: для панели {service.name} "
+                    f"уже задан {existing.address} ({existing.inbound_tag})"
+                )
+            return
+        backend = self._grpc[key] = XrayGrpcService(address, inbound_tag, service, protocol=protocol, name=service.name)
+        if backend.is_available:
+            # Клиенты, добавленные через gRPC, есть только в работающем Xray до записи в панель:
+            # перед любым перезапуском Xray панели изменения записываются в нее
+            service.add_restart_hook(backend.persist)
+    
+    def panels(self) -> List[X3UIService]:
+        """Все панели"""
+        self._build()
+        return list(self._panels.values())
+    
+    def for_server(self, server_config: Optional[Dict]) -> X3UIService:
+        """Панель сервера (панель по умолчанию, если сервер неизвестен)"""
+        self._build()
+        if not server_config:
+            return x3ui_service
+        return self._by_server.get(self.server_key(server_config), x3ui_service)
+    
+    def queue_for(self, service: X3UIService) -> ProvisioningQueue:
+        """Очередь изменений клиентов панели"""
+        self._build()
+        return self._queues.get(self.panel_key(service), provisioning_queue)
+    
+    def grpc_for(self, service: X3UIService) -> Optional[XrayGrpcService]:
+        """gRPC API Xray панели (None, если не настроен или grpcio не установлен)"""
+        self._build()
+        backend = self._grpc.get(self.panel_key(service))
+        return backend if backend is not None and backend.is_available else None
+    
+    async def fan_out(
+        self,
+        func: Callable[[X3UIService], Awaitable[Any]],
+        concurrency: int = None
+    ) -> Dict[str, Any]:
+        """Выполнение операции на всех панелях одновременно (не более concurrency за раз)
+        
+        Returns:
+            dict: имя панели -> результат func или исключение, если операция упала
+        """
+        panels = self.panels()
+        semaphore = asyncio.Semaphore(concurrency or settings.X3UI_FANOUT_CONCURRENCY)
+        
+        async def run(panel: X3UIService):
+            async with semaphore:
+                try:
+                    return await func(panel)
+                except Exception as e:
+                    logger.error(f"Ошибка операции на панели {panel.name}: {e}")
+                    return e
+        
+        results = await asyncio.gather(*(run(panel) for panel in panels))
+        return {panel.name: result for panel, result in zip(panels, results)}
+    
+    async def start(self):
+        """Открытие HTTP-сессий всех панелей и запуск записи изменений из gRPC API Xray"""
+        await asyncio.gather(*(panel.start() for panel in self.panels()))
+        for backend in self._grpc.values():
+            if backend.is_available:
+                backend.start()
+    
+    async def close(self):
+        """Применение оставшихся изменений и закрытие сессий всех панелей"""
+        self._build()
+        await asyncio.gather(*(backend.close() for backend in self._grpc.values()), return_exceptions=True)
+        await asyncio.gather(*(queue.close() for queue in self._queues.values()), return_exceptions=True)
+        # Запланированные перезапуски Xray выполняются, пока сессии панелей еще открыты
+        await restart_scheduler.flush()
+        await asyncio.gather(*(panel.close() for panel in self._panels.values()), return_exceptions=True)
+
+
+# Создаем глобальный экземпляр
+panel_registry = PanelRegistry()
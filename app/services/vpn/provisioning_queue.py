@@ -0,0 +1,119 @@
+import asyncio
+from typing import Optional, Dict, List, Tuple
+from loguru import logger
+from config.settings import settings
+from app.services.vpn.x3ui_service import X3UIService, x3ui_service
+
+
+class ProvisioningQueue:
+    """Очередь изменений клиентов 3x-ui с объединением записей
+    
+    Добавления и удаления, пришедшие в течение короткого окна (X3UI_BATCH_WINDOW),
+    применяются к панели пакетом: один addClient со всеми новыми клиентами
+    (или одна перезапись inbound) и один перезапуск Xray. Каждый вызывающий
+    ждет свой future и получает результат для своего клиента.
+    """
+    
+    def __init__(self, service: X3UIService, window: float = None, max_batch: int = None):
+        self.service = service
+        self.window = settings.X3UI_BATCH_WINDOW if window is None else window
+        self.max_batch = max_batch or settings.X3UI_BATCH_MAX_SIZE
+        
+        # inbound_id -> операции в порядке поступления: (действие, uuid, email, future)
+        self._pending: Dict[int, List[Tuple[str, str, Optional[str], asyncio.Future]]] = {}
+        self._pending_count = 0
+        self._timer: Optional[asyncio.Task] = None
+        self._flush_tasks: set = set()
+        self._flush_lock = asyncio.Lock()
+        self._closed = False
+    
+    async def add_client(self, uuid: str, email: str = None, inbound_id: int = None) -> Tuple[bool, Optional[Dict]]:
+        """Добавление клиента через очередь (аналог X3UIService.add_client)"""
+        return await self._enqueue("add", uuid, email, inbound_id)
+    
+    async def remove_client(self, uuid: str, inbound_id: int = None) -> bool:
+        """Удаление клиента через очередь (аналог X3UIService.remove_client)"""
+        return await self._enqueue("remove", uuid, None, inbound_id)
+    
+    async def _enqueue(self, action: str, uuid: str, email: Optional[str], inbound_id: Optional[int]):
+        """Постановка операции в очередь и ожидание ее результата"""
+        if self._closed or self.window <= 0:
+            # Очередь выключена - выполняем операцию сразу
+            if action == "add":
+                return await self.service.add_client(uuid, email, inbound_id)
+            return await self.service.remove_client(uuid, inbound_id)
+        
+        inbound_id = inbound_id or self.service.inbound_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(inbound_id, []).append((action, uuid, email, future))
+        self._pending_count += 1
+        
+        if self._pending_count >= self.max_batch:
+            # Пакет заполнен - применяем не дожидаясь окончания окна
+            task = asyncio.create_task(self.flush())
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        
+        return await future
+    
+    async def _flush_later(self):
+        """Применение пакета по окончании окна"""
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            # Операции, пришедшие во время применения пакета, запустят новое окно
+            self._timer = None
+        await self.flush()
+    
+    async def flush(self):
+        """Применение всех накопленных операций"""
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            count, self._pending_count = self._pending_count, 0
+            if not pending:
+                return
+            
+            logger.info(f"📦 Применение пакета изменений 3x-ui: {count} операций, inbounds: {list(pending)}")
+            for inbound_id, operations in pending.items():
+                # Подряд идущие операции одного типа объединяются; порядок разных типов сохраняется
+                run: List[Tuple[str, str, Optional[str], asyncio.Future]] = []
+                for operation in operations:
+                    if run and operation[0] != run[0][0]:
+                        await self._apply_run(inbound_id, run)
+                        run = []
+                    run.append(operation)
+                if run:
+                    await self._apply_run(inbound_id, run)
+    
+    async def _apply_run(self, inbound_id: int, run: List[Tuple[str, str, Optional[str], asyncio.Future]]):
+        """Применение пакета однотипных операций и передача результатов вызывающим"""
+        action = run[0][0]
+        try:
+            if action == "add":
+                results = await self.service.add_clients([(uuid, email) for _, uuid, email, _ in run], inbound_id)
+                default = (False, None)
+            else:
+                results = await self.service.remove_clients([uuid for _, uuid, _, _ in run], inbound_id)
+                default = False
+        except Exception as e:
+            logger.error(f"Ошибка применения пакета изменений 3x-ui: {e}")
+            results, default = {}, ((False, None) if action == "add" else False)
+        
+        for _, uuid, _, future in run:
+            if not future.done():
+                future.set_result(results.get(uuid, default))
+    
+    async def close(self):
+        """Применение оставшихся операций (вызывается при остановке бота)"""
+        self._closed = True
+        if self._timer:
+            self._timer.cancel()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        await self.flush()
+
+
+# Создаем глобальный экземпляр (очередь перед общим X3UIService)
+provisioning_queue = ProvisioningQueue(x3ui_service)
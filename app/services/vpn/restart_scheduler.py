@@ -0,0 +1,163 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List
+from loguru import logger
+from config.settings import settings
+from app.utils.metrics import metrics
+from app.utils.notify import notify_admins
+
+
+class PendingRestart:
+    """Запланированный перезапуск Xray одного узла"""
+    
+    def __init__(self, node: str, name: str, restart: Callable[[], Awaitable[bool]], deadline: float, max_deadline: float):
+        self.node = node
+        self.name = name
+        self.restart = restart
+        self.requested_at = time.monotonic()
+        self.deadline = deadline
+        self.max_deadline = max_deadline
+        self.requests = 0
+        self.waiters: List[asyncio.Future] = []
+        self.wake = asyncio.Event()
+
+
+class RestartScheduler:
+    """Отложенный и объединенный перезапуск Xray по узлам (панель 3x-ui или VPS по SSH)
+    
+    Изменение клиентов только помечает узел "грязным": перезапуск выполняется
+    через XRAY_RESTART_WINDOW секунд после последнего запроса, но не позже
+    XRAY_RESTART_MAX_DELAY секунд после первого. Все запросы, пришедшие за это
+    время, обслуживаются одним перезапуском. Запросы во время перезапуска
+    планируют следующий (их изменения могли не попасть в текущий).
+    """
+    
+    def __init__(self, window: float = None, max_delay: float = None):
+        self.window = settings.XRAY_RESTART_WINDOW if window is None else window
+        self.max_delay = settings.XRAY_RESTART_MAX_DELAY if max_delay is None else max_delay
+        self._pending: Dict[str, PendingRestart] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}  # Один перезапуск узла за раз
+        self._tasks: set = set()
+        self._closed = False
+    
+    def request(self, node: str, restart: Callable[[], Awaitable[bool]], name: str = None) -> asyncio.Future:
+        """Пометить узел для перезапуска
+        
+        Args:
+            node: ключ узла (у разных inbounds одной панели - один Xray и один ключ)
+            restart: корутина перезапуска; вызывается последняя переданная
+        
+        Returns:
+            Future с результатом перезапуска (True - успешно); ждать его не обязательно
+        """
+        now = time.monotonic()
+        pending = self._pending.get(node)
+        if pending is None:
+            pending = self._pending[node] = PendingRestart(
+                node, name or node, restart, now + self.window, now + max(self.max_delay, self.window)
+            )
+            self._spawn(self._run(pending))
+        pending.restart = restart
+        pending.requests += 1
+        # Каждый запрос отодвигает перезапуск на окно, но не дальше максимальной задержки
+        pending.deadline = min(now + self.window, pending.max_deadline)
+        
+        future = asyncio.get_running_loop().create_future()
+        pending.waiters.append(future)
+        if self._closed or self.window <= 0:
+            pending.deadline = now
+            pending.wake.set()
+        return future
+    
+    async def run_now(self, node: str, restart: Callable[[], Awaitable[bool]], name: str = None) -> bool:
+        """Перезапуск узла сразу (вместе с уже запланированными изменениями)"""
+        future = self.request(node, restart, name)
+        pending = self._pending.get(node)
+        if pending is not None:
+            pending.deadline = time.monotonic()
+            pending.wake.set()
+        return await future
+    
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, pending: PendingRestart):
+        """Ожидание срока перезапуска (срок может сдвигаться новыми запросами)"""
+        while True:
+            delay = pending.deadline - time.monotonic()
+            if delay <= 0:
+                break
+            pending.wake.clear()
+            try:
+                await asyncio.wait_for(pending.wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        await self._restart(pending)
+    
+    async def _restart(self, pending: PendingRestart):
+        lock = self._locks.setdefault(pending.node, asyncio.Lock())
+        async with lock:
+            # Новые запросы с этого момента планируют следующий перезапуск
+            if self._pending.get(pending.node) is pending:
+                del self._pending[pending.node]
+            waited = time.monotonic() - pending.requested_at
+            logger.info(
+                f"🔄 Перезапуск Xray {pending.name}: {pending.requests} изменений объединено, "
+                f"ожидание {waited:.1f}с"
+            )
+            try:
+                success = bool(await pending.restart())
+            except Exception as e:
+                logger.error(f"Ошибка перезапуска Xray {pending.name}: {e}")
+                success = False
+        
+        metrics.inc("xray_restarts")
+        metrics.inc("xray_restart_requests_coalesced", pending.requests - 1)
+        metrics.observe("xray_restart_delay", waited)
+        for future in pending.waiters:
+            if not future.done():
+                future.set_result(success)
+        if not success:
+            metrics.inc("xray_restarts_failed")
+            await notify_admins(
+                f"⚠️ Не удалось перезапустить Xray {pending.name}\n\n"
+                f"Изменений клиентов, ожидающих перезапуска: {pending.requests}"
+            )
+    
+    def pending(self) -> List[Dict]:
+        """Запланированные перезапуски (для отчета админам)"""
+        now = time.monotonic()
+        return [
+            {
+                "name": pending.name,
+                "requests": pending.requests,
+                "waiting": now - pending.requested_at,
+                "due_in": max(0.0, pending.deadline - now)
+            }
+            for pending in self._pending.values()
+        ]
+    
+    async def flush(self):
+        """Немедленное выполнение всех запланированных перезапусков"""
+        futures = []
+        for pending in list(self._pending.values()):
+            pending.deadline = time.monotonic()
+            pending.wake.set()
+            futures.extend(pending.waiters)
+        if futures:
+            await asyncio.gather(*futures, return_exceptions=True)
+    
+    async def close(self):
+        """Выполнение запланированных перезапусков при остановке бота"""
+        self._closed = True
+        if self._pending:
+            logger.info(f"🔄 Выполняем запланированные перезапуски Xray: {len(self._pending)}")
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+# Создаем глобальный экземпляр
+restart_scheduler = RestartScheduler()
@@ -0,0 +1,220 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+import paramiko
+from loguru import logger
+from config.settings import settings
+
+
+class SSHConnection:
+    """Постоянное SSH-подключение к одному хосту с закэшированным SFTP
+    
+    Транспорт держится открытым между операциями (keepalive), SFTP-канал
+    открывается один раз и переиспользуется. Если подключение оборвалось,
+    оно пересоздается при следующей операции. Все методы блокирующие и
+    вызываются из пула потоков (см. SSHPool.run_blocking).
+    """
+    
+    # Ошибки, после которых подключение считается потерянным (таймаут сюда не входит:
+    # подключение может быть живым, просто команда выполняется долго)
+    CONNECTION_ERRORS = (paramiko.SSHException, EOFError, ConnectionError)
+    
+    def __init__(self, host: str, port: int, username: str, password: str = None, key_path: str = None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.key_path = key_path
+        
+        self._client: Optional[paramiko.SSHClient] = None
+        self._sftp: Optional[paramiko.SFTPClient] = None
+        self._lock = threading.RLock()
+        # SFTP-канал не рассчитан на одновременные запросы из разных потоков
+        self._sftp_lock = threading.Lock()
+        # Пути к конфигурации Xray и базе данных 3x-ui на хосте: (время определения, пути).
+        # Подключение одно на хост, поэтому пути определяются один раз для всех сервисов
+        # (заполняет и сбрасывает VPSService._get_host_layout)
+        self.layout: Optional[Tuple[float, Dict[str, Optional[str]]]] = None
+    
+    def __repr__(self) -> str:
+        return f"{self.username}@{self.host}:{self.port}"
+    
+    def _is_active(self) -> bool:
+        transport = self._client.get_transport() if self._client else None
+        return transport is not None and transport.is_active()
+    
+    def client(self) -> paramiko.SSHClient:
+        """Открытый SSH-клиент (подключение создается при необходимости)"""
+        with self._lock:
+            if self._is_active():
+                return self._client
+            
+            self._drop()
+            if not self.key_path and not self.password:
+                raise paramiko.AuthenticationException("Не указан пароль или SSH ключ для VPS")
+            
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(
+                hostname=self.host,
+                port=self.port,
+                username=self.username,
+                password=None if self.key_path else self.password,
+                key_filename=self.key_path or None,
+                timeout=10
+            )
+            transport = client.get_transport()
+            if transport is not None:
+                transport.set_keepalive(settings.SSH_KEEPALIVE_INTERVAL)
+            self._client = client
+            logger.info(f"🔌 SSH-подключение к {self} открыто")
+            return client
+    
+    def sftp(self) -> paramiko.SFTPClient:
+        """Закэшированный SFTP-клиент этого подключения"""
+        with self._lock:
+            client = self.client()
+            channel = self._sftp.get_channel() if self._sftp else None
+            if channel is None or channel.closed:
+                self._sftp = client.open_sftp()
+            return self._sftp
+    
+    def run(self, func: Callable[["SSHConnection"], Any], idempotent: bool = False) -> Any:
+        """Выполнение func(connection); при обрыве соединения подключение сбрасывается
+        
+        Повтор на новом подключении - только для idempotent=True: обрыв мог случиться
+        после того, как VPS выполнил команду (изменение базы данных, запись файла),
+        и повтор выполнил бы ее второй раз.
+        """
+        try:
+            return func(self)
+        except self.CONNECTION_ERRORS as e:
+            if isinstance(e, paramiko.AuthenticationException):
+                raise
+            self.invalidate()
+            if not idempotent:
+                logger.warning(f"⚠️ SSH-подключение к {self} потеряно ({e}), операция не повторяется: она могла выполниться")
+                raise
+            logger.warning(f"⚠️ SSH-подключение к {self} потеряно ({e}), переподключаемся")
+            return func(self)
+    
+    def _open_channel(self) -> paramiko.Channel:
+        """Новый канал для команды (до отправки команды - повтор при обрыве безопасен)"""
+        transport = self.client().get_transport()
+        if transport is None:
+            raise paramiko.SSHException(f"SSH-подключение к {self} не активно")
+        return transport.open_session(timeout=10)
+    
+    def exec(self, command: str, stdin: str = None, idempotent: bool = False) -> Tuple[int, str, str]:
+        """Выполнение команды: (код завершения, stdout, stderr)
+        
+        stdin передается через канал, а не в командной строке: размер аргументов
+        команды ограничен ядром (MAX_ARG_STRLEN, 128 КБ на строку).
+        Подключение и открытие канала повторяются при обрыве всегда, сама команда -
+        только при idempotent=True (чтение).
+        """
+        def run(connection: "SSHConnection", channel: paramiko.Channel = None):
+            channel = channel or connection._open_channel()
+            channel.settimeout(settings.SSH_OPERATION_TIMEOUT)
+            channel.exec_command(command)
+            if stdin is not None:
+                channel.sendall(stdin.encode('utf-8'))
+                channel.shutdown_write()
+            out = channel.makefile('rb').read().decode('utf-8')
+            err = channel.makefile_stderr('rb').read().decode('utf-8')
+            return channel.recv_exit_status(), out, err
+        
+        if idempotent:
+            return self.run(run, idempotent=True)
+        channel = self.run(SSHConnection._open_channel, idempotent=True)
+        return self.run(lambda connection: run(connection, channel))
+    
+    def with_sftp(self, func: Callable[[paramiko.SFTPClient], Any], idempotent: bool = False) -> Any:
+        """Выполнение func(sftp) на закэшированном SFTP-канале
+        
+        Подключение и открытие SFTP-канала повторяются при обрыве всегда, сама
+        операция - только при idempotent=True (чтение).
+        """
+        def run(connection: "SSHConnection"):
+            with connection._sftp_lock:
+                return func(connection.sftp())
+        
+        if not idempotent:
+            self.run(SSHConnection.sftp, idempotent=True)
+        return self.run(run, idempotent)
+    
+    def _drop(self):
+        if self._sftp is not None:
+            try:
+                self._sftp.close()
+            except Exception:
+                pass
+        if self._client is not None:
+            try:
+                self._client.close()
+            except Exception:
+                pass
+        self._sftp = None
+        self._client = None
+    
+    def invalidate(self):
+        """Сброс подключения (следующая операция подключится заново)"""
+        with self._lock:
+            self._drop()
+    
+    def close(self):
+        """Закрытие подключения"""
+        with self._lock:
+            if self._client is not None:
+                logger.info(f"SSH-подключение к {self} закрыто")
+            self._drop()
+
+
+class SSHPool:
+    """Постоянные SSH-подключения по хостам и ограниченный пул потоков для них
+    
+    Блокирующие операции paramiko/sqlite выполняются в отдельном пуле из
+    SSH_EXECUTOR_WORKERS потоков с таймаутом SSH_OPERATION_TIMEOUT: медленный
+    VPS занимает только эти потоки, а не цикл событий бота.
+    """
+    
+    def __init__(self, workers: int = None):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or settings.SSH_EXECUTOR_WORKERS,
+            thread_name_prefix="ssh"
+        )
+        self._connections: Dict[Tuple[str, int, str], SSHConnection] = {}
+    
+    def get(self, host: str, port: int, username: str, password: str = None, key_path: str = None) -> SSHConnection:
+        """Подключение к хосту (одно на host/port/username)"""
+        key = (host, port, username)
+        connection = self._connections.get(key)
+        if connection is None or connection.password != password or connection.key_path != key_path:
+            if connection is not None:
+                connection.close()
+            connection = self._connections[key] = SSHConnection(host, port, username, password, key_path)
+        return connection
+    
+    async def run_blocking(self, func: Callable, *args, timeout: float = None) -> Any:
+        """Выполнение блокирующей операции в пуле потоков с таймаутом"""
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(
+            loop.run_in_executor(self._executor, functools.partial(func, *args)),
+            timeout=timeout or settings.SSH_OPERATION_TIMEOUT
+        )
+    
+    async def close(self):
+        """Закрытие всех подключений"""
+        connections = list(self._connections.values())
+        self._connections.clear()
+        for connection in connections:
+            try:
+                await self.run_blocking(connection.close)
+            except Exception as e:
+                logger.debug(f"Ошибка закрытия SSH-подключения {connection}: {e}")
+
+
+# Создаем глобальный экземпляр
+ssh_pool = SSHPool()
@@ -0,0 +1,146 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+from loguru import logger
+from sqlalchemy import select, func
+from config.settings import settings
+from app.database.models import V2RayKey, TrafficStat, TrafficCursor
+from app.services.database import db
+from app.services.vpn.panel_registry import panel_registry
+from app.services.vpn.x3ui_service import X3UIService
+from app.utils.metrics import metrics
+
+
+class TrafficSyncService:
+    """Фоновая синхронизация трафика клиентов с панелей 3x-ui в локальную БД
+    
+    Раз в TRAFFIC_SYNC_INTERVAL секунд с каждой панели одним запросом читаются
+    накопленные счетчики всех клиентов. По курсору (последним прочитанным
+    значениям) считается прирост, и в traffic_stats пишутся только ненулевые
+    приросты. Статистика пользователя затем считается по локальной таблице,
+    без обращения к панели.
+    """
+    
+    def __init__(self, db, interval: float = None):
+        self.db = db
+        self.interval = interval or settings.TRAFFIC_SYNC_INTERVAL
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self.last_sync_at: Optional[datetime] = None
+    
+    def start(self):
+        """Запуск фоновой синхронизации"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"📊 Синхронизация трафика запущена (каждые {self.interval:.0f}с)")
+    
+    async def close(self):
+        """Остановка фоновой синхронизации"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.sync_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка синхронизации трафика: {e}")
+            await asyncio.sleep(self.interval)
+    
+    async def sync_once(self) -> int:
+        """Один проход синхронизации по всем панелям
+        
+        Returns:
+            int: количество записанных приростов
+        """
+        async with self._lock:
+            results = await panel_registry.fan_out(lambda panel: self._sync_panel(panel))
+            written = sum(result for result in results.values() if isinstance(result, int))
+            self.last_sync_at = datetime.utcnow()
+            metrics.inc("traffic_sync_rows", written)
+            logger.debug(f"📊 Синхронизация трафика: записано приростов {written}")
+            return written
+    
+    async def _sync_panel(self, panel: X3UIService) -> int:
+        """Синхронизация одной панели"""
+        traffic = await panel.get_client_traffic()
+        if traffic is None:
+            raise RuntimeError("панель не вернула счетчики трафика")
+        if not traffic:
+            return 0
+        
+        panel_key = panel_registry.panel_key(panel)
+        now = datetime.utcnow()
+        written = 0
+        
+        async with self.db.session_maker() as session:
+            # Владельцы ключей (учитываются только клиенты, созданные ботом)
+            owners_result = await session.execute(
+                select(V2RayKey.uuid, V2RayKey.user_id).where(V2RayKey.uuid.in_(list(traffic)))
+            )
+            owners: Dict[str, int] = {uuid: user_id for uuid, user_id in owners_result}
+            if not owners:
+                return 0
+            
+            cursors_result = await session.execute(
+                select(TrafficCursor).where(TrafficCursor.panel == panel_key)
+            )
+            cursors: Dict[str, TrafficCursor] = {c.key_uuid: c for c in cursors_result.scalars()}
+            
+            for uuid, user_id in owners.items():
+                up, down = traffic[uuid]
+                cursor = cursors.get(uuid)
+                if cursor is None:
+                    # Первое появление клиента: курсор начинается с текущих счетчиков, прирост
+                    # не записывается (иначе весь накопленный трафик попал бы в сегодняшний день)
+                    session.add(TrafficCursor(panel=panel_key, key_uuid=uuid, up=up, down=down, updated_at=now))
+                    continue
+                
+                delta_up, delta_down = self._delta(cursor.up or 0, up), self._delta(cursor.down or 0, down)
+                if delta_up or delta_down:
+                    session.add(TrafficStat(
+                        user_id=user_id,
+                        key_uuid=uuid,
+                        up=delta_up,
+                        down=delta_down,
+                        recorded_at=now
+                    ))
+                    written += 1
+                cursor.up, cursor.down, cursor.updated_at = up, down, now
+            
+            await session.commit()
+        
+        return written
+    
+    @staticmethod
+    def _delta(previous: int, current: int) -> int:
+        """Прирост счетчика (после сброса трафика на панели счетчик начинается с нуля)"""
+        return current - previous if current >= previous else current
+    
+    async def get_user_traffic(self, telegram_id: int, days: int = 30) -> Tuple[int, int, int, int]:
+        """Трафик пользователя из локальной таблицы
+        
+        Returns:
+            tuple: (up, down) за все время и (up, down) за последние days дней, в байтах
+        """
+        since = datetime.utcnow() - timedelta(days=days)
+        async with self.db.session_maker() as session:
+            stmt = select(
+                func.coalesce(func.sum(TrafficStat.up), 0),
+                func.coalesce(func.sum(TrafficStat.down), 0),
+                func.coalesce(func.sum(TrafficStat.up).filter(TrafficStat.recorded_at >= since), 0),
+                func.coalesce(func.sum(TrafficStat.down).filter(TrafficStat.recorded_at >= since), 0)
+            ).where(TrafficStat.user_id == telegram_id)  # user_id ключей - Telegram ID (см. V2RayService.create_key)
+            row = (await session.execute(stmt)).one()
+            return tuple(int(value) for value in row)
+
+
+# Создаем глобальный экземпляр
+traffic_sync = TrafficSyncService(db)
@@ -3,8 +3,12 @@ import json
 import base64
 from io import BytesIO
 from datetime import datetime, timedelta
-from typing import Dict, Optional
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
 from loguru import logger
+from config.settings import settings
+from app.core.exceptions import CircuitOpenError
+from app.services.vpn.inbound_codec import inbound_codec
+from app.services.vpn.link_templates import link_templates
 
 class V2RayGenerator:
     """Генератор ключей для V2RayTun (поддерживает VMess и VLESS)"""
@@ -19,101 +23,8 @@ class V2RayGenerator:
         if not user_uuid:
             user_uuid = str(uuid.uuid4())
         
-        # Определяем параметры
-        network = server_config.get("network", "tcp")
-        path = server_config.get("path", "")
-        tls_enabled = server_config.get("tls", False)
-        security = server_config.get("security", "none")  # none, tls, reality
-        flow = server_config.get("flow", "")  # для xtls-rprx-vision
-        sni = server_config.get("sni", server_config.get("address", ""))
-        host = server_config.get("address", "")
-        port = server_config["port"]
-        remark = server_config.get("location", "VPN Server")
-        
-        # Формируем параметры для VLESS URL
-        params = []
-        
-        # Encryption (обычно none для VLESS)
-        params.append("encryption=none")
-        
-        # Security
-        if security == "tls":
-            params.append("security=tls")
-            if sni:
-                params.append(f"sni={sni}")
-        elif security == "reality":
-            params.append("security=reality")
-            # Server Name (SNI) для Reality - обязательный параметр
-            server_name = server_config.get("server_name", server_config.get("sni", ""))
-            if server_name:
-                params.append(f"sni={server_name}")
-            else:
-                logger.warning(f"⚠️ server_name отсутствует для Reality! Ключ может быть неполным.")
-            # Fingerprint для Reality - опциональный параметр (если не указан, используется значение по умолчанию)
-            fingerprint = server_config.get("fingerprint", "")
-            if fingerprint:
-                params.append(f"fp={fingerprint}")
-            else:
-                # Fingerprint опционален - если не указан, клиент использует значение по умолчанию
-                logger.debug(f"ℹ️ fingerprint не указан для Reality, будет использовано значение по умолчанию")
-            # Public Key (pbk) для Reality - обязательный параметр
-            public_key = server_config.get("reality_pbk", server_config.get("pbk", ""))
-            if public_key:
-                params.append(f"pbk={public_key}")
-            else:
-                logger.error(f"❌ reality_pbk отсутствует для Reality! Ключ будет неполным и не будет работать!")
-                logger.error(f"   Убедитесь, что reality_pbk указан в VPN_SERVERS в .env или извлекается из inbound")
-            # Short ID (sid) для Reality - обязательный параметр
-            # Если указано несколько Short ID через запятую, берем только первый
-            short_id = server_config.get("reality_sid", server_config.get("sid", ""))
-            if short_id:
-                # Берем только первый Short ID, если указано несколько через запятую
-                short_id = short_id.split(",")[0].strip()
-                params.append(f"sid={short_id}")
-            else:
-                logger.error(f"❌ reality_sid отсутствует для Reality! Ключ будет неполным и не будет работать!")
-            # SpiderX для обхода блокировок (добавляем только если указан)
-            spiderx = server_config.get("spiderx", "")
-            if spiderx and spiderx.strip():  # Добавляем только если не пустой
-                params.append(f"spx={spiderx}")
-        else:
-            params.append("security=none")
-        
-        # Flow (для xtls-rprx-vision)
-        if flow:
-            params.append(f"flow={flow}")
-        
-        # Network type
-        params.append(f"type={network}")
-        
-        # Header type
-        if network == "tcp":
-            params.append("headerType=none")
-        elif network == "ws":
-            params.append("headerType=none")
-            if path:
-                params.append(f"path={path}")
-            if sni:
-                params.append(f"host={sni}")
-        
-        # Формируем VLESS URL
-        query_string = "&".join(params)
-        vless_url = f"vless://{user_uuid}@{host}:{port}?{query_string}#{remark}"
-        
-        # ВАЖНО: Логируем параметры для отладки
-        if security == "reality":
-            logger.debug(f"🔍 Параметры Reality в ключе:")
-            logger.debug(f"   - security: {security}")
-            logger.debug(f"   - server_name: {server_config.get('server_name', 'N/A')}")
-            logger.debug(f"   - fingerprint: {server_config.get('fingerprint', 'N/A')}")
-            logger.debug(f"   - reality_pbk: {'присутствует' if server_config.get('reality_pbk') else 'ОТСУТСТВУЕТ'}")
-            logger.debug(f"   - reality_sid: {server_config.get('reality_sid', 'N/A')}")
-            logger.debug(f"   - spiderx: {server_config.get('spiderx', 'N/A')}")
-            logger.debug(f"   - Параметры в URL: {query_string}")
-            if not server_config.get('reality_pbk'):
-                logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА: reality_pbk отсутствует! Ключ будет неполным!")
-        
-        return vless_url, user_uuid
+        # Параметры сервера собираются один раз на версию профиля, для ключа подставляется только UUID
+        return link_templates.vless(server_config).render(user_uuid), user_uuid
     
     @staticmethod
     def generate_vmess_config(server_config: Dict, user_uuid: str = None) -> tuple[str, str]:
@@ -198,8 +109,6 @@ class V2RayService:
         self.db = db
         self.generator = V2RayGenerator()
         self._vps_service = None  # Кэш для VPSService
-        self._inbound_cache = None  # Кэш для inbound
-        self._inbound_cache_time = None  # Время кэширования
     
     async def _get_vps_service(self):
         """Получение VPSService с кэшированием"""
@@ -208,27 +117,17 @@ class V2RayService:
             self._vps_service = VPSService()
         return self._vps_service
     
-    async def _get_inbound_cached(self, force_refresh: bool = False):
-        """Получение inbound с кэшированием (кэш на 60 секунд)"""
-        import time
-        current_time = time.time()
+    async def _get_inbound_cached(self, force_refresh: bool = False, server_config: Optional[Dict] = None):
+        """Получение inbound из общего снимка X3UIService (обновляется в фоне и после записей)
         
-        # Проверяем кэш (действителен 60 секунд)
-        if not force_refresh and self._inbound_cache and self._inbound_cache_time:
-            if current_time - self._inbound_cache_time < 60:
-                logger.debug("✅ Используем кэшированный inbound")
-                return self._inbound_cache
-        
-        # Получаем свежий inbound
+        Args:
+            server_config: сервер из VPN_SERVERS (inbound берется с его панели)
+        """
         try:
             vps_service = await self._get_vps_service()
-            if hasattr(vps_service, 'x3ui_service') and vps_service.x3ui_service:
-                inbound = await vps_service.x3ui_service.get_inbound()
-                if inbound:
-                    self._inbound_cache = inbound
-                    self._inbound_cache_time = current_time
-                    logger.debug("✅ Inbound закэширован")
-                    return inbound
+            if getattr(vps_service, 'panel_registry', None):
+                panel = vps_service.panel_registry.for_server(server_config)
+                return await panel.get_inbound(force_refresh=force_refresh)
         except Exception as e:
             logger.warning(f"⚠️ Не удалось получить inbound: {e}")
         
@@ -237,13 +136,8 @@ class V2RayService:
     async def _extract_reality_params_from_inbound(self, inbound: Dict, server_config: Dict):
         """Извлечение параметров Reality из inbound и добавление в server_config"""
         try:
-            stream_settings = inbound.get("streamSettings", {})
-            if isinstance(stream_settings, str):
-                try:
-                    stream_settings = json.loads(stream_settings)
-                except:
-                    logger.warning(f"⚠️ Не удалось распарсить streamSettings как JSON")
-                    stream_settings = {}
+            # Разбор streamSettings общий для снимка inbounds (выполняется один раз)
+            stream_settings = inbound_codec.field(inbound, "streamSettings")
             
             if stream_settings:
                 security = stream_settings.get("security", "")
@@ -301,11 +195,8 @@ class V2RayService:
         except Exception as e:
             logger.warning(f"⚠️ Ошибка при извлечении параметров Reality из inbound: {e}")
     
-    async def create_key(self, user_id: int, server_config: Dict) -> Dict:
-        """Создание ключа для пользователя"""
-        # Генерируем UUID для пользователя
-        user_uuid = str(uuid.uuid4())
-        
+    async def _resolve_protocol(self, server_config: Dict):
+        """Определение типа протокола и параметров Reality сервера (server_config дополняется на месте)"""
         # ВАЖНО: Если type не указан в server_config, определяем его автоматически
         # Если есть параметры Reality, то это VLESS
         if "type" not in server_config or not server_config.get("type"):
@@ -316,13 +207,13 @@ class V2RayService:
                 # ВАЖНО: Если security не установлен, но есть reality_pbk, нужно извлечь параметры из inbound
                 if not server_config.get("security") or server_config.get("security") != "reality":
                     logger.info(f"⚠️ security не установлен, извлекаем параметры Reality из inbound...")
-                    inbound = await self._get_inbound_cached()
+                    inbound = await self._get_inbound_cached(server_config=server_config)
                     if inbound:
                         await self._extract_reality_params_from_inbound(inbound, server_config)
             else:
                 # Пробуем определить из 3x-ui API
                 try:
-                    inbound = await self._get_inbound_cached()
+                    inbound = await self._get_inbound_cached(server_config=server_config)
                     if inbound and inbound.get("protocol"):
                         server_config["type"] = inbound.get("protocol").lower()
                         logger.info(f"✅ Автоматически определен тип протокола из 3x-ui: {server_config['type']}")
@@ -343,9 +234,44 @@ class V2RayService:
             if server_config.get("reality_pbk") or server_config.get("reality_sid"):
                 # Есть параметры Reality, но security не установлен - извлекаем из inbound
                 logger.info(f"⚠️ security не установлен, но есть параметры Reality, извлекаем из inbound...")
-                inbound = await self._get_inbound_cached()
+                inbound = await self._get_inbound_cached(server_config=server_config)
                 if inbound:
                     await self._extract_reality_params_from_inbound(inbound, server_config)
+    
+    @staticmethod
+    def _key_config_data(server_config: Dict, protocol_type: str) -> Dict:
+        """Параметры сервера для config_json ключа (по ним восстанавливается server_config)"""
+        return {
+            "type": protocol_type,
+            "network": server_config.get("network", "tcp"),
+            "path": server_config.get("path", ""),
+            "tls": server_config.get("tls", False),
+            "security": server_config.get("security", "none"),
+            "flow": server_config.get("flow", ""),
+            "sni": server_config.get("sni", server_config.get("address", "")),
+            "server_name": server_config.get("server_name", ""),  # Для Reality
+            "fingerprint": server_config.get("fingerprint", ""),  # Для Reality
+            "reality_pbk": server_config.get("reality_pbk", server_config.get("pbk", "")),  # Public Key для Reality
+            "reality_sid": server_config.get("reality_sid", server_config.get("sid", "")),  # Short ID для Reality
+            "spiderx": server_config.get("spiderx", "")  # Для Reality
+        }
+    
+    async def create_key(self, user_id: int, server_config: Dict) -> Dict:
+        """Создание ключа для пользователя
+        
+        Raises:
+            CircuitOpenError: панель 3x-ui недоступна - ключ не создается, чтобы не выдать нерабочий
+        """
+        vps_service = await self._get_vps_service()
+        if getattr(vps_service, 'use_x3ui', False):
+            panel = vps_service.panel_registry.for_server(server_config)
+            if not panel.is_available:
+                raise CircuitOpenError(f"3x-ui {panel.name}", panel.breaker.retry_after())
+        
+        # Генерируем UUID для пользователя
+        user_uuid = str(uuid.uuid4())
+        
+        await self._resolve_protocol(server_config)
         
         # ВАЖНО: Логируем параметры перед генерацией
         protocol_type = server_config.get("type", "vmess").lower()
@@ -389,20 +315,7 @@ class V2RayService:
             logger.info(f"   - key_string начинается с: {key_string[:20]}...")
             
             # Сохраняем полную конфигурацию сервера
-            config_data = {
-                "type": protocol_type,
-                "network": server_config.get("network", "tcp"),
-                "path": server_config.get("path", ""),
-                "tls": server_config.get("tls", False),
-                "security": server_config.get("security", "none"),
-                "flow": server_config.get("flow", ""),
-                "sni": server_config.get("sni", server_config.get("address", "")),
-                "server_name": server_config.get("server_name", ""),  # Для Reality
-                "fingerprint": server_config.get("fingerprint", ""),  # Для Reality
-                "reality_pbk": server_config.get("reality_pbk", server_config.get("pbk", "")),  # Public Key для Reality
-                "reality_sid": server_config.get("reality_sid", server_config.get("sid", "")),  # Short ID для Reality
-                "spiderx": server_config.get("spiderx", "")  # Для Reality
-            }
+            config_data = self._key_config_data(server_config, protocol_type)
             
             # ВАЖНО: Логируем перед сохранением
             logger.info(f"💾 Сохранение ключа в базу данных:")
@@ -441,7 +354,10 @@ class V2RayService:
                 # Используем уникальный email на основе UUID, чтобы избежать дубликатов
                 unique_email = f"user_{generated_uuid[:8]}"
                 # Передаем тип протокола и порт для правильного поиска inbound
-                success, config = await vps_service.add_user_to_v2ray(generated_uuid, unique_email, protocol_type, server_config.get("port", 443))
+                success, config = await vps_service.add_user_to_v2ray(
+                    generated_uuid, unique_email, protocol_type, server_config.get("port", 443),
+                    server_config=server_config
+                )
                 if success:
                     logger.info(f"✅ Пользователь {generated_uuid} автоматически добавлен на VPS")
                     if config:
@@ -470,6 +386,124 @@ class V2RayService:
                 "uuid": generated_uuid
             }
     
+    async def create_keys_bulk(
+        self,
+        user_ids: Iterable[int],
+        server_config: Dict,
+        progress: Optional[Callable[[int, int], Awaitable[None]]] = None
+    ) -> Dict:
+        """Массовое создание ключей на одном сервере (миграция узла, перевыпуск ключей)
+        
+        Параметры сервера разбираются один раз, все UUID и ссылки генерируются
+        за один проход, а клиенты добавляются на сервер пакетами по BULK_KEYS_BATCH_SIZE
+        (VPSService.apply_batch, один перезапуск на пакет). Ключи пакета записываются
+        в базу одной вставкой только для клиентов, которых сервер подтвердил: старые
+        ключи этих пользователей деактивируются в той же транзакции. Пользователи,
+        чьих клиентов добавить не удалось, остаются со старыми ключами.
+        
+        Args:
+            user_ids: пользователи (как в create_key); повторы игнорируются
+            progress: корутина progress(обработано, всего), вызывается после каждого пакета
+        
+        Returns:
+            dict: keys - выпущенные ключи {"user_id", "uuid", "key"}, failed - user_id,
+            которым ключ не выпущен (сервер не подтвердил клиента или ошибка базы), expires_at
+        
+        Raises:
+            CircuitOpenError: панель 3x-ui недоступна - ключи не создаются
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        vps_service = await self._get_vps_service()
+        if getattr(vps_service, 'use_x3ui', False):
+            panel = vps_service.panel_registry.for_server(server_config)
+            if not panel.is_available:
+                raise CircuitOpenError(f"3x-ui {panel.name}", panel.breaker.retry_after())
+        
+        await self._resolve_protocol(server_config)
+        protocol_type = server_config.get("type", "vmess").lower()
+        port = server_config.get("port", 443)
+        logger.info(
+            f"🔑 Массовое создание ключей: {len(user_ids)} пользователей, "
+            f"сервер {server_config.get('address')}:{port} ({protocol_type})"
+        )
+        
+        # Все ключи за один проход (для VLESS - подстановка UUID в шаблон сервера)
+        now = datetime.utcnow()
+        expires_at = now + timedelta(days=30)
+        config_json = json.dumps(self._key_config_data(server_config, protocol_type))
+        keys: List[Dict] = []
+        for user_id in user_ids:
+            key_string, generated_uuid = self.generator.generate_config(server_config)
+            keys.append({"user_id": user_id, "uuid": generated_uuid, "key": key_string})
+        
+        # Клиенты на сервер - пакетами (один перезапуск Xray на пакет), затем ключи подтвержденных в базу
+        issued: List[Dict] = []
+        failed: List[int] = []
+        batch_size = max(1, settings.BULK_KEYS_BATCH_SIZE)
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            operations = [("add", key["uuid"], f"user_{key['uuid'][:8]}") for key in batch]
+            try:
+                results = await vps_service.apply_batch(operations, protocol_type, port, server_config=server_config)
+            except Exception as e:
+                logger.error(f"Ошибка добавления пакета клиентов на сервер: {e}")
+                results = {}
+            confirmed = [key for key in batch if results.get(key["uuid"])]
+            failed.extend(key["user_id"] for key in batch if not results.get(key["uuid"]))
+            
+            if confirmed:
+                try:
+                    await self._store_bulk_keys(confirmed, server_config, protocol_type, config_json, now, expires_at)
+                    issued.extend(confirmed)
+                except Exception as e:
+                    # Клиенты уже на сервере, но ключей в базе нет - их уберет /cleanup
+                    logger.error(f"Ошибка записи пакета ключей в базу данных: {e}")
+                    failed.extend(key["user_id"] for key in confirmed)
+            if progress is not None:
+                await progress(i + len(batch), len(keys))
+        
+        if failed:
+            logger.warning(f"⚠️ Ключи не выпущены для {len(failed)} пользователей из {len(keys)} (старые ключи сохранены)")
+        logger.info(f"✅ Массовое создание ключей завершено: выпущено {len(issued)} из {len(keys)}")
+        return {"keys": issued, "failed": failed, "expires_at": expires_at}
+    
+    async def _store_bulk_keys(
+        self, keys: List[Dict], server_config: Dict, protocol_type: str, config_json: str,
+        now: datetime, expires_at: datetime
+    ):
+        """Замена ключей пользователей пакета одной транзакцией (деактивация старых и вставка новых)"""
+        user_ids = [key["user_id"] for key in keys]
+        async with self.db.session_maker() as session:
+            from sqlalchemy import insert, update
+            from app.database.models import V2RayKey
+            
+            # Деактивируем старые ключи (кусками: ограничение числа параметров SQL)
+            for i in range(0, len(user_ids), 500):
+                await session.execute(
+                    update(V2RayKey)
+                    .where(V2RayKey.user_id.in_(user_ids[i:i + 500]))
+                    .values(is_active=False)
+                )
+            
+            await session.execute(insert(V2RayKey), [
+                {
+                    "user_id": key["user_id"],
+                    "key_type": protocol_type,
+                    "uuid": key["uuid"],
+                    "server_address": server_config["address"],
+                    "server_port": server_config["port"],
+                    "config_json": config_json,
+                    "key_string": key["key"],
+                    "qr_code_url": None,
+                    "is_active": True,
+                    "created_at": now,
+                    "expires_at": expires_at,
+                    "last_used": now
+                }
+                for key in keys
+            ])
+            await session.commit()
+    
     async def get_active_key(self, user_id: int) -> Optional[Dict]:
         """Получение активного ключа пользователя"""
         async with self.db.session_maker() as session:
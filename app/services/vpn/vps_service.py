@@ -1,22 +1,103 @@
 import json
 import asyncio
+import hashlib
+import os
 import paramiko
+import re
+import shlex
 import sqlite3
-from typing import Optional, Dict
+import time
+from typing import Any, Callable, Iterable, List, Optional, Dict, Tuple
 from loguru import logger
 from config.settings import settings
+from app.services.vpn.inbound_codec import loads as json_loads, dumps as json_dumps
+from app.services.vpn.ssh_pool import SSHConnection, ssh_pool
+from app.services.vpn.restart_scheduler import restart_scheduler
+
+# Изменение клиентов в x-ui.db на самом VPS (python3 -c <скрипт> <путь к базе> <json>).
+# Транзакция BEGIN IMMEDIATE берет блокировку записи sqlite, поэтому изменение
+# не пересекается с записями самой панели; обновляются только измененные inbounds.
+# Добавление - в первый inbound по select (port, protocol), удаление - из всех inbounds.
+# Результат печатается одной строкой JSON: found, inbound_ids, added, removed, existing.
+REMOTE_DB_EDIT_SCRIPT = """
+import json, sqlite3, sys
+db_path, payload = sys.argv[1], json.loads(sys.stdin.read())
+add, remove = payload.get("add") or [], set(payload.get("remove") or [])
+select = payload.get("select")
+result = {"found": False, "inbound_ids": [], "added": [], "removed": [], "existing": []}
+conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+try:
+    conn.execute("BEGIN IMMEDIATE")
+    rows = []
+    if select:
+        rows = conn.execute("SELECT id, settings FROM inbounds WHERE port = ? AND protocol = ?",
+                            (select["port"], select["protocol"])).fetchmany(1)
+    target_id = rows[0][0] if rows else None
+    if remove or not select:
+        rows = conn.execute("SELECT id, settings FROM inbounds").fetchall()
+    result["found"] = target_id is not None if select else bool(rows)
+    for inbound_id, raw in rows:
+        try:
+            inbound_settings = json.loads(raw or "{}")
+        except ValueError:
+            continue
+        clients = [c for c in inbound_settings.get("clients") or [] if c]
+        kept = [c for c in clients if c.get("id") not in remove]
+        removed = [c.get("id") for c in clients if c.get("id") in remove]
+        ids = {c.get("id") for c in kept}
+        added = []
+        for client in add if inbound_id == target_id else []:
+            if client["id"] in ids:
+                result["existing"].append(client["id"])
+            else:
+                kept.append(client)
+                ids.add(client["id"])
+                added.append(client["id"])
+        if added or removed:
+            inbound_settings["clients"] = kept
+            conn.execute("UPDATE inbounds SET settings = ? WHERE id = ?", (json.dumps(inbound_settings), inbound_id))
+            result["inbound_ids"].append(inbound_id)
+            result["added"].extend(added)
+            result["removed"].extend(removed)
+    conn.execute("COMMIT")
+except BaseException:
+    if conn.in_transaction:
+        conn.execute("ROLLBACK")
+    raise
+finally:
+    conn.close()
+print(json.dumps(result))
+"""
 
 
 class VPSService:
     """Сервис для автоматического управления VPS через SSH или 3x-ui API"""
     
+    # Стандартные пути конфигурации Xray и базы данных 3x-ui (в порядке приоритета)
+    XRAY_CONFIG_PATHS = (
+        '/usr/local/x-ui/bin/config.json',
+        '/etc/x-ui/config.json',
+        '/opt/x-ui/config.json'
+    )
+    XUI_DB_PATHS = (
+        '/usr/local/x-ui/bin/x-ui.db',
+        '/etc/x-ui/x-ui.db',
+        '/usr/local/x-ui/x-ui.db'
+    )
+    
     def __init__(self):
         self.use_x3ui = getattr(settings, 'USE_X3UI_API', True)  # Используем API по умолчанию
         
         if self.use_x3ui:
-            # Используем 3x-ui API
-            from app.services.vpn import X3UIService
-            self.x3ui_service = X3UIService()
+            # Используем 3x-ui API (общий экземпляр с постоянной HTTP-сессией)
+            from app.services.vpn.x3ui_service import x3ui_service
+            from app.services.vpn.provisioning_queue import provisioning_queue
+            from app.services.vpn.panel_registry import panel_registry
+            self.x3ui_service = x3ui_service
+            # Изменения клиентов идут через очередь, объединяющую одновременные записи
+            self.provisioning_queue = provisioning_queue
+            # У каждого сервера из VPN_SERVERS может быть своя панель со своей очередью
+            self.panel_registry = panel_registry
             logger.info("Используется 3x-ui API для управления пользователями")
         else:
             # Используем SSH для работы с 3x-ui конфигурацией Xray
@@ -25,76 +106,438 @@ class VPSService:
             self.username = getattr(settings, 'VPS_USERNAME', 'root')
             self.password = getattr(settings, 'VPS_PASSWORD', '')
             self.ssh_key_path = getattr(settings, 'VPS_SSH_KEY_PATH', '')
-            # Путь будет определяться динамически через _get_xray_config_path
+            # Пути определяются динамически через _get_host_layout и кэшируются в подключении
+            # к хосту (SSHConnection.layout) - общем для всех экземпляров VPSService
             logger.info("Используется SSH для управления пользователями через 3x-ui конфигурацию")
     
-    def _get_ssh_client(self) -> Optional[paramiko.SSHClient]:
-        """Создание SSH подключения"""
+    async def _run_blocking(self, func: Callable, *args, timeout: float = None) -> Any:
+        """Выполнение блокирующей операции SSH/SFTP/sqlite в пуле потоков SSH с таймаутом"""
+        return await ssh_pool.run_blocking(func, *args, timeout=timeout)
+    
+    async def _get_ssh_client(self) -> Optional[SSHConnection]:
+        """Постоянное SSH подключение к VPS (переиспользуется между операциями)"""
+        connection = ssh_pool.get(
+            self.host,
+            self.port,
+            self.username,
+            password=self.password,
+            key_path=self.ssh_key_path
+        )
         try:
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            
-            # Подключение по ключу или паролю
-            if self.ssh_key_path:
-                client.connect(
-                    hostname=self.host,
-                    port=self.port,
-                    username=self.username,
-                    key_filename=self.ssh_key_path,
-                    timeout=10
-                )
-            elif self.password:
-                client.connect(
-                    hostname=self.host,
-                    port=self.port,
-                    username=self.username,
-                    password=self.password,
-                    timeout=10
-                )
-            else:
-                logger.error("Не указан пароль или SSH ключ для VPS")
-                return None
-            
-            return client
-            
+            # Подключаемся заранее, чтобы ошибка авторизации не возникла посреди операции
+            await self._run_blocking(connection.client)
+            return connection
+        except asyncio.TimeoutError:
+            logger.error("Таймаут подключения к VPS")
         except Exception as e:
             logger.error(f"Ошибка подключения к VPS: {e}")
-            return None
+        return None
     
-    async def _get_xray_config_path(self, client: paramiko.SSHClient) -> Optional[str]:
-        """Определяет путь к файлу конфигурации Xray, используемому 3x-ui"""
+    async def _exec(self, client: SSHConnection, command: str, stdin: str = None, idempotent: bool = False) -> Tuple[int, str, str]:
+        """Выполнение команды на VPS: (код завершения, stdout, stderr)
+        
+        idempotent=True - команда только читает, и при обрыве соединения ее можно повторить
+        """
+        return await self._run_blocking(client.exec, command, stdin, idempotent)
+    
+    @staticmethod
+    def _read_file_sync(sftp: paramiko.SFTPClient, path: str) -> str:
+        with sftp.open(path, 'r') as f:
+            return f.read().decode('utf-8')
+    
+    @staticmethod
+    def _write_file_sync(sftp: paramiko.SFTPClient, path: str, content: str):
+        with sftp.open(path, 'w') as f:
+            f.write(content.encode('utf-8'))
+    
+    async def _read_file(self, client: SSHConnection, path: str) -> str:
+        """Чтение файла на VPS через SFTP"""
+        return await self._run_blocking(client.with_sftp, lambda sftp: self._read_file_sync(sftp, path), True)
+    
+    async def _write_file(self, client: SSHConnection, path: str, content: str):
+        """Запись файла на VPS через SFTP"""
+        await self._run_blocking(client.with_sftp, lambda sftp: self._write_file_sync(sftp, path, content))
+    
+    @staticmethod
+    def _edit_remote_db_sync(
+        sftp: paramiko.SFTPClient,
+        db_path: str,
+        local_path: str,
+        edit: Callable[[sqlite3.Cursor], bool]
+    ) -> bool:
+        """Скачивание x-ui.db, изменение через edit(cursor) и загрузка обратно, если edit вернул True"""
         try:
-            # Проверяем стандартные пути
-            possible_paths = [
-                '/usr/local/x-ui/bin/config.json',
-                '/etc/x-ui/config.json',
-                '/opt/x-ui/config.json'
-            ]
-            for path in possible_paths:
-                stdin, stdout, stderr = client.exec_command(f"test -f {path} && echo 'found'")
-                if stdout.read().decode().strip() == 'found':
-                    logger.info(f"Найден файл конфигурации Xray: {path}")
-                    return path
-            
+            sftp.get(db_path, local_path)
+            conn = sqlite3.connect(local_path)
+            try:
+                changed = edit(conn.cursor())
+                if changed:
+                    conn.commit()
+            finally:
+                conn.close()
+            if changed:
+                sftp.put(local_path, db_path)
+            return changed
+        finally:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+    
+    async def _edit_remote_db(self, client: SSHConnection, db_path: str, local_path: str, edit: Callable[[sqlite3.Cursor], bool]) -> bool:
+        """Изменение базы данных 3x-ui на VPS (в пуле потоков)"""
+        return await self._run_blocking(
+            client.with_sftp,
+            lambda sftp: self._edit_remote_db_sync(sftp, db_path, local_path, edit)
+        )
+    
+    async def _remote_db_edit(
+        self,
+        client: SSHConnection,
+        db_path: str,
+        select: Optional[Dict],
+        add: Iterable[Dict] = (),
+        remove: Iterable[str] = ()
+    ) -> Optional[Dict]:
+        """Изменение клиентов в базе данных 3x-ui на самом VPS одной командой
+        
+        Args:
+            select: {"port", "protocol"} - первый подходящий inbound, None - все inbounds
+            add: клиенты для добавления (уже существующие UUID пропускаются)
+            remove: UUID клиентов для удаления
+        
+        Returns:
+            Результат скрипта (found, inbound_ids, added, removed, existing) или None,
+            если на VPS нет python3 либо режим отключен (нужно скачать базу данных)
+        """
+        if not settings.SSH_REMOTE_DB_EDIT:
+            return None
+        # Клиенты передаются через stdin: в аргументах команды большой пакет не поместится
+        payload = json_dumps({"select": select, "add": list(add), "remove": list(remove)})
+        command = " ".join(shlex.quote(part) for part in ("python3", "-c", REMOTE_DB_EDIT_SCRIPT, db_path))
+        code, out, err = await self._exec(client, command, stdin=payload)
+        if code == 127 or (code != 0 and "not found" in err and "python3" in err):
+            logger.warning("⚠️ На VPS нет python3, база данных 3x-ui будет изменена через скачивание")
+            return None
+        if code != 0:
+            raise RuntimeError(f"Ошибка изменения базы данных 3x-ui на VPS: {err.strip() or out.strip()}")
+        lines = out.strip().splitlines()
+        return json_loads(lines[-1]) if lines else None
+    
+    def _invalidate_layout(self, client: SSHConnection):
+        """Сброс закэшированных путей хоста (следующая операция определит их заново)"""
+        client.layout = None
+    
+    async def _get_host_layout(self, client: SSHConnection, refresh: bool = False) -> Dict[str, Optional[str]]:
+        """Пути к конфигурации Xray и базе данных 3x-ui на VPS
+        
+        Определяются одной командой (все test -f и поиск процесса Xray) и кэшируются
+        в подключении к хосту на SSH_LAYOUT_CACHE_TTL секунд. Если закэшированный путь перестал
+        работать, вызывающий код сбрасывает кэш через refresh=True.
+        """
+        cached = client.layout
+        if cached and not refresh and time.monotonic() - cached[0] < settings.SSH_LAYOUT_CACHE_TTL:
+            return cached[1]
+        
+        # Одна команда вместо отдельного test -f на каждый путь
+        checks = [f"test -f {path} && echo 'config {index}'" for index, path in enumerate(self.XRAY_CONFIG_PATHS)]
+        checks += [f"test -f {path} && echo 'db {index}'" for index, path in enumerate(self.XUI_DB_PATHS)]
+        checks.append("echo 'ps'; ps aux | grep xray | grep -v grep")
+        _, output, _ = await self._exec(client, "; ".join(checks), idempotent=True)
+        
+        config_indexes, db_indexes = [], []
+        lines = output.splitlines()
+        process_output = ""
+        for line_index, line in enumerate(lines):
+            parts = line.strip().split()
+            if parts == ["ps"]:
+                process_output = "\n".join(lines[line_index + 1:])
+                break
+            if len(parts) == 2 and parts[1].isdigit():
+                if parts[0] == "config":
+                    config_indexes.append(int(parts[1]))
+                elif parts[0] == "db":
+                    db_indexes.append(int(parts[1]))
+        
+        config_path = self.XRAY_CONFIG_PATHS[min(config_indexes)] if config_indexes else None
+        if config_path:
+            logger.info(f"Найден файл конфигурации Xray: {config_path}")
+        else:
             # Если не найдено, пытаемся найти через процесс Xray
-            stdin, stdout, stderr = client.exec_command("ps aux | grep xray | grep -v grep")
-            output = stdout.read().decode().strip()
-            import re
-            match = re.search(r'-c\s+(\S+)', output)
+            match = re.search(r'-c\s+(\S+)', process_output.strip())
             if match:
                 config_path = match.group(1)
                 logger.info(f"Найден файл конфигурации Xray через процесс: {config_path}")
-                return config_path
-            
-            logger.warning("Не удалось определить путь к файлу конфигурации Xray.")
-            return None
+            else:
+                logger.warning("Не удалось определить путь к файлу конфигурации Xray.")
+        
+        db_path = self.XUI_DB_PATHS[min(db_indexes)] if db_indexes else None
+        if db_path:
+            logger.info(f"📦 Найдена база данных 3x-ui: {db_path}")
+        
+        layout = {"config": config_path, "db": db_path}
+        # Неполный результат не кэшируем: файлы могут появиться после установки 3x-ui
+        client.layout = (time.monotonic(), layout) if config_path and db_path else None
+        return layout
+    
+    @staticmethod
+    def _edit_db_clients(cursor: sqlite3.Cursor, select: Optional[Dict], add: List[Dict], remove: List[str]) -> Dict:
+        """То же, что REMOTE_DB_EDIT_SCRIPT, на скачанной копии базы данных (если на VPS нет python3)"""
+        result = {"found": False, "inbound_ids": [], "added": [], "removed": [], "existing": []}
+        remove = set(remove)
+        rows = []
+        if select:
+            cursor.execute("SELECT id, settings FROM inbounds WHERE port = ? AND protocol = ?", (select["port"], select["protocol"]))
+            rows = cursor.fetchmany(1)
+        target_id = rows[0][0] if rows else None
+        if remove or not select:
+            cursor.execute("SELECT id, settings FROM inbounds")
+            rows = cursor.fetchall()
+        result["found"] = target_id is not None if select else bool(rows)
+        
+        for inbound_id, settings_json in rows:
+            inbound_settings = json_loads(settings_json or "{}")
+            clients = [c for c in inbound_settings.get("clients") or [] if c]
+            kept = [c for c in clients if c.get("id") not in remove]
+            removed = [c.get("id") for c in clients if c.get("id") in remove]
+            ids = {c.get("id") for c in kept}
+            added = []
+            for client in add if inbound_id == target_id else []:
+                if client["id"] in ids:
+                    result["existing"].append(client["id"])
+                else:
+                    kept.append(dict(client))
+                    ids.add(client["id"])
+                    added.append(client["id"])
+            if added or removed:
+                inbound_settings["clients"] = kept
+                cursor.execute("UPDATE inbounds SET settings = ? WHERE id = ?", (json_dumps(inbound_settings), inbound_id))
+                result["inbound_ids"].append(inbound_id)
+                result["added"].extend(added)
+                result["removed"].extend(removed)
+        return result
+    
+    async def _edit_db(
+        self,
+        client: SSHConnection,
+        db_path: str,
+        select: Optional[Dict],
+        add: List[Dict] = (),
+        remove: List[str] = (),
+        local_path: str = None
+    ) -> Dict:
+        """Изменение клиентов в базе данных 3x-ui: на VPS одной командой, а если там нет
+        python3 - на скачанной копии (с загрузкой обратно)
+        
+        Returns:
+            Результат (found, inbound_ids, added, removed, existing), см. REMOTE_DB_EDIT_SCRIPT
+        """
+        add, remove = list(add), list(remove)
+        result = await self._remote_db_edit(client, db_path, select, add=add, remove=remove)
+        if result is not None:
+            return result
+        
+        logger.info("⬇️ Скачиваем базу данных 3x-ui для изменения клиентов...")
+        state: Dict = {}
+        
+        def edit(cursor: sqlite3.Cursor) -> bool:
+            state.update(self._edit_db_clients(cursor, select, add, remove))
+            return bool(state["added"] or state["removed"])
+        
+        await self._edit_remote_db(client, db_path, local_path or f"/tmp/x-ui-{os.getpid()}.db", edit)
+        return state
+    
+    async def _remote_sha256(self, client: SSHConnection, path: str) -> Optional[str]:
+        """SHA-256 файла, посчитанный на VPS (None, если sha256sum недоступен)"""
+        code, output, _ = await self._exec(client, f"sha256sum {shlex.quote(path)}", idempotent=True)
+        parts = output.split()
+        return parts[0].lower() if code == 0 and parts else None
+    
+    async def _write_verified(self, client: SSHConnection, path: str, content: str) -> bool:
+        """Запись файла на VPS с проверкой контрольной суммы
+        
+        Returns:
+            True, если SHA-256 файла на VPS совпал с ожидаемым; False - файл нужно перечитать
+        """
+        await self._write_file(client, path, content)
+        expected = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        actual = await self._remote_sha256(client, path)
+        if actual == expected:
+            logger.info(f"✅ Контрольная сумма {path} совпадает ({expected[:12]})")
+            return True
+        logger.warning(f"⚠️ Контрольная сумма {path} не совпадает: ожидалась {expected[:12]}, на VPS {actual and actual[:12]}")
+        return False
+    
+    async def _file_has_client(
+        self, client: SSHConnection, path: str, uuid: str, inbound_index: Optional[int]
+    ) -> Tuple[Optional[bool], Dict]:
+        """Полное чтение конфигурации Xray и поиск клиента в inbound (если контрольная сумма не совпала)
+        
+        Returns:
+            tuple: (найден ли клиент - None, если inbound_index вне диапазона; конфигурация из файла)
+        """
+        config = json.loads(await self._read_file(client, path))
+        inbounds = config.get("inbounds") or []
+        if inbound_index is None or inbound_index >= len(inbounds):
+            logger.warning(f"⚠️ Не удалось проверить UUID {uuid} - inbound_index {inbound_index} вне диапазона")
+            return None, config
+        clients = (inbounds[inbound_index].get("settings") or {}).get("clients") or []
+        logger.info(f"Проверка: в файле {len(clients)} клиентов")
+        return uuid in [c.get("id") for c in clients if c], config
+    
+    async def _get_xray_config_path(self, client: SSHConnection, refresh: bool = False) -> Optional[str]:
+        """Определяет путь к файлу конфигурации Xray, используемому 3x-ui"""
+        try:
+            return (await self._get_host_layout(client, refresh)).get("config")
         except Exception as e:
             logger.error(f"Ошибка определения пути к конфигурации Xray: {e}")
             return None
     
-    async def add_user_to_v2ray(self, uuid: str, email: str = None, protocol_type: str = "vless", port: int = 443) -> tuple[bool, Optional[Dict]]:
+    @staticmethod
+    def _find_target_inbound(config: Dict, port: int, protocol_type: str) -> Tuple[Optional[int], Optional[Dict]]:
+        """Inbound конфигурации Xray для новых клиентов: (индекс, inbound) или (None, None)"""
+        # Находим нужный inbound по порту и протоколу
+        # Если указан индекс 5, используем его (для случаев, когда нужно использовать конкретный inbound)
+        target_inbound = None
+        inbound_index = None
+        
+        # Сначала пробуем найти по порту и протоколу
+        for i, inbound in enumerate(config.get("inbounds", [])):
+            if inbound.get("port") == port and inbound.get("protocol", "").lower() == protocol_type.lower():
+                target_inbound = inbound
+                inbound_index = i
+                logger.info(f"✅ Найден целевой inbound: индекс={i}, порт={port}, протокол={protocol_type}")
+                break
+        
+        # Если не найден, пробуем использовать индекс 5 (если он существует)
+        if not target_inbound and len(config.get("inbounds", [])) > 5:
+            inbound_index = 5
+            inbounds_list = config.get("inbounds", [])
+            if len(inbounds_list) > 5:
+                target_inbound = inbounds_list[5]
+                logger.info(f"✅ Используем inbound с индексом 5: порт={target_inbound.get('port')}, протокол={target_inbound.get('protocol')}")
+        
+        if not target_inbound:
+            logger.warning(f"⚠️ Не найден inbound с портом {port} и протоколом {protocol_type}")
+            # Пробуем найти первый inbound с нужным протоколом
+            for i, inbound in enumerate(config.get("inbounds", [])):
+                if inbound.get("protocol", "").lower() == protocol_type.lower():
+                    target_inbound = inbound
+                    inbound_index = i
+                    logger.warning(f"⚠️ Найден inbound с протоколом {protocol_type}, но порт {inbound.get('port')} отличается от {port}")
+                    break
+            
+            if not target_inbound:
+                logger.error(f"❌ Не найден inbound с протоколом {protocol_type}")
+                logger.error(f"Доступные протоколы: {[inb.get('protocol') for inb in config.get('inbounds', [])]}")
+                return None, None
+        
+        return inbound_index, target_inbound
+    
+    @staticmethod
+    def _build_xray_client(target_inbound: Dict, uuid: str, email: str, protocol_type: str) -> Dict:
+        """Клиент Xray для добавления в inbound (flow берется у существующих клиентов)"""
+        # Добавляем пользователя (VLESS не требует alterId)
+        if protocol_type.lower() == "vless":
+            new_client = {
+                "id": uuid,
+                "email": email
+            }
+            # Добавляем flow, если он указан в настройках
+            target_settings = target_inbound.get("settings") or {}
+            target_clients = target_settings.get("clients") or []
+            if target_clients and len(target_clients) > 0:
+                # Берем flow из первого клиента, если он есть
+                first_client = target_clients[0]
+                if first_client and first_client.get("flow"):
+                    new_client["flow"] = first_client.get("flow")
+        else:
+            # VMess требует alterId
+            new_client = {
+                "id": uuid,
+                "alterId": 0,
+                "email": email
+            }
+        return new_client
+    
+    @staticmethod
+    def _normalize_xray_config(config: Dict):
+        """DNS, outbound direct и правила routing, которые нужны конфигурации Xray"""
+        # Добавляем DNS настройки, если их нет
+        if "dns" not in config:
+            config["dns"] = {
+                "servers": [
+                    "8.8.8.8",
+                    "8.8.4.4",
+                    "1.1.1.1",
+                    {
+                        "address": "223.5.5.5",
+                        "domains": ["geosite:cn"]
+                    }
+                ],
+                "queryStrategy": "UseIP"
+            }
+        
+        # Улучшаем outbound с правильной стратегией DNS
+        if "outbounds" not in config or len(config["outbounds"]) == 0:
+            config["outbounds"] = []
+        
+        # Обновляем или создаем outbound
+        if len(config["outbounds"]) > 0:
+            config["outbounds"][0]["protocol"] = "freedom"
+            if "settings" not in config["outbounds"][0]:
+                config["outbounds"][0]["settings"] = {}
+            config["outbounds"][0]["settings"]["domainStrategy"] = "UseIPv4"
+            config["outbounds"][0]["tag"] = "direct"
+        else:
+            config["outbounds"].append({
+                "protocol": "freedom",
+                "settings": {
+                    "domainStrategy": "UseIPv4"
+                },
+                "tag": "direct"
+            })
+        
+        # Добавляем routing с правильными правилами
+        if "routing" not in config:
+            config["routing"] = {
+                "domainStrategy": "IPIfNonMatch",
+                "rules": [
+                    {
+                        "type": "field",
+                        "outboundTag": "direct",
+                        "network": "tcp,udp"
+                    }
+                ]
+            }
+        else:
+            # Обновляем существующий routing
+            config["routing"]["domainStrategy"] = "IPIfNonMatch"
+            if "rules" not in config["routing"]:
+                config["routing"]["rules"] = []
+            # Добавляем правило, если его нет
+            has_direct_rule = any(
+                rule.get("outboundTag") == "direct" 
+                for rule in config["routing"].get("rules", [])
+            )
+            if not has_direct_rule:
+                config["routing"]["rules"].append({
+                    "type": "field",
+                    "outboundTag": "direct",
+                    "network": "tcp,udp"
+                })
+    
+    async def add_user_to_v2ray(
+        self,
+        uuid: str,
+        email: str = None,
+        protocol_type: str = "vless",
+        port: int = 443,
+        server_config: Optional[Dict] = None
+    ) -> tuple[bool, Optional[Dict]]:
         """Добавление пользователя в конфигурацию V2Ray/Xray на VPS
         
+        Args:
+            server_config: сервер из VPN_SERVERS (определяет панель 3x-ui; по умолчанию - основная панель)
+        
         Returns:
             tuple: (success: bool, config: Optional[Dict]) - успех операции и полная конфигурация Xray
         """
@@ -103,14 +546,22 @@ class VPSService:
         
         # Используем 3x-ui API, если включено
         if self.use_x3ui:
-            success, config = await self.x3ui_service.add_client(uuid, email)
+            panel = self.panel_registry.for_server(server_config)
+            grpc_backend = self.panel_registry.grpc_for(panel)
+            if grpc_backend is not None:
+                # Без перезапуска Xray; при ошибке gRPC - обычное добавление через панель
+                success, config = await grpc_backend.add_client(uuid, email)
+                if success:
+                    return success, config
+                logger.warning(f"⚠️ gRPC API Xray не добавил {uuid}, добавляем через панель 3x-ui")
+            success, config = await self.panel_registry.queue_for(panel).add_client(uuid, email)
             if success and config:
                 logger.info(f"✅ Пользователь {uuid} добавлен через API, получена конфигурация Xray")
                 logger.debug(f"Конфигурация содержит {len(config.get('inbounds', []))} inbounds")
             return success, config
         
         # Иначе используем SSH (старый метод)
-        client = self._get_ssh_client()
+        client = await self._get_ssh_client()
         if not client:
             return False, None
         
@@ -122,13 +573,20 @@ class VPSService:
                 return False, None
             
             # Читаем текущую конфигурацию
-            sftp = client.open_sftp()
             try:
-                with sftp.open(config_path, 'r') as f:
-                    config_content = f.read().decode('utf-8')
+                config_content = await self._read_file(client, config_path)
             except FileNotFoundError:
-                logger.error(f"Файл конфигурации не найден: {config_path}")
-                return False, None
+                # Закэшированный путь устарел - определяем расположение файлов заново
+                logger.warning(f"Файл конфигурации не найден: {config_path}, ищем заново")
+                config_path = await self._get_xray_config_path(client, refresh=True)
+                if not config_path:
+                    logger.error("Не удалось найти файл конфигурации Xray")
+                    return False, None
+                try:
+                    config_content = await self._read_file(client, config_path)
+                except FileNotFoundError:
+                    logger.error(f"Файл конфигурации не найден: {config_path}")
+                    return False, None
             
             config = json.loads(config_content)
             
@@ -140,41 +598,9 @@ class VPSService:
                 clients = settings.get('clients') or []
                 logger.info(f"  Inbound {idx}: порт={inbound.get('port')}, протокол={inbound.get('protocol')}, клиентов={len(clients)}")
             
-            # Находим нужный inbound по порту и протоколу
-            # Если указан индекс 5, используем его (для случаев, когда нужно использовать конкретный inbound)
-            target_inbound = None
-            inbound_index = None
-            
-            # Сначала пробуем найти по порту и протоколу
-            for i, inbound in enumerate(config.get("inbounds", [])):
-                if inbound.get("port") == port and inbound.get("protocol", "").lower() == protocol_type.lower():
-                    target_inbound = inbound
-                    inbound_index = i
-                    logger.info(f"✅ Найден целевой inbound: индекс={i}, порт={port}, протокол={protocol_type}")
-                    break
-            
-            # Если не найден, пробуем использовать индекс 5 (если он существует)
-            if not target_inbound and len(config.get("inbounds", [])) > 5:
-                inbound_index = 5
-                inbounds_list = config.get("inbounds", [])
-                if len(inbounds_list) > 5:
-                    target_inbound = inbounds_list[5]
-                    logger.info(f"✅ Используем inbound с индексом 5: порт={target_inbound.get('port')}, протокол={target_inbound.get('protocol')}")
-            
-            if not target_inbound:
-                logger.warning(f"⚠️ Не найден inbound с портом {port} и протоколом {protocol_type}")
-                # Пробуем найти первый inbound с нужным протоколом
-                for i, inbound in enumerate(config.get("inbounds", [])):
-                    if inbound.get("protocol", "").lower() == protocol_type.lower():
-                        target_inbound = inbound
-                        inbound_index = i
-                        logger.warning(f"⚠️ Найден inbound с протоколом {protocol_type}, но порт {inbound.get('port')} отличается от {port}")
-                        break
-                
-                if not target_inbound:
-                    logger.error(f"❌ Не найден inbound с протоколом {protocol_type}")
-                    logger.error(f"Доступные протоколы: {[inb.get('protocol') for inb in config.get('inbounds', [])]}")
-                    return False, None
+            inbound_index, target_inbound = self._find_target_inbound(config, port, protocol_type)
+            if target_inbound is None:
+                return False, None
             
             # Получаем список клиентов из найденного inbound
             settings = target_inbound.get("settings") or {}
@@ -191,28 +617,7 @@ class VPSService:
                 logger.warning(f"Email {email} уже используется. Генерируем новый уникальный email.")
                 email = f"user_{uuid[:8]}"
             
-            # Добавляем пользователя (VLESS не требует alterId)
-            if protocol_type.lower() == "vless":
-                new_client = {
-                    "id": uuid,
-                    "email": email
-                }
-                # Добавляем flow, если он указан в настройках
-                target_settings = target_inbound.get("settings") or {}
-                target_clients = target_settings.get("clients") or []
-                if target_clients and len(target_clients) > 0:
-                    # Берем flow из первого клиента, если он есть
-                    first_client = target_clients[0]
-                    if first_client and first_client.get("flow"):
-                        new_client["flow"] = first_client.get("flow")
-            else:
-                # VMess требует alterId
-                new_client = {
-                    "id": uuid,
-                    "alterId": 0,
-                    "email": email
-                }
-            
+            new_client = self._build_xray_client(target_inbound, uuid, email, protocol_type)
             clients.append(new_client)
             logger.info(f"➕ Добавлен новый клиент: UUID={uuid}, email={email}, всего клиентов={len(clients)}")
             
@@ -220,397 +625,369 @@ class VPSService:
             config["inbounds"][inbound_index]["settings"]["clients"] = clients
             logger.info(f"💾 Конфигурация обновлена, готовимся к записи в {config_path}")
             
-            # Добавляем DNS настройки, если их нет
-            if "dns" not in config:
-                config["dns"] = {
-                    "servers": [
-                        "8.8.8.8",
-                        "8.8.4.4",
-                        "1.1.1.1",
-                        {
-                            "address": "223.5.5.5",
-                            "domains": ["geosite:cn"]
-                        }
-                    ],
-                    "queryStrategy": "UseIP"
-                }
-            
-            # Улучшаем outbound с правильной стратегией DNS
-            if "outbounds" not in config or len(config["outbounds"]) == 0:
-                config["outbounds"] = []
-            
-            # Обновляем или создаем outbound
-            if len(config["outbounds"]) > 0:
-                config["outbounds"][0]["protocol"] = "freedom"
-                if "settings" not in config["outbounds"][0]:
-                    config["outbounds"][0]["settings"] = {}
-                config["outbounds"][0]["settings"]["domainStrategy"] = "UseIPv4"
-                config["outbounds"][0]["tag"] = "direct"
-            else:
-                config["outbounds"].append({
-                    "protocol": "freedom",
-                    "settings": {
-                        "domainStrategy": "UseIPv4"
-                    },
-                    "tag": "direct"
-                })
-            
-            # Добавляем routing с правильными правилами
-            if "routing" not in config:
-                config["routing"] = {
-                    "domainStrategy": "IPIfNonMatch",
-                    "rules": [
-                        {
-                            "type": "field",
-                            "outboundTag": "direct",
-                            "network": "tcp,udp"
-                        }
-                    ]
-                }
-            else:
-                # Обновляем существующий routing
-                config["routing"]["domainStrategy"] = "IPIfNonMatch"
-                if "rules" not in config["routing"]:
-                    config["routing"]["rules"] = []
-                # Добавляем правило, если его нет
-                has_direct_rule = any(
-                    rule.get("outboundTag") == "direct" 
-                    for rule in config["routing"].get("rules", [])
-                )
-                if not has_direct_rule:
-                    config["routing"]["rules"].append({
-                        "type": "field",
-                        "outboundTag": "direct",
-                        "network": "tcp,udp"
-                    })
+            self._normalize_xray_config(config)
             
             new_config_content = json.dumps(config, indent=2)
             
             # Записываем обратно
             logger.info(f"📝 Записываем конфигурацию в {config_path}...")
-            with sftp.open(config_path, 'w') as f:
-                f.write(new_config_content.encode('utf-8'))
-            
-            # Проверяем, что файл записан
-            sftp.close()
-            logger.info(f"✅ Конфигурация записана в {config_path}")
-            
-            # Проверяем содержимое после записи (для отладки)
-            sftp = client.open_sftp()
-            with sftp.open(config_path, 'r') as f:
-                verify_content = f.read().decode('utf-8')
-                verify_config = json.loads(verify_content)
-                verify_inbounds = verify_config.get("inbounds") or []
-                if inbound_index is not None and inbound_index < len(verify_inbounds):
-                    verify_inbound = verify_inbounds[inbound_index]
-                    verify_settings = verify_inbound.get("settings") or {}
-                    verify_clients = verify_settings.get("clients") or []
-                    logger.info(f"✅ Проверка: в файле теперь {len(verify_clients)} клиентов")
-                    if uuid in [c.get("id") for c in verify_clients if c]:
-                        logger.info(f"✅ UUID {uuid} подтвержден в файле конфигурации")
-                    else:
-                        logger.error(f"❌ UUID {uuid} НЕ найден в файле после записи!")
-                else:
-                    logger.warning(f"⚠️ Не удалось проверить UUID {uuid} - inbound_index {inbound_index} вне диапазона")
-            sftp.close()
+            expected_hash = hashlib.sha256(new_config_content.encode('utf-8')).hexdigest()
+            if await self._write_verified(client, config_path, new_config_content):
+                logger.info(f"✅ UUID {uuid} записан в {config_path}")
+            elif not (await self._file_has_client(client, config_path, uuid, inbound_index))[0]:
+                logger.error(f"❌ UUID {uuid} НЕ найден в файле после записи!")
             
             # ВАЖНО: 3x-ui перезаписывает JSON из SQLite базы данных при перезапуске
             # Нужно также обновить SQLite базу данных 3x-ui
             logger.info("💾 Обновляем SQLite базу данных 3x-ui...")
-            db_paths = [
-                '/usr/local/x-ui/bin/x-ui.db',
-                '/etc/x-ui/x-ui.db',
-                '/usr/local/x-ui/x-ui.db'
-            ]
-            
             db_updated = False
-            for db_path in db_paths:
+            db_path = (await self._get_host_layout(client)).get("db")
+            if db_path:
                 try:
-                    stdin, stdout, stderr = client.exec_command(f"test -f {db_path} && echo 'found'")
-                    if stdout.read().decode().strip() == 'found':
-                        logger.info(f"📦 Найдена база данных 3x-ui: {db_path}")
-                        # Скачиваем базу данных, обновляем и загружаем обратно
-                        sftp = client.open_sftp()
-                        try:
-                            # Скачиваем базу данных
-                            local_db = f"/tmp/x-ui-{uuid[:8]}.db"
-                            sftp.get(db_path, local_db)
-                            
-                            # Обновляем базу данных локально
-                            conn = sqlite3.connect(local_db)
-                            cursor = conn.cursor()
-                            
-                            # Находим inbound по порту и протоколу в базе данных
-                            cursor.execute("SELECT id, settings FROM inbounds WHERE port = ? AND protocol = ?", (port, protocol_type))
-                            inbound_row = cursor.fetchone()
-                            
-                            if inbound_row:
-                                inbound_id, inbound_settings_json = inbound_row
-                                inbound_settings = json.loads(inbound_settings_json)
-                                clients = inbound_settings.get("clients", [])
-                                
-                                # Проверяем, нет ли уже такого UUID
-                                if not any(c.get("id") == uuid for c in clients if c):
-                                    # Добавляем клиента
-                                    new_client = {"id": uuid, "email": email}
-                                    target_settings = target_inbound.get("settings") or {}
-                                    target_clients = target_settings.get("clients") or []
-                                    if protocol_type.lower() == "vless" and target_clients and len(target_clients) > 0:
-                                        first_client = target_clients[0]
-                                        if first_client and first_client.get("flow"):
-                                            new_client["flow"] = first_client.get("flow")
-                                    elif protocol_type.lower() == "vmess":
-                                        new_client["alterId"] = 0
-                                    
-                                    clients.append(new_client)
-                                    inbound_settings["clients"] = clients
-                                    
-                                    # Обновляем базу данных
-                                    cursor.execute("UPDATE inbounds SET settings = ? WHERE id = ?", 
-                                                 (json.dumps(inbound_settings), inbound_id))
-                                    conn.commit()
-                                    logger.info(f"✅ Клиент добавлен в SQLite базу данных (inbound_id={inbound_id})")
-                                    db_updated = True
-                                else:
-                                    logger.info(f"✅ Клиент уже существует в SQLite базе данных")
-                                    db_updated = True
-                            else:
-                                logger.warning(f"⚠️ Inbound не найден в SQLite базе данных")
-                            
-                            conn.close()
-                            
-                            # Загружаем обновленную базу данных обратно
-                            if db_updated:
-                                sftp.put(local_db, db_path)
-                                logger.info(f"✅ SQLite база данных обновлена")
-                            
-                            sftp.close()
-                            break
-                        except Exception as e:
-                            logger.error(f"Ошибка обновления SQLite базы данных: {e}")
-                            sftp.close()
+                    # Изменение на сервере одной командой; если на VPS нет python3 -
+                    # скачиваем базу данных, обновляем и загружаем обратно
+                    result = await self._edit_db(
+                        client, db_path, {"port": port, "protocol": protocol_type}, add=[dict(new_client)],
+                        local_path=f"/tmp/x-ui-{uuid[:8]}.db"
+                    )
+                    
+                    if result["added"]:
+                        logger.info(f"✅ Клиент добавлен в SQLite базу данных (inbound_id={(result['inbound_ids'] or [None])[0]})")
+                        logger.info(f"✅ SQLite база данных обновлена")
+                        db_updated = True
+                    elif result["found"]:
+                        logger.info(f"✅ Клиент уже существует в SQLite базе данных")
+                        db_updated = True
+                    else:
+                        logger.warning(f"⚠️ Inbound не найден в SQLite базе данных")
                 except Exception as e:
-                    continue
-            
-            if not db_updated:
-                logger.warning("⚠️ Не удалось обновить SQLite базу данных 3x-ui. Пользователь добавлен только в JSON файл.")
-            
-            # Перезапускаем Xray через 3x-ui
-            logger.info("🔄 Перезапускаем x-ui...")
-            stdin, stdout, stderr = client.exec_command('systemctl restart x-ui')
-            exit_status = stdout.channel.recv_exit_status()
-            error_output = stderr.read().decode('utf-8')
-            stdout_output = stdout.read().decode('utf-8')
+                    logger.error(f"Ошибка обновления SQLite базы данных: {e}")
+                    # Путь мог устареть - при следующей операции пути определятся заново
+                    self._invalidate_layout(client)
+            
+            if db_updated:
+                # x-ui берет клиентов из базы данных при перезапуске, поэтому перезапуск
+                # откладывается и объединяется с соседними изменениями этого VPS
+                self.schedule_restart(client)
+                logger.info(f"✅ Пользователь {uuid} добавлен на VPS, перезапуск x-ui запланирован")
+                return True, config
             
-            if exit_status == 0:
-                logger.info(f"✅ x-ui перезапущен успешно")
-                # Ждем немного, чтобы x-ui успел перезагрузить конфигурацию
-                await asyncio.sleep(3)
-                
-                # Проверяем статус x-ui
-                stdin, stdout, stderr = client.exec_command('systemctl is-active x-ui')
-                status = stdout.read().decode('utf-8').strip()
-                if status == 'active':
-                    logger.info(f"✅ x-ui активен после перезапуска")
-                else:
-                    logger.warning(f"⚠️ x-ui статус после перезапуска: {status}")
-                
-                # Проверяем, что пользователь все еще в конфигурации
-                sftp = client.open_sftp()
-                with sftp.open(config_path, 'r') as f:
-                    final_content = f.read().decode('utf-8')
-                    final_config = json.loads(final_content)
-                    final_inbounds = final_config.get("inbounds") or []
-                    if inbound_index is not None and inbound_index < len(final_inbounds):
-                        final_inbound = final_inbounds[inbound_index]
-                        final_settings = final_inbound.get("settings") or {}
-                        final_clients = final_settings.get("clients") or []
-                        if uuid in [c.get("id") for c in final_clients if c]:
-                            logger.info(f"✅ Пользователь {uuid} успешно добавлен на VPS и x-ui перезапущен")
-                            sftp.close()
-                            return True, final_config
-                        else:
-                            # UUID не найден в клиентах, но inbound существует
-                            if db_updated:
-                                logger.warning(f"⚠️ Пользователь {uuid} исчез из JSON, но добавлен в SQLite базу данных")
-                                logger.info("✅ Пользователь должен появиться после следующего перезапуска x-ui")
-                                sftp.close()
-                                return True, final_config
-                            else:
-                                logger.error(f"❌ Пользователь {uuid} исчез из конфигурации после перезапуска x-ui!")
-                                logger.error("⚠️ Возможно, 3x-ui перезаписывает конфигурацию. Проверьте настройки 3x-ui.")
-                                sftp.close()
-                                return False, None
-                    else:
-                        # inbound_index вне диапазона
-                        if db_updated:
-                            logger.warning(f"⚠️ Не удалось проверить пользователя {uuid}, но он добавлен в SQLite базу данных")
-                            logger.info("✅ Пользователь должен появиться после следующего перезапуска x-ui")
-                            sftp.close()
-                            return True, final_config
-                        else:
-                            logger.error(f"❌ Не удалось проверить пользователя {uuid} и он не добавлен в SQLite базу данных")
-                            sftp.close()
-                            return False, None
-            else:
-                logger.error(f"❌ Ошибка перезапуска x-ui: exit_status={exit_status}")
-                logger.error(f"stderr: {error_output}")
-                logger.error(f"stdout: {stdout_output}")
-                
-                # Пробуем альтернативные методы перезапуска
-                logger.info("🔄 Пробуем альтернативный метод перезапуска...")
-                stdin, stdout, stderr = client.exec_command('x-ui restart 2>&1 || systemctl restart xray 2>&1')
-                exit_status2 = stdout.channel.recv_exit_status()
-                if exit_status2 == 0:
-                    logger.info(f"✅ x-ui/xray перезапущен альтернативным методом")
-                    await asyncio.sleep(2)
-                    # Читаем финальную конфигурацию
-                    sftp = client.open_sftp()
-                    with sftp.open(config_path, 'r') as f:
-                        final_config = json.loads(f.read().decode('utf-8'))
-                    sftp.close()
-                    return True, final_config
-                else:
-                    logger.error(f"❌ Не удалось перезапустить x-ui/xray. Пользователь добавлен, но требуется ручной перезапуск.")
-                    logger.error("⚠️ Выполните вручную: systemctl restart x-ui")
-                    # Читаем конфигурацию, даже если перезапуск не удался
-                    sftp = client.open_sftp()
-                    with sftp.open(config_path, 'r') as f:
-                        final_config = json.loads(f.read().decode('utf-8'))
-                    sftp.close()
-                    return True, final_config  # Возвращаем True, так как пользователь добавлен в файл
+            logger.warning("⚠️ Не удалось обновить SQLite базу данных 3x-ui. Пользователь добавлен только в JSON файл.")
+            # Без базы данных нужно убедиться, что клиент пережил перезапуск - перезапускаем сразу
+            # (вместе с уже запланированными изменениями этого VPS)
+            if not await restart_scheduler.run_now(*self._restart_target(client)):
+                logger.error(f"❌ Не удалось перезапустить x-ui/xray. Пользователь добавлен, но требуется ручной перезапуск.")
+                logger.error("⚠️ Выполните вручную: systemctl restart x-ui")
+                return True, config  # Возвращаем True, так как пользователь добавлен в файл
+            
+            # Проверяем, что пользователь все еще в конфигурации: если файл не менялся
+            # после записи, достаточно контрольной суммы
+            if await self._remote_sha256(client, config_path) == expected_hash:
+                logger.info(f"✅ Пользователь {uuid} успешно добавлен на VPS и x-ui перезапущен")
+                return True, config
+            present, final_config = await self._file_has_client(client, config_path, uuid, inbound_index)
+            if present:
+                logger.info(f"✅ Пользователь {uuid} успешно добавлен на VPS и x-ui перезапущен")
+                return True, final_config
+            if present is False:
+                logger.error(f"❌ Пользователь {uuid} исчез из конфигурации после перезапуска x-ui!")
+                logger.error("⚠️ Возможно, 3x-ui перезаписывает конфигурацию. Проверьте настройки 3x-ui.")
+                return False, None
             
+            logger.error(f"❌ Не удалось проверить пользователя {uuid} и он не добавлен в SQLite базу данных")
+            return False, None
+        
         except Exception as e:
             logger.error(f"Ошибка добавления пользователя на VPS: {e}")
             return False, None
-        finally:
-            client.close()
     
-    async def remove_user_from_v2ray(self, uuid: str) -> bool:
-        """Удаление пользователя из конфигурации V2Ray/Xray через SQLite 3x-ui"""
+    async def _remove_from_panel(self, panel, uuid: str) -> bool:
+        """Удаление клиента с панели: через gRPC API Xray, если он настроен, иначе через очередь"""
+        grpc_backend = self.panel_registry.grpc_for(panel)
+        if grpc_backend is not None:
+            if await grpc_backend.remove_client(uuid):
+                return True
+            logger.warning(f"⚠️ gRPC API Xray не удалил {uuid}, удаляем через панель 3x-ui")
+        return await self.panel_registry.queue_for(panel).remove_client(uuid)
+    
+    async def remove_user_from_v2ray(self, uuid: str, server_config: Optional[Dict] = None) -> bool:
+        """Удаление пользователя из конфигурации V2Ray/Xray через SQLite 3x-ui
+        
+        Args:
+            server_config: сервер из VPN_SERVERS; если не указан, клиент удаляется на всех панелях
+        """
+        # Используем 3x-ui API, если включено
         if self.use_x3ui:
-            logger.error("3x-ui API не работает, используем SSH для управления конфигурацией.")
-            self.use_x3ui = False
+            if server_config:
+                return await self._remove_from_panel(self.panel_registry.for_server(server_config), uuid)
+            
+            results = await self.panel_registry.fan_out(lambda panel: self._remove_from_panel(panel, uuid))
+            # Отсутствие клиента на панели считается успешным удалением
+            return all(result is True for result in results.values())
         
-        client = self._get_ssh_client()
+        client = await self._get_ssh_client()
         if not client:
             return False
         
         try:
-            # Находим базу данных 3x-ui
-            xui_db_paths = [
-                '/usr/local/x-ui/bin/x-ui.db',
-                '/etc/x-ui/x-ui.db',
-                '/usr/local/x-ui/x-ui.db'
-            ]
-            
-            xui_db_path = None
-            for path in xui_db_paths:
-                stdin, stdout, stderr = client.exec_command(f"test -f {path} && echo 'found'")
-                if stdout.read().decode().strip() == 'found':
-                    xui_db_path = path
-                    logger.info(f"📦 Найдена база данных 3x-ui: {xui_db_path}")
-                    break
+            # Находим базу данных 3x-ui (путь кэшируется для хоста)
+            xui_db_path = (await self._get_host_layout(client)).get("db")
             
             if not xui_db_path:
                 logger.error("Не удалось найти файл базы данных 3x-ui.")
                 return False
             
-            # Скачиваем базу данных
-            local_db_path = f"/tmp/x-ui_remove_{uuid[:8]}.db"
-            sftp = client.open_sftp()
-            logger.info(f"⬇️ Скачиваем базу данных 3x-ui для удаления пользователя {uuid}...")
-            sftp.get(xui_db_path, local_db_path)
-            logger.info("✅ База данных успешно скачана.")
-            
-            # Обновляем базу данных локально
-            conn = sqlite3.connect(local_db_path)
-            cursor = conn.cursor()
-            
-            # Находим и удаляем пользователя из всех inbounds
-            cursor.execute("SELECT id, settings FROM inbounds")
-            inbounds_data = cursor.fetchall()
-            
-            removed = False
-            for inbound_id, settings_json in inbounds_data:
-                settings = json.loads(settings_json)
-                clients = settings.get("clients", [])
-                initial_clients_count = len(clients)
-                
-                # Удаляем клиента с указанным UUID
-                settings["clients"] = [c for c in clients if c.get("id") != uuid]
-                
-                if len(settings["clients"]) < initial_clients_count:
-                    updated_settings_json = json.dumps(settings)
-                    cursor.execute("UPDATE inbounds SET settings = ? WHERE id = ?", (updated_settings_json, inbound_id))
-                    removed = True
-                    logger.info(f"✅ Пользователь {uuid} удален из inbound {inbound_id} в локальной базе данных.")
+            # Удаляем клиента на сервере одной командой; если на VPS нет python3 -
+            # скачиваем базу данных, удаляем клиента и загружаем обратно
+            try:
+                result = await self._edit_db(
+                    client, xui_db_path, None, remove=[uuid], local_path=f"/tmp/x-ui_remove_{uuid[:8]}.db"
+                )
+                removed = bool(result["removed"])
+                for inbound_id in result["inbound_ids"] if removed else []:
+                    logger.info(f"✅ Пользователь {uuid} удален из inbound {inbound_id} в базе данных.")
+            except Exception:
+                # Путь мог устареть - при следующей операции пути определятся заново
+                self._invalidate_layout(client)
+                raise
             
             if not removed:
                 logger.warning(f"Пользователь {uuid} не найден в базе данных 3x-ui. Удаление не требуется.")
-                conn.close()
-                sftp.close()
-                client.close()
                 return True
             
-            conn.commit()
-            conn.close()
+            logger.info("✅ База данных 3x-ui на VPS обновлена.")
             
-            # Загружаем обновленную базу данных обратно
-            logger.info(f"⬆️ Загружаем обновленную базу данных после удаления пользователя {uuid}...")
-            sftp.put(local_db_path, xui_db_path)
-            logger.info("✅ База данных успешно загружена на VPS.")
-            
-            sftp.close()
-            
-            # Перезапускаем x-ui
-            if await self.restart_xray_service(client):
-                logger.info(f"✅ Пользователь {uuid} успешно удален из Xray и сервис перезапущен.")
-                client.close()
-                return True
-            else:
-                logger.error(f"Ошибка перезапуска Xray после удаления пользователя {uuid}.")
-                client.close()
-                return False
-                
+            # Перезапуск x-ui откладывается и объединяется с соседними изменениями
+            self.schedule_restart(client)
+            logger.info(f"✅ Пользователь {uuid} удален из базы данных 3x-ui, перезапуск x-ui запланирован.")
+            return True
+        
         except Exception as e:
             logger.error(f"Ошибка удаления пользователя с VPS через SQLite: {e}")
             return False
-        finally:
-            if 'sftp' in locals():
-                sftp.close()
-            if 'client' in locals():
-                client.close()
-            # Удаляем временный файл
-            import os
-            if 'local_db_path' in locals() and os.path.exists(local_db_path):
-                os.remove(local_db_path)
-    
-    async def restart_xray_service(self, client: paramiko.SSHClient) -> bool:
+    
+    async def apply_batch(
+        self,
+        operations: List[Tuple[str, str, Optional[str]]],
+        protocol_type: str = "vless",
+        port: int = 443,
+        server_config: Optional[Dict] = None
+    ) -> Dict[str, bool]:
+        """Пакетное применение изменений клиентов с одним перезапуском Xray
+        
+        Для миграций и массового истечения подписок: вместо N циклов
+        чтение-запись-перезапуск конфигурация читается и записывается один раз,
+        база данных 3x-ui меняется одной командой, x-ui перезапускается не более одного раза.
+        Для каждого UUID применяется последняя операция пакета.
+        
+        Args:
+            operations: список ("add" | "remove", uuid, email); email для удаления не нужен
+            server_config: сервер из VPN_SERVERS (для 3x-ui API); без него удаление идет на всех панелях
+        
+        Returns:
+            dict: uuid -> успех записи изменения. Ошибка перезапуска x-ui на результат
+                не влияет (записанное не откатывается): о ней уведомляются админы
+        """
+        final: Dict[str, Tuple[str, Optional[str]]] = {}
+        for action, uuid, email in operations:
+            if action not in ("add", "remove"):
+                raise ValueError(f"Неизвестная операция: {action}")
+            # Порядок первого появления сохраняется, действие - последнее
+            final[uuid] = (action, email)
+        adds = [(uuid, email or f"user_{uuid[:8]}") for uuid, (action, email) in final.items() if action == "add"]
+        removes = [uuid for uuid, (action, _) in final.items() if action == "remove"]
+        if not final:
+            return {}
+        logger.info(f"📦 Пакет изменений клиентов: добавить {len(adds)}, удалить {len(removes)}")
+        
+        if self.use_x3ui:
+            results: Dict[str, bool] = {}
+            panel = self.panel_registry.for_server(server_config)
+            if adds:
+                added = await panel.add_clients(adds)
+                results.update({uuid: added.get(uuid, (False, None))[0] for uuid, _ in adds})
+            if removes:
+                if server_config:
+                    results.update(await panel.remove_clients(removes))
+                else:
+                    per_panel = await self.panel_registry.fan_out(lambda panel: panel.remove_clients(removes))
+                    for uuid in removes:
+                        results[uuid] = all(
+                            isinstance(result, dict) and result.get(uuid) is True for result in per_panel.values()
+                        )
+            return results
+        
+        client = await self._get_ssh_client()
+        if not client:
+            return {uuid: False for uuid in final}
+        
+        try:
+            return await self._apply_batch_ssh(client, adds, removes, protocol_type, port)
+        except Exception as e:
+            logger.error(f"Ошибка пакетного изменения клиентов на VPS: {e}")
+            return {uuid: False for uuid in final}
+    
+    async def _apply_batch_ssh(
+        self,
+        client: SSHConnection,
+        adds: List[Tuple[str, str]],
+        removes: List[str],
+        protocol_type: str,
+        port: int
+    ) -> Dict[str, bool]:
+        """Пакет изменений через SSH: одно чтение-запись config.json, одна команда SQLite, один перезапуск"""
+        results: Dict[str, bool] = {}
+        
+        config_path = await self._get_xray_config_path(client)
+        if not config_path:
+            logger.error("Не удалось найти файл конфигурации Xray")
+            return {uuid: False for uuid in [uuid for uuid, _ in adds] + removes}
+        try:
+            config_content = await self._read_file(client, config_path)
+        except FileNotFoundError:
+            # Закэшированный путь устарел - определяем расположение файлов заново
+            config_path = await self._get_xray_config_path(client, refresh=True)
+            if not config_path:
+                logger.error("Не удалось найти файл конфигурации Xray")
+                return {uuid: False for uuid in [uuid for uuid, _ in adds] + removes}
+            config_content = await self._read_file(client, config_path)
+        config = json.loads(config_content)
+        
+        # Удаление - из всех inbounds
+        remove_set = set(removes)
+        config_changed = False
+        for inbound in config.get("inbounds") or []:
+            inbound_settings = inbound.get("settings") or {}
+            clients = inbound_settings.get("clients") or []
+            kept = [c for c in clients if c and c.get("id") not in remove_set]
+            if len(kept) != len([c for c in clients if c]):
+                inbound_settings["clients"] = kept
+                config_changed = True
+        
+        # Добавление - в inbound по порту и протоколу
+        new_clients = []
+        if adds:
+            inbound_index, target_inbound = self._find_target_inbound(config, port, protocol_type)
+            if target_inbound is None:
+                results.update({uuid: False for uuid, _ in adds})
+            else:
+                target_settings = target_inbound.setdefault("settings", {})
+                clients = target_settings.get("clients") or []
+                existing_uuids = {c.get("id") for c in clients if c and c.get("id")}
+                existing_emails = {c.get("email") for c in clients if c and c.get("email")}
+                for uuid, email in adds:
+                    if uuid in existing_uuids:
+                        logger.info(f"Пользователь {uuid} уже существует на VPS")
+                        results[uuid] = True
+                        continue
+                    if email in existing_emails:
+                        logger.warning(f"Email {email} уже используется. Генерируем новый уникальный email.")
+                        email = f"user_{uuid[:8]}"
+                    new_client = self._build_xray_client(target_inbound, uuid, email, protocol_type)
+                    clients.append(new_client)
+                    new_clients.append(new_client)
+                    existing_uuids.add(uuid)
+                    existing_emails.add(new_client["email"])
+                target_settings["clients"] = clients
+        
+        if new_clients or config_changed:
+            self._normalize_xray_config(config)
+            new_config_content = json.dumps(config, indent=2)
+            logger.info(f"📝 Записываем конфигурацию в {config_path} (+{len(new_clients)}, -{len(removes)})...")
+            if await self._write_verified(client, config_path, new_config_content):
+                written = {c["id"] for c in new_clients}
+            else:
+                # Контрольная сумма не совпала - проверяем клиентов по содержимому файла
+                verify_config = json.loads(await self._read_file(client, config_path))
+                written = {
+                    c.get("id")
+                    for inbound in verify_config.get("inbounds") or []
+                    for c in (inbound.get("settings") or {}).get("clients") or [] if c
+                }
+            for new_client in new_clients:
+                results[new_client["id"]] = new_client["id"] in written
+                if not results[new_client["id"]]:
+                    logger.error(f"❌ UUID {new_client['id']} НЕ найден в файле после записи!")
+        
+        # База данных 3x-ui: все изменения одной командой
+        db_changed = False
+        db_ok = True
+        db_path = (await self._get_host_layout(client)).get("db")
+        if db_path:
+            select = {"port": port, "protocol": protocol_type} if new_clients else None
+            db_clients = [dict(c) for c in new_clients]
+            try:
+                db_result = await self._edit_db(
+                    client, db_path, select, add=db_clients, remove=removes,
+                    local_path=f"/tmp/x-ui-batch-{os.getpid()}.db"
+                )
+                db_changed = bool(db_result["added"] or db_result["removed"])
+                logger.info(f"✅ SQLite база данных обновлена: добавлено {len(db_result['added'])}, удалено {len(db_result['removed'])}")
+            except Exception as e:
+                logger.error(f"Ошибка обновления SQLite базы данных: {e}")
+                # Путь мог устареть - при следующей операции пути определятся заново
+                self._invalidate_layout(client)
+                db_ok = False
+        elif removes:
+            logger.error("Не удалось найти файл базы данных 3x-ui.")
+            db_ok = False
+        else:
+            logger.warning("⚠️ Не удалось обновить SQLite базу данных 3x-ui. Пользователи добавлены только в JSON файл.")
+        
+        # Удаление применяется через базу данных (x-ui пересобирает из нее config.json)
+        results.update({uuid: db_ok for uuid in removes})
+        
+        if new_clients or config_changed or db_changed:
+            logger.info(f"🔄 Перезапускаем x-ui один раз для пакета из {len(adds) + len(removes)} изменений...")
+            if not await restart_scheduler.run_now(*self._restart_target(client)):
+                # Изменения уже записаны в config.json и базу данных и применятся при следующем
+                # перезапуске; об ошибке перезапуска RestartScheduler уведомляет админов
+                logger.error(
+                    f"❌ x-ui не перезапущен после пакета: {len(results)} изменений клиентов записаны, "
+                    f"но применятся только после перезапуска"
+                )
+        return results
+    
+    def _restart_target(self, client: SSHConnection) -> Tuple[str, Callable[[], Any], str]:
+        """Узел, корутина перезапуска и имя VPS для RestartScheduler"""
+        return f"ssh {client!r}", lambda: self.restart_xray_service(client), f"VPS {client.host}"
+    
+    def schedule_restart(self, client: SSHConnection) -> asyncio.Future:
+        """Запланировать перезапуск x-ui на VPS (см. RestartScheduler)"""
+        return restart_scheduler.request(*self._restart_target(client))
+    
+    async def restart_xray_service(self, client: SSHConnection) -> bool:
         """Перезапускает сервис x-ui на сервере."""
         try:
-            stdin, stdout, stderr = client.exec_command('systemctl restart x-ui')
-            exit_status = stdout.channel.recv_exit_status()
-            error_output = stderr.read().decode('utf-8')
-            stdout_output = stdout.read().decode('utf-8')
+            exit_status, stdout_output, error_output = await self._exec(client, 'systemctl restart x-ui')
             
-            if exit_status == 0:
-                logger.info("✅ Сервис x-ui успешно перезапущен.")
-                # Ждем немного, чтобы x-ui успел перезагрузить конфигурацию
-                await asyncio.sleep(3)
+            if exit_status != 0:
+                logger.error(f"❌ Ошибка перезапуска x-ui: exit_status={exit_status}")
+                logger.error(f"stderr: {error_output}")
+                logger.error(f"stdout: {stdout_output}")
                 
-                # Проверяем статус x-ui
-                stdin, stdout, stderr = client.exec_command('systemctl is-active x-ui')
-                status = stdout.read().decode('utf-8').strip()
-                if status == 'active':
-                    logger.info("✅ x-ui активен после перезапуска")
+                # Пробуем альтернативные методы перезапуска
+                logger.info("🔄 Пробуем альтернативный метод перезапуска...")
+                exit_status, _, _ = await self._exec(client, 'x-ui restart 2>&1 || systemctl restart xray 2>&1')
+                if exit_status == 0:
+                    logger.info(f"✅ x-ui/xray перезапущен альтернативным методом")
+                    await asyncio.sleep(2)
                     return True
-                else:
-                    logger.warning(f"⚠️ x-ui статус после перезапуска: {status}")
-                    return True  # Возвращаем True, так как перезапуск выполнен
-            else:
                 logger.error(f"Ошибка перезапуска сервиса x-ui: {error_output}")
                 return False
+            
+            logger.info("✅ Сервис x-ui успешно перезапущен.")
+            # Ждем немного, чтобы x-ui успел перезагрузить конфигурацию
+            await asyncio.sleep(3)
+            
+            # Проверяем статус x-ui
+            _, status, _ = await self._exec(client, 'systemctl is-active x-ui', idempotent=True)
+            status = status.strip()
+            if status == 'active':
+                logger.info("✅ x-ui активен после перезапуска")
+            else:
+                logger.warning(f"⚠️ x-ui статус после перезапуска: {status}")
+            return True  # Возвращаем True, так как перезапуск выполнен
         except Exception as e:
             logger.error(f"Ошибка при выполнении команды перезапуска x-ui: {e}")
             return False
@@ -626,16 +1003,14 @@ class VPSService:
                 return False
         
         # Иначе проверяем через SSH
-        client = self._get_ssh_client()
+        client = await self._get_ssh_client()
         if not client:
             return False
         
         try:
             # Проверяем статус Xray (приоритет) или V2Ray
-            stdin, stdout, stderr = client.exec_command('systemctl is-active xray || systemctl is-active v2ray')
-            status = stdout.read().decode('utf-8').strip()
-            client.close()
-            return status == 'active'
+            _, status, _ = await self._exec(client, 'systemctl is-active xray || systemctl is-active v2ray', idempotent=True)
+            return status.strip() == 'active'
         except Exception as e:
             logger.error(f"Ошибка проверки статуса Xray/V2Ray: {e}")
             return False
@@ -1,15 +1,94 @@
 import aiohttp
+import asyncio
+import hashlib
 import json
-from typing import Optional, Dict, List
+import re
+import ssl
+import time
+from email.utils import parsedate_to_datetime
+from http.cookies import SimpleCookie
+from pathlib import Path
+from typing import Awaitable, Callable, Optional, Dict, List, Tuple
 from loguru import logger
 from config.settings import settings
+from app.utils.metrics import metrics
+from app.utils.notify import notify_admins
+from app.services.singleflight import SingleFlight
+from app.services.resilience import CircuitBreaker, AdaptiveTimeout, backoff_delay
+from app.services.vpn.client_index import ClientIndex
+from app.services.vpn.inbound_codec import inbound_codec, dumps as json_dumps
+from app.services.vpn.restart_scheduler import restart_scheduler
 
 
 class X3UIService:
     """Сервис для работы с 3x-ui API"""
     
-    def __init__(self):
-        api_url_full = getattr(settings, 'X3UI_API_URL', 'http://148.253.213.153:2053')
+    # Сессия младше этого возраста (секунды) считается свежей при поиске endpoints
+    PROBE_SESSION_MAX_AGE = 30
+    
+    # Возможности только для чтения: их запросы идемпотентны и могут повторяться
+    READ_CAPABILITIES = ("inbounds_list", "xray_config")
+    
+    # Пути API различаются между версиями 3x-ui: (метод, путь) в порядке приоритета.
+    # Рабочий путь определяется один раз и кэшируется на диске (см. _call_endpoint)
+    ENDPOINT_CANDIDATES: Dict[str, List[Tuple[str, str]]] = {
+        "login": [
+            ("POST", "/login"),  # Правильный путь к авторизации (найден через тестирование)
+            ("POST", "/panel/api/login"),  # Альтернативный вариант
+            ("POST", "/xui/api/login"),  # Альтернативный вариант
+            ("POST", "/api/login"),  # Без префикса
+        ],
+        "inbounds_list": [
+            # Найден через DevTools; некоторые версии требуют POST даже для получения данных
+            ("GET", "/panel/api/inbounds/list"),
+            ("POST", "/panel/api/inbounds/list"),
+        ],
+        "inbound_update": [
+            ("POST", "/panel/api/inbounds/update/{inbound_id}"),  # С 's' в конце (найден через DevTools)
+            ("POST", "/panel/api/inbound/update/{inbound_id}"),  # Без 's' (старый вариант)
+        ],
+        "xray_config": [
+            ("GET", "/panel/api/xray/config"),
+            ("GET", "/xui/api/xray/config"),
+            ("GET", "/api/xray/config"),
+        ],
+        # Клиентские endpoints: изменяют одного клиента, не пересылая весь inbound
+        "client_add": [
+            ("POST", "/panel/api/inbounds/addClient"),
+        ],
+        "client_update": [
+            ("POST", "/panel/api/inbounds/updateClient/{client_id}"),
+        ],
+        "client_delete": [
+            ("POST", "/panel/api/inbounds/{inbound_id}/delClient/{client_id}"),
+        ],
+        "restart": [
+            ("POST", "/panel/api/inbounds/restartAll"),  # Перезапуск всех inbounds
+            ("POST", "/panel/api/xray/restart"),  # Старый вариант
+            ("POST", "/xui/api/xray/restart"),  # Альтернативный вариант
+            ("POST", "/api/xray/restart"),  # Еще один вариант
+        ],
+    }
+    
+    # Корутины, выполняемые перед перезапуском Xray панели (ключ - URL панели: у всех
+    # inbounds панели один Xray, а перезапуск может запросить сервис любого из них)
+    _restart_hooks: Dict[str, List[Callable[[], Awaitable]]] = {}
+    
+    def __init__(
+        self,
+        api_url: str = None,
+        username: str = None,
+        password: str = None,
+        inbound_id: int = None,
+        name: str = None
+    ):
+        """
+        Args:
+            api_url, username, password, inbound_id: параметры панели
+                (по умолчанию - X3UI_* из настроек; задаются для дополнительных панелей, см. PanelRegistry)
+            name: имя панели для логов и админских отчетов
+        """
+        api_url_full = api_url or getattr(settings, 'X3UI_API_URL', 'http://148.253.213.153:2053')
         
         # Извлекаем базовый URL и WebBasePath
         from urllib.parse import urlparse, urlunparse
@@ -20,350 +99,888 @@ class X3UIService:
         # WebBasePath (если указан в URL)
         self.web_base_path = parsed.path.rstrip('/') if parsed.path else ""
         
-        self.username = getattr(settings, 'X3UI_USERNAME', 'admin')
-        self.password = getattr(settings, 'X3UI_PASSWORD', 'admin')
-        self.inbound_id = getattr(settings, 'X3UI_INBOUND_ID', 1)  # ID inbound в 3x-ui
+        self.username = username or getattr(settings, 'X3UI_USERNAME', 'admin')
+        self.password = password or getattr(settings, 'X3UI_PASSWORD', 'admin')
+        self.inbound_id = int(inbound_id or getattr(settings, 'X3UI_INBOUND_ID', 1))  # ID inbound в 3x-ui
+        self.name = name or parsed.netloc
         
-        logger.info(f"3x-ui базовый URL: {self.base_url}, WebBasePath: {self.web_base_path}")
+        logger.info(f"3x-ui [{self.name}] базовый URL: {self.base_url}, WebBasePath: {self.web_base_path}")
         
-    async def _make_request(self, method: str, endpoint: str, data: Dict = None) -> Optional[Dict]:
-        """Выполнение запроса к API 3x-ui (использует сессию)"""
-        try:
-            # Создаем сессию для сохранения cookies
+        # Постоянная HTTP-сессия с пулом соединений (создается в start() или при первом запросе)
+        self._session: Optional[aiohttp.ClientSession] = None
+        
+        # Закэшированная сессия 3x-ui (cookie и unix-время его истечения)
+        self._session_cookie: Optional[str] = None
+        self._session_expires_at: float = 0.0
+        self._session_obtained_at: float = 0.0
+        self._login_lock = asyncio.Lock()
+        
+        # Найденные endpoints: возможность -> (метод, путь) или None, если панель ее не поддерживает
+        self._endpoints: Dict[str, Optional[Tuple[str, str]]] = {}
+        # Когда записано отсутствие возможности (unix-время): такие записи живут X3UI_ENDPOINT_NEGATIVE_TTL
+        self._unsupported_at: Dict[str, float] = {}
+        self._endpoints_loaded = False
+        self._endpoints_fingerprint: Optional[str] = None
+        self._discovery_lock = asyncio.Lock()
+        self._probe_lock = asyncio.Lock()
+        
+        # Защита от медленной или недоступной панели: быстрый отказ вместо ожидания таймаутов
+        self.breaker = CircuitBreaker(
+            f"3x-ui {self.name}",
+            failure_threshold=settings.X3UI_BREAKER_FAILURES,
+            recovery_timeout=settings.X3UI_BREAKER_RECOVERY
+        )
+        # Таймаут чтений подстраивается под фактическую задержку панели
+        self._read_timeout = AdaptiveTimeout(settings.X3UI_READ_TIMEOUT_MIN, settings.X3UI_REQUEST_TIMEOUT)
+        # Размер последнего ответа по путям чтения (байты): список inbounds растет с числом клиентов
+        self._read_sizes: Dict[str, int] = {}
+        
+        # Одинаковые одновременные чтения (список inbounds, конфигурация) выполняются одним запросом
+        self._singleflight = SingleFlight()
+        
+        # Общий для процесса снимок списка inbounds. Версия увеличивается при каждой записи
+        # клиентов, поэтому загрузка, начатая до записи, не перезапишет снимок устаревшими данными
+        self._snapshot: Optional[List[Dict]] = None
+        self._snapshot_at: float = 0.0
+        self._snapshot_version: int = 0
+        # Во время загрузки была запись: снимок обновляется еще раз после завершения загрузки
+        self._snapshot_stale = False
+        # Индексы клиентов по inbound (строятся из снимка и поддерживаются при записях)
+        self._client_indexes: Dict[int, ClientIndex] = {}
+        
+        # Фоновые задачи (перезапуск Xray и проверка после быстрого добавления клиента)
+        self._background_tasks: set = set()
+        # Клиенты, ожидающие фоновой проверки (uuid -> число проверок), и удаленные за это время:
+        # отсутствие удаленного клиента в inbound - не ошибка добавления
+        self._verifying: Dict[str, int] = {}
+        self._removed_while_verifying: set = set()
+        
+        # Заголовки, найденные через DevTools (из cURL команды)
+        self._api_headers = {
+            "Accept": "application/json, text/plain, */*",
+            "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
+            "Connection": "keep-alive",
+            "Content-Type": "application/json",
+            "Referer": f"{self.base_url}{self.web_base_path}/panel/inbounds",
+            "Sec-Fetch-Dest": "empty",
+            "Sec-Fetch-Mode": "cors",
+            "Sec-Fetch-Site": "same-origin",
+            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/144.0.0.0 Safari/537.36",
+            "X-Requested-With": "XMLHttpRequest",
+            "sec-ch-ua": '"Not(A:Brand";v="8", "Chromium";v="144", "Google Chrome";v="144"',
+            "sec-ch-ua-mobile": "?0",
+            "sec-ch-ua-platform": '"macOS"'
+        }
+    
+    async def start(self):
+        """Открытие постоянной HTTP-сессии (вызывается при запуске бота)"""
+        await self._get_session()
+        logger.info(
+            f"✅ HTTP-сессия 3x-ui открыта (limit={settings.X3UI_POOL_LIMIT}, "
+            f"limit_per_host={settings.X3UI_POOL_LIMIT_PER_HOST}, keepalive={settings.X3UI_KEEPALIVE_TIMEOUT}с)"
+        )
+    
+    async def close(self):
+        """Закрытие HTTP-сессии и всех соединений пула"""
+        # Незавершенные фоновые проверки отменяем до закрытия сессии
+        tasks = list(self._background_tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.info(f"Отменено фоновых задач 3x-ui: {len(tasks)}")
+        
+        if self._session and not self._session.closed:
+            await self._session.close()
+            logger.info("HTTP-сессия 3x-ui закрыта")
+        self._session = None
+        self._invalidate_session()
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Получение постоянной HTTP-сессии (keep-alive, пул соединений)"""
+        if self._session is None or self._session.closed:
             # Отключаем проверку SSL (для самоподписанных сертификатов)
-            import ssl
             ssl_context = ssl.create_default_context()
             ssl_context.check_hostname = False
             ssl_context.verify_mode = ssl.CERT_NONE
             
-            connector = aiohttp.TCPConnector(limit=10, ssl=ssl_context)
-            timeout = aiohttp.ClientTimeout(total=60)  # Увеличено до 60 секунд
-            
-            # Создаем cookie jar для сохранения cookies
-            cookie_jar = aiohttp.CookieJar()
-            
-            async with aiohttp.ClientSession(
-                connector=connector, 
-                timeout=timeout, 
-                cookie_jar=cookie_jar,
-                allow_redirects=True  # Разрешаем редиректы
-            ) as session:
-                # Заголовки для авторизации (минимальные)
-                login_headers = {
-                    "Content-Type": "application/json",
-                    "Accept": "application/json, text/plain, */*",
-                }
-                
-                # Сначала логинимся (сессия сохранит cookies)
-                login_data = {
-                    "username": self.username,
-                    "password": self.password
-                }
-                
-                # В 3x-ui API пути могут различаться
-                # WebBasePath добавляется к базовому пути
-                # Правильный путь к авторизации: /login (найден через тестирование)
-                # Путь к API endpoints: /panel/api/... (например, /panel/api/server/status)
-                api_paths = [
-                    "/login",  # Правильный путь к авторизации (найден через тестирование)
-                    "/panel/api/login",  # Альтернативный вариант
-                    "/xui/api/login",  # Альтернативный вариант
-                    "/api/login"  # Без префикса
-                ]
-                
-                login_url = None
-                login_result = None
-                session_cookie = None
-                
-                for api_path in api_paths:
-                    if self.web_base_path:
-                        test_url = f"{self.base_url}{self.web_base_path}{api_path}"
-                    else:
-                        test_url = f"{self.base_url}{api_path}"
+            connector = aiohttp.TCPConnector(
+                limit=settings.X3UI_POOL_LIMIT,
+                limit_per_host=settings.X3UI_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=settings.X3UI_KEEPALIVE_TIMEOUT,
+                ssl=ssl_context
+            )
+            timeout = aiohttp.ClientTimeout(total=settings.X3UI_REQUEST_TIMEOUT)
+            
+            # Cookie сессии 3x-ui кэшируется в сервисе и передается явно в заголовках
+            cookie_jar = aiohttp.DummyCookieJar()
+            
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                cookie_jar=cookie_jar
+            )
+        return self._session
+    
+    def _build_url(self, path: str) -> str:
+        """Полный URL с учетом WebBasePath"""
+        if not path.startswith("/"):
+            path = f"/{path}"
+        return f"{self.base_url}{self.web_base_path}{path}"
+    
+    def _is_session_valid(self) -> bool:
+        """Проверка, что закэшированная сессия есть и не истекает в ближайшее время"""
+        if not self._session_cookie:
+            return False
+        return time.time() < self._session_expires_at - settings.X3UI_SESSION_REFRESH_MARGIN
+    
+    def _invalidate_session(self, cookie: Optional[str] = None):
+        """Сброс закэшированной сессии (только если она не была уже обновлена другим запросом)"""
+        if cookie is None or self._session_cookie == cookie:
+            self._session_cookie = None
+            self._session_expires_at = 0.0
+    
+    @staticmethod
+    def _parse_session_cookie(response: aiohttp.ClientResponse) -> Optional[Tuple[str, Optional[float]]]:
+        """Извлечение cookie 3x-ui и времени его истечения из Set-Cookie
+        
+        Returns:
+            tuple: (значение cookie, unix-время истечения или None)
+        """
+        for set_cookie in response.headers.getall('Set-Cookie', []):
+            if '3x-ui=' not in set_cookie:
+                continue
+            try:
+                cookie = SimpleCookie()
+                cookie.load(set_cookie)
+                morsel = cookie.get('3x-ui')
+            except Exception:
+                morsel = None
+            if not morsel or not morsel.value:
+                continue
+            
+            expires_at = None
+            max_age = morsel.get('max-age')
+            expires = morsel.get('expires')
+            try:
+                if max_age:
+                    expires_at = time.time() + int(max_age)
+                elif expires:
+                    expires_at = parsedate_to_datetime(expires).timestamp()
+            except Exception:
+                logger.debug(f"Не удалось разобрать срок действия cookie 3x-ui: {set_cookie[:100]}")
+            return morsel.value, expires_at
+        return None
+    
+    async def _login(self) -> bool:
+        """Авторизация в 3x-ui и кэширование cookie сессии вместе с временем истечения"""
+        session = await self._get_session()
+        await self._load_endpoints()
+        
+        # Заголовки для авторизации (минимальные)
+        login_headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json, text/plain, */*",
+        }
+        login_data = {
+            "username": self.username,
+            "password": self.password
+        }
+        
+        # Сначала пробуем закэшированный путь авторизации, затем остальных кандидатов
+        api_paths = [path for _, path in self._ordered_candidates("login")]
+        
+        for api_path in api_paths:
+            test_url = self._build_url(api_path)
+            logger.info(f"🔐 Попытка авторизации в 3x-ui: {test_url}")
+            
+            async with session.post(
+                test_url,
+                json=login_data,
+                headers=login_headers,
+                allow_redirects=False
+            ) as test_response:
+                if test_response.status == 200:
+                    try:
+                        result = await test_response.json()
+                    except Exception:
+                        continue
+                    if not result.get("success"):
+                        logger.warning(f"⚠️ 3x-ui отклонил авторизацию через {test_url}: {result.get('msg', '')}")
+                        continue
                     
-                    logger.info(f"🔐 Попытка авторизации в 3x-ui: {test_url}")
+                    parsed = self._parse_session_cookie(test_response)
+                    if not parsed:
+                        logger.warning(f"⚠️ Авторизация через {test_url} успешна, но cookie 3x-ui не получен")
+                        continue
                     
-                    async with session.post(
-                        test_url,
-                        json=login_data,
-                        headers=login_headers
-                    ) as test_response:
-                        if test_response.status == 200:
-                            try:
-                                result = await test_response.json()
-                                if result.get("success"):
-                                    login_url = test_url
-                                    login_result = result
-                                    logger.info(f"✅ Авторизация успешна через: {test_url}")
-                                    
-                                    # Извлекаем cookie из Set-Cookie заголовка
-                                    set_cookies = test_response.headers.getall('Set-Cookie', [])
-                                    for set_cookie in set_cookies:
-                                        if '3x-ui=' in set_cookie:
-                                            # Извлекаем значение cookie
-                                            # Формат: "3x-ui=value; Path=/; Expires=..."
-                                            parts = set_cookie.split(';')
-                                            for part in parts:
-                                                part = part.strip()
-                                                if part.startswith('3x-ui='):
-                                                    cookie_value = part.split('=', 1)[1]  # Используем split с maxsplit=1 на случай, если в значении есть '='
-                                                    session_cookie = f"lang=ru-RU; 3x-ui={cookie_value}"
-                                                    logger.info(f"✅ Cookie извлечен: 3x-ui={cookie_value[:50]}...")
-                                                    break
-                                            if session_cookie:
-                                                break
-                                    if session_cookie:
-                                        break
-                            except:
-                                pass
-                        elif test_response.status not in [404, 301, 302]:
-                            # Если не 404/редирект, значит путь правильный, но может быть ошибка авторизации
-                            try:
-                                text = await test_response.text()
-                                logger.debug(f"Ответ от {test_url}: {test_response.status}, {text[:100]}")
-                            except:
-                                pass
-                
-                if not login_url or not login_result:
-                    logger.error(f"Ошибка: не удалось найти рабочий API endpoint для авторизации")
-                    logger.error("Попробованы пути: " + ", ".join([f"{self.base_url}{self.web_base_path if self.web_base_path else ''}{p}" for p in api_paths]))
-                    return None
-                
-                if not session_cookie:
-                    # Пробуем получить cookie из cookie jar
-                    for cookie in session.cookie_jar:
-                        if cookie.key == '3x-ui':
-                            session_cookie = f"lang=ru-RU; 3x-ui={cookie.value}"
-                            logger.info(f"✅ Cookie получен из jar: 3x-ui={cookie.value[:50]}...")
-                            break
-                
-                # Если cookie не найден, но авторизация прошла успешно, 
-                # возможно cookie не установился из-за параметров Set-Cookie
-                # В этом случае используем cookie jar напрямую
-                if not session_cookie:
-                    logger.warning("⚠️ Cookie не извлечен, но авторизация прошла успешно")
-                    logger.warning("Попробуем использовать cookie jar напрямую")
-                
-                # Теперь выполняем основной запрос (cookies сохранены в сессии)
-                # API endpoints требуют WebBasePath в пути
-                if endpoint.startswith("/"):
-                    api_endpoint = endpoint
-                else:
-                    api_endpoint = f"/{endpoint}"
-                
-                if self.web_base_path:
-                    url = f"{self.base_url}{self.web_base_path}{api_endpoint}"
-                else:
-                    url = f"{self.base_url}{api_endpoint}"
-                
-                # Заголовки, найденные через DevTools (из cURL команды)
-                headers = {
-                    "Accept": "application/json, text/plain, */*",
-                    "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
-                    "Connection": "keep-alive",
-                    "Content-Type": "application/json",
-                    "Referer": f"{self.base_url}{self.web_base_path}/panel/inbounds",
-                    "Sec-Fetch-Dest": "empty",
-                    "Sec-Fetch-Mode": "cors",
-                    "Sec-Fetch-Site": "same-origin",
-                    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/144.0.0.0 Safari/537.36",
-                    "X-Requested-With": "XMLHttpRequest",
-                    "sec-ch-ua": '"Not(A:Brand";v="8", "Chromium";v="144", "Google Chrome";v="144"',
-                    "sec-ch-ua-mobile": "?0",
-                    "sec-ch-ua-platform": '"macOS"'
-                }
-                
-                # Добавляем cookie в заголовки
-                # Важно: cookie должен быть в заголовках, так как aiohttp не всегда сохраняет cookies из Set-Cookie
-                if session_cookie:
-                    headers["Cookie"] = session_cookie
-                    logger.debug(f"Используем cookie в заголовках: {session_cookie[:50]}...")
-                else:
-                    # Пробуем получить cookie из jar как запасной вариант
-                    cookies_in_jar = list(session.cookie_jar)
-                    if cookies_in_jar:
-                        cookie_str = "; ".join([f"{c.key}={c.value}" for c in cookies_in_jar])
-                        headers["Cookie"] = cookie_str
-                        logger.debug(f"Используем cookies из jar: {len(cookies_in_jar)} cookies")
-                    else:
-                        logger.warning("⚠️ Cookie не найден ни в заголовках, ни в jar")
+                    cookie_value, expires_at = parsed
+                    if not expires_at:
+                        expires_at = time.time() + settings.X3UI_SESSION_TTL
+                    self._session_cookie = f"lang=ru-RU; 3x-ui={cookie_value}"
+                    self._session_expires_at = expires_at
+                    self._session_obtained_at = time.time()
+                    self._remember_endpoint("login", "POST", api_path)
+                    logger.info(
+                        f"✅ Авторизация успешна через: {test_url} "
+                        f"(сессия действительна {int(expires_at - time.time())}с)"
+                    )
+                    return True
+                elif test_response.status not in [404, 301, 302]:
+                    # Если не 404/редирект, значит путь правильный, но может быть ошибка авторизации
+                    try:
+                        text = await test_response.text()
+                        logger.debug(f"Ответ от {test_url}: {test_response.status}, {text[:100]}")
+                    except:
+                        pass
+        
+        # Закэшированный путь не сработал - при следующей попытке проверяем всех кандидатов заново
+        self._forget_endpoint("login")
+        logger.error(f"Ошибка: не удалось найти рабочий API endpoint для авторизации")
+        logger.error("Попробованы пути: " + ", ".join([self._build_url(p) for p in api_paths]))
+        return False
+    
+    async def _ensure_login(self, force: bool = False) -> bool:
+        """Получение действующей сессии 3x-ui
+        
+        Одновременные запросы не логинятся параллельно: первый выполняет авторизацию,
+        остальные ждут на блокировке и используют полученную им сессию.
+        """
+        if not force and self._is_session_valid():
+            return True
+        
+        stale_cookie = self._session_cookie
+        async with self._login_lock:
+            # Пока ждали блокировку, сессию мог обновить другой запрос
+            if self._is_session_valid() and (not force or self._session_cookie != stale_cookie):
+                return True
+            return await self._login()
+    
+    def _is_auth_failure(self, response: aiohttp.ClientResponse, session_reused: bool) -> bool:
+        """Проверка, что панель отклонила запрос из-за истекшей сессии"""
+        if response.status == 401:
+            return True
+        if response.status in (301, 302, 303, 307, 308):
+            location = response.headers.get("Location", "")
+            return "login" in location or location.rstrip("/") in ("", self.web_base_path)
+        # Новые версии 3x-ui отвечают 404 на API-запросы без авторизации.
+        # Считаем это истекшей сессией, только если сессия была получена до этого запроса.
+        return response.status == 404 and session_reused
+    
+    @property
+    def is_available(self) -> bool:
+        """Принимает ли сервис запросы (False - circuit breaker открыт, панель недоступна)"""
+        return not self.breaker.is_open
+    
+    async def _request(
+        self, method: str, endpoint: str, data: Dict = None, probe: bool = False, idempotent: bool = False
+    ) -> Tuple[int, Optional[Dict]]:
+        """Выполнение запроса к API 3x-ui с закэшированной сессией
+        
+        Пока circuit breaker открыт, запрос сразу отклоняется (статус 0).
+        Идемпотентные чтения используют адаптивный таймаут и повторяются
+        при сетевых ошибках и 5xx (не более X3UI_READ_RETRIES раз, с джиттером).
+        
+        Args:
+            probe: режим поиска endpoint - 404 считается отсутствием пути, а не истекшей сессией
+            idempotent: запрос только читает данные и его можно безопасно повторить
+        
+        Returns:
+            tuple: (HTTP статус или 0 при сетевой ошибке, JSON ответа при статусе 200)
+        """
+        attempts = 1 + (settings.X3UI_READ_RETRIES if idempotent else 0)
+        status, result = 0, None
+        
+        for attempt in range(attempts):
+            if not self.breaker.allow_request():
+                metrics.inc("x3ui_circuit_rejected")
+                logger.warning(f"⛔ 3x-ui недоступна, запрос {method} {endpoint} отклонен без попытки")
+                return 0, None
+            
+            status, result, retryable = await self._request_once(method, endpoint, data, probe, idempotent)
+            if not retryable or attempt == attempts - 1:
+                break
+            
+            delay = backoff_delay(attempt, settings.X3UI_RETRY_BASE_DELAY, settings.X3UI_RETRY_MAX_DELAY)
+            metrics.inc("x3ui_read_retries")
+            logger.info(f"🔄 Повтор {method} {endpoint} через {delay:.2f}с (попытка {attempt + 2}/{attempts})")
+            await asyncio.sleep(delay)
+        
+        return status, result
+    
+    def _read_timeout_for(self, endpoint: str) -> float:
+        """Таймаут чтения: адаптивный, но не меньше времени загрузки ответа размером с прошлый
+        
+        Ответ со списком inbounds на десятки тысяч клиентов весит мегабайты, поэтому
+        нижняя граница растет с размером последнего ответа этого пути
+        (X3UI_READ_MIN_THROUGHPUT КБ/с поверх X3UI_READ_TIMEOUT_MIN).
+        """
+        size = self._read_sizes.get(endpoint, 0)
+        floor = settings.X3UI_READ_TIMEOUT_MIN + size / (settings.X3UI_READ_MIN_THROUGHPUT * 1024)
+        return min(settings.X3UI_REQUEST_TIMEOUT, max(self._read_timeout.current(), floor))
+    
+    async def _request_once(
+        self, method: str, endpoint: str, data: Dict, probe: bool, idempotent: bool
+    ) -> Tuple[int, Optional[Dict], bool]:
+        """Одна попытка запроса с учетом результата в circuit breaker
+        
+        Returns:
+            tuple: (статус, JSON ответа, можно ли повторить попытку)
+        """
+        started = time.monotonic()
+        try:
+            session = await self._get_session()
+            url = self._build_url(endpoint)
+            method = method.upper()
+            timeout = aiohttp.ClientTimeout(
+                total=self._read_timeout_for(endpoint) if idempotent else settings.X3UI_REQUEST_TIMEOUT
+            )
+            
+            session_reused = self._is_session_valid() and not probe
+            if not await self._ensure_login():
+                self.breaker.release_trial()
+                return 0, None, False
+            
+            for attempt in range(2):
+                cookie = self._session_cookie
+                headers = dict(self._api_headers)
+                # Важно: cookie передаем в заголовках, так как aiohttp не всегда сохраняет cookies из Set-Cookie
+                headers["Cookie"] = cookie
                 
-                if method.upper() == "GET":
-                    async with session.get(url, headers=headers) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        else:
-                            text = await response.text()
-                            logger.error(f"Ошибка GET {endpoint}: {response.status}, {text}")
-                            return None
-                elif method.upper() == "POST":
-                    async with session.post(url, headers=headers, json=data) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        else:
-                            text = await response.text()
-                            logger.error(f"Ошибка POST {endpoint}: {response.status}, {text}")
-                            return None
-                elif method.upper() == "PUT":
-                    async with session.put(url, headers=headers, json=data) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        else:
-                            text = await response.text()
-                            logger.error(f"Ошибка PUT {endpoint}: {response.status}, {text}")
-                            return None
-                elif method.upper() == "DELETE":
-                    async with session.delete(url, headers=headers) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        else:
+                async with session.request(
+                    method, url, headers=headers, json=data, allow_redirects=False, timeout=timeout
+                ) as response:
+                    if attempt == 0 and self._is_auth_failure(response, session_reused):
+                        logger.info(f"🔐 Сессия 3x-ui истекла ({method} {endpoint}: {response.status}), повторная авторизация...")
+                        self._invalidate_session(cookie)
+                        if not await self._ensure_login(force=True):
+                            self.breaker.release_trial()
+                            return 0, None, False
+                        continue
+                    
+                    if response.status >= 500:
+                        text = await response.text()
+                        logger.error(f"Ошибка {method} {endpoint}: {response.status}, {text[:200]}")
+                        self.breaker.record_failure()
+                        return response.status, None, idempotent
+                    
+                    self.breaker.record_success()
+                    body = await response.read()
+                    if idempotent:
+                        # Время учитывается вместе с загрузкой тела ответа, а не до заголовков
+                        self._read_timeout.observe(time.monotonic() - started)
+                        self._read_sizes[endpoint] = len(body)
+                    
+                    if response.status == 200:
+                        try:
+                            return response.status, await response.json(), False
+                        except Exception:
                             text = await response.text()
-                            logger.error(f"Ошибка DELETE {endpoint}: {response.status}, {text}")
-                            return None
-                        
+                            logger.warning(f"Ответ {method} {endpoint} не является JSON: {text[:100]}")
+                            return response.status, None, False
+                    
+                    text = await response.text()
+                    if probe:
+                        logger.debug(f"Endpoint {method} {endpoint} недоступен: {response.status}")
+                    else:
+                        logger.error(f"Ошибка {method} {endpoint}: {response.status}, {text}")
+                    return response.status, None, False
+            
+            self.breaker.release_trial()
+            return 0, None, False
+        except asyncio.CancelledError:
+            self.breaker.release_trial()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            # Сетевая ошибка или таймаут - панель медленная или недоступна
+            self.breaker.record_failure()
+            metrics.inc("x3ui_request_errors")
+            logger.error(
+                f"Ошибка запроса к 3x-ui API ({method} {endpoint}, {time.monotonic() - started:.1f}с): "
+                f"{type(e).__name__}: {e}"
+            )
+            return 0, None, idempotent
         except Exception as e:
+            self.breaker.release_trial()
             logger.error(f"Ошибка запроса к 3x-ui API: {e}")
             import traceback
             logger.error(traceback.format_exc())
+            return 0, None, False
+    
+    async def _make_request(self, method: str, endpoint: str, data: Dict = None) -> Optional[Dict]:
+        """Выполнение запроса к API 3x-ui (использует закэшированную сессию)
+        
+        Повторная авторизация выполняется только при истечении сессии
+        или если панель ответила 401/редиректом на страницу логина.
+        """
+        _, result = await self._request(method, endpoint, data)
+        return result
+    
+    # ---------- Обнаружение endpoints ----------
+    
+    @property
+    def _panel_key(self) -> str:
+        """Ключ панели в файле кэша endpoints"""
+        return f"{self.base_url}{self.web_base_path}"
+    
+    async def _detect_panel_version(self) -> str:
+        """Определение версии панели по странице логина (без авторизации)
+        
+        3x-ui добавляет текущую версию к ссылкам на статические файлы (?v=2.x.x),
+        поэтому страница логина - дешевый способ узнать версию без авторизации.
+        """
+        try:
+            session = await self._get_session()
+            async with session.get(self._build_url("/"), allow_redirects=True) as response:
+                text = await response.text()
+            match = re.search(r'\.(?:js|css)\?(?:v=)?([\w.\-]+)', text)
+            if match:
+                return match.group(1)
+        except Exception as e:
+            logger.debug(f"Не удалось определить версию 3x-ui: {e}")
+        return "unknown"
+    
+    async def probe(self, timeout: float) -> float:
+        """Проверка доступности панели запросом страницы логина (без авторизации)
+        
+        Запрос идет мимо circuit breaker и повторов - это замер, а не рабочий запрос.
+        
+        Returns:
+            float: задержка ответа (секунды)
+        
+        Raises:
+            Exception: панель не ответила за timeout или вернула 5xx
+        """
+        session = await self._get_session()
+        started = time.monotonic()
+        async with session.get(
+            self._build_url("/"),
+            allow_redirects=False,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            await response.read()
+            if response.status >= 500:
+                raise RuntimeError(f"HTTP {response.status}")
+        return time.monotonic() - started
+    
+    async def _load_endpoints(self):
+        """Загрузка закэшированных endpoints с диска (один раз на процесс)
+        
+        Кэш действителен, только если отпечаток (URL панели + версия) совпадает с текущим.
+        Записи об отсутствии возможности дополнительно ограничены X3UI_ENDPOINT_NEGATIVE_TTL:
+        устаревшие (и записанные без времени) отбрасываются, возможность проверяется заново.
+        """
+        if self._endpoints_loaded:
+            return
+        async with self._discovery_lock:
+            if self._endpoints_loaded:
+                return
+            
+            version = await self._detect_panel_version()
+            self._endpoints_fingerprint = hashlib.sha256(f"{self._panel_key}|{version}".encode()).hexdigest()[:16]
+            
+            cache_path = Path(settings.X3UI_ENDPOINTS_CACHE_PATH)
+            try:
+                if cache_path.exists():
+                    cache = json.loads(cache_path.read_text(encoding="utf-8"))
+                    entry = cache.get(self._panel_key) or {}
+                    if entry.get("fingerprint") == self._endpoints_fingerprint:
+                        unsupported_at = entry.get("unsupported_at") or {}
+                        now = time.time()
+                        for name, value in (entry.get("endpoints") or {}).items():
+                            if name not in self.ENDPOINT_CANDIDATES:
+                                continue
+                            if value:
+                                self._endpoints[name] = tuple(value)
+                            elif now - float(unsupported_at.get(name) or 0) < settings.X3UI_ENDPOINT_NEGATIVE_TTL:
+                                self._endpoints[name] = None
+                                self._unsupported_at[name] = float(unsupported_at[name])
+                        logger.info(f"✅ Загружены endpoints 3x-ui из кэша (версия панели: {version}): {len(self._endpoints)} шт.")
+                    elif entry:
+                        logger.info(f"🔄 Версия 3x-ui изменилась ({version}), endpoints будут найдены заново")
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось прочитать кэш endpoints 3x-ui: {e}")
+            
+            self._endpoints_loaded = True
+    
+    def _save_endpoints(self):
+        """Сохранение найденных endpoints на диск"""
+        cache_path = Path(settings.X3UI_ENDPOINTS_CACHE_PATH)
+        try:
+            cache = {}
+            if cache_path.exists():
+                cache = json.loads(cache_path.read_text(encoding="utf-8"))
+            cache[self._panel_key] = {
+                "fingerprint": self._endpoints_fingerprint,
+                "endpoints": {name: list(value) if value else None for name, value in self._endpoints.items()},
+                "unsupported_at": {name: int(at) for name, at in self._unsupported_at.items() if name in self._endpoints},
+                "updated_at": int(time.time())
+            }
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(cache, indent=2, ensure_ascii=False), encoding="utf-8")
+            tmp_path.replace(cache_path)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить кэш endpoints 3x-ui: {e}")
+    
+    def _remember_endpoint(self, capability: str, method: Optional[str], path: Optional[str] = None):
+        """Запоминание рабочего endpoint (или его отсутствия, если method=None)"""
+        value = (method, path) if method else None
+        if capability in self._endpoints and self._endpoints[capability] == value:
+            return
+        self._endpoints[capability] = value
+        if value:
+            self._unsupported_at.pop(capability, None)
+            logger.info(f"📌 Endpoint 3x-ui '{capability}': {method} {path}")
+        else:
+            self._unsupported_at[capability] = time.time()
+            logger.info(f"📌 Endpoint 3x-ui '{capability}' не поддерживается этой версией панели")
+        self._save_endpoints()
+    
+    def _forget_endpoint(self, capability: str):
+        """Сброс закэшированного endpoint (будет найден заново при следующем вызове)"""
+        if self._endpoints.pop(capability, None) is not None:
+            self._save_endpoints()
+    
+    def _expire_unsupported(self, capability: str):
+        """Сброс устаревшей записи об отсутствии возможности (панель могли обновить)"""
+        recorded_at = self._unsupported_at.get(capability)
+        if recorded_at is not None and time.time() - recorded_at >= settings.X3UI_ENDPOINT_NEGATIVE_TTL:
+            del self._unsupported_at[capability]
+            if capability in self._endpoints and self._endpoints[capability] is None:
+                del self._endpoints[capability]
+                logger.info(f"🔄 Endpoint 3x-ui '{capability}' будет проверен заново")
+    
+    def _ordered_candidates(self, capability: str) -> List[Tuple[str, str]]:
+        """Кандидаты endpoint: закэшированный первым, затем остальные"""
+        candidates = list(self.ENDPOINT_CANDIDATES[capability])
+        cached = self._endpoints.get(capability)
+        if cached in candidates:
+            candidates.remove(cached)
+            candidates.insert(0, cached)
+        return candidates
+    
+    def is_endpoint_supported(self, capability: str) -> Optional[bool]:
+        """Поддерживает ли панель endpoint (None - еще не проверялось)"""
+        self._expire_unsupported(capability)
+        if capability not in self._endpoints:
+            return None
+        return self._endpoints[capability] is not None
+    
+    async def _call_endpoint(self, capability: str, data: Dict = None, **path_params) -> Optional[Dict]:
+        """Вызов API по имени возможности с использованием закэшированного пути
+        
+        Если путь еще не известен или перестал работать, кандидаты перебираются заново,
+        а результат сохраняется в кэш. Endpoint считается рабочим, если панель вернула 200 и JSON.
+        """
+        await self._load_endpoints()
+        self._expire_unsupported(capability)
+        
+        cached = self._endpoints.get(capability)
+        if cached:
+            method, path = cached
+            status, result = await self._request(
+                method, path.format(**path_params), data, idempotent=capability in self.READ_CAPABILITIES
+            )
+            if status == 200 and isinstance(result, dict):
+                return result
+            if status == 0 or status >= 500:
+                # Сетевая ошибка или сбой панели - путь тут ни при чем
+                return None
+            if status not in (404, 405):
+                # 403/429 и т.п. (в том числе от прокси перед панелью) не означают, что путь изменился
+                logger.warning(f"⚠️ Закэшированный endpoint '{capability}' ({method} {path}) вернул {status}")
+                return None
+            logger.warning(f"⚠️ Закэшированный endpoint '{capability}' ({method} {path}) вернул {status}, ищем заново")
+            self._forget_endpoint(capability)
+        elif capability in self._endpoints:
+            # Панель не поддерживает эту возможность
+            return None
+        
+        async with self._probe_lock:
+            # Пока ждали блокировку, endpoint мог найти другой запрос
+            if capability in self._endpoints and self._endpoints[capability] != cached:
+                found = self._endpoints[capability]
+                if not found:
+                    return None
+                _, result = await self._request(
+                    found[0], found[1].format(**path_params), data, idempotent=capability in self.READ_CAPABILITIES
+                )
+                return result
+            
+            # Перед перебором кандидатов нужна свежая сессия, чтобы 404 означал отсутствие пути, а не истекшую сессию
+            session_age = time.time() - self._session_obtained_at
+            if not await self._ensure_login(force=session_age > self.PROBE_SESSION_MAX_AGE):
+                return None
+            
+            for method, path in self.ENDPOINT_CANDIDATES[capability]:
+                if cached and (method, path) == cached:
+                    continue
+                status, result = await self._request(method, path.format(**path_params), data, probe=True)
+                if status == 200 and isinstance(result, dict):
+                    self._remember_endpoint(capability, method, path)
+                    return result
+                if status == 0 or status >= 500:
+                    return None
+            
+            if cached:
+                # Возможность раньше работала: вероятнее временный сбой, чем отсутствие в панели -
+                # отказ не запоминаем, при следующем вызове кандидаты перебираются снова
+                logger.warning(f"⚠️ Endpoint '{capability}' не найден заново, повторная проверка при следующем вызове")
+                return None
+            self._remember_endpoint(capability, None)
             return None
     
-    async def get_inbound(self, inbound_id: int = None) -> Optional[Dict]:
-        """Получение информации о inbound"""
+    async def _read_endpoint(self, capability: str, **path_params) -> Optional[Dict]:
+        """Чтение через _call_endpoint с объединением одинаковых одновременных запросов
+        
+        Результат общий для всех ожидающих - его нельзя изменять.
+        """
+        key = (capability, tuple(sorted(path_params.items())))
+        return await self._singleflight.do(key, self._call_endpoint, capability, **path_params)
+    
+    # ---------- Снимок inbounds ----------
+    
+    @property
+    def snapshot_version(self) -> int:
+        """Версия снимка inbounds (увеличивается при каждой записи клиентов)"""
+        return self._snapshot_version
+    
+    def invalidate_snapshot(self):
+        """Пометка снимка устаревшим после записи и фоновое обновление
+        
+        Пока обновление не завершено, читатели получают предыдущий снимок.
+        """
+        self._snapshot_version += 1
+        self._snapshot_at = 0.0
+        if self._snapshot is not None:
+            self._schedule_snapshot_refresh()
+    
+    def _schedule_snapshot_refresh(self):
+        """Запуск фонового обновления снимка (если оно еще не идет)"""
+        if not self._singleflight.in_flight(("inbounds_snapshot",)):
+            self._spawn_background(self._refresh_snapshot())
+    
+    async def _refresh_snapshot(self) -> Optional[List[Dict]]:
+        """Загрузка списка inbounds в снимок (одновременные обновления объединяются)"""
+        inbounds = await self._singleflight.do(("inbounds_snapshot",), self._load_snapshot)
+        self._refresh_if_stale()
+        return inbounds
+    
+    def _refresh_if_stale(self):
+        """Повторное обновление в фоне, если загруженные данные могли не содержать записи
+        
+        Вызывается после завершения загрузки: пока она числится идущей,
+        _schedule_snapshot_refresh новое обновление не запустит.
+        """
+        if self._snapshot_stale:
+            self._snapshot_stale = False
+            self._schedule_snapshot_refresh()
+    
+    async def _load_snapshot(self, fresh: bool = False) -> Optional[List[Dict]]:
+        """Загрузка списка inbounds с панели в снимок
+        
+        Args:
+            fresh: не присоединяться к уже идущему запросу (он мог начаться до последней записи)
+        """
+        version = self._snapshot_version
+        # Путь к списку inbounds определяется один раз и кэшируется (см. ENDPOINT_CANDIDATES)
+        if fresh:
+            result = await self._call_endpoint("inbounds_list")
+        else:
+            result = await self._read_endpoint("inbounds_list")
+        if not result or not result.get("success"):
+            if result:
+                logger.debug(f"Результат получения списка inbounds: {result}")
+            return None
+        
+        inbounds = result.get("obj") or []
+        if version == self._snapshot_version:
+            self._snapshot = inbounds
+            self._snapshot_at = time.time()
+        else:
+            # Во время загрузки была запись - данные могут ее не содержать, обновим еще раз
+            # (после завершения загрузки, см. _refresh_if_stale)
+            logger.debug("Снимок inbounds изменился во время загрузки, повторное обновление в фоне")
+            if self._snapshot is None:
+                self._snapshot = inbounds
+            self._snapshot_stale = True
+        return inbounds
+    
+    async def get_inbounds(self, force_refresh: bool = False) -> Optional[List[Dict]]:
+        """Список inbounds из общего снимка (stale-while-revalidate)
+        
+        Свежий снимок (младше X3UI_SNAPSHOT_TTL) возвращается сразу. Устаревший тоже
+        возвращается сразу, а обновление запускается в фоне - ждет загрузки только первый запрос.
+        
+        Args:
+            force_refresh: дождаться свежих данных с панели (для проверок после записи
+                и перед перезаписью inbound); если панель не ответила - None, а не старый снимок
+        
+        Returns:
+            Общий список inbounds (изменять нельзя) или None
+        """
+        if self._snapshot is not None and not force_refresh:
+            if time.time() - self._snapshot_at >= settings.X3UI_SNAPSHOT_TTL:
+                self._schedule_snapshot_refresh()
+            return self._snapshot
+        
+        if force_refresh:
+            # Обновление, начатое до этого вызова, может не содержать последних изменений:
+            # увеличиваем версию, чтобы оно не перезаписало снимок, и загружаем отдельно
+            self._snapshot_version += 1
+            inbounds = await self._load_snapshot(fresh=True)
+            self._refresh_if_stale()
+            if inbounds is None:
+                logger.warning(f"⚠️ Не удалось получить свежий список inbounds 3x-ui {self.name}")
+            return inbounds
+        
+        inbounds = await self._refresh_snapshot()
+        return inbounds if inbounds is not None else self._snapshot
+    
+    async def get_client_index(self, inbound_id: int = None, force_refresh: bool = False) -> Optional[ClientIndex]:
+        """Индекс клиентов inbound по UUID и email
+        
+        Индекс строится один раз для каждого снимка inbounds, а между обновлениями
+        снимка поддерживается записями этого сервиса.
+        """
         inbound_id = inbound_id or self.inbound_id
+        inbounds = await self.get_inbounds(force_refresh=force_refresh)
+        if inbounds is None:
+            return None
         
-        # Используем найденный через DevTools endpoint: /panel/api/inbounds/list
-        # Пробуем GET и POST, так как некоторые API требуют POST даже для получения данных
-        endpoints = [
-            ("GET", "/panel/api/inbounds/list"),
-            ("POST", "/panel/api/inbounds/list"),
-        ]
+        index = self._client_indexes.get(inbound_id)
+        if index is not None and index.source is inbounds:
+            return index
         
-        for method, endpoint in endpoints:
-            result = await self._make_request(method, endpoint)
-            if result and result.get("success"):
-                inbounds = result.get("obj", [])
-                logger.info(f"✅ Получен список inbounds через {method} {endpoint}: {len(inbounds)} inbounds")
-                # Ищем нужный inbound по ID
-                for inbound in inbounds:
-                    if inbound.get("id") == inbound_id:
-                        # Логируем подробную информацию о найденном inbound
-                        inb_port = inbound.get('port', 'N/A')
-                        inb_protocol = inbound.get('protocol', 'N/A')
-                        inb_remark = inbound.get('remark', 'N/A')
-                        inb_enable = inbound.get('enable', False)
-                        
-                        logger.info(f"✅ Найден inbound с ID {inbound_id}:")
-                        logger.info(f"   - Порт: {inb_port}")
-                        logger.info(f"   - Протокол: {inb_protocol}")
-                        logger.info(f"   - Remark: {inb_remark}")
-                        logger.info(f"   - Enabled: {inb_enable}")
-                        
-                        # Логируем streamSettings для отладки
-                        stream_settings = inbound.get("streamSettings", {})
-                        if isinstance(stream_settings, str):
-                            try:
-                                import json
-                                stream_settings_parsed = json.loads(stream_settings)
-                                security = stream_settings_parsed.get('security', 'N/A')
-                                has_reality = bool(stream_settings_parsed.get('realitySettings'))
-                                logger.info(f"   - Security: {security}")
-                                logger.info(f"   - Reality Settings: {has_reality}")
-                                logger.debug(f"📋 streamSettings (распарсено): security={security}, realitySettings={has_reality}")
-                            except:
-                                logger.debug(f"📋 streamSettings (строка): {stream_settings[:100]}...")
-                        else:
-                            security = stream_settings.get('security', 'N/A')
-                            has_reality = bool(stream_settings.get('realitySettings'))
-                            logger.info(f"   - Security: {security}")
-                            logger.info(f"   - Reality Settings: {has_reality}")
-                            logger.debug(f"📋 streamSettings (объект): security={security}, realitySettings={has_reality}")
-                        return inbound
-                logger.warning(f"Inbound с ID {inbound_id} не найден в списке из {len(inbounds)} inbounds")
-                # Логируем все доступные inbounds с подробной информацией
-                if inbounds:
-                    logger.warning(f"📋 Доступные inbounds ({len(inbounds)} шт.):")
-                    for idx, inb in enumerate(inbounds, 1):
-                        inb_id = inb.get('id', 'N/A')
-                        inb_port = inb.get('port', 'N/A')
-                        inb_protocol = inb.get('protocol', 'N/A')
-                        inb_remark = inb.get('remark', 'N/A')
-                        inb_enable = inb.get('enable', False)
-                        
-                        # Проверяем streamSettings для Reality
-                        stream_settings = inb.get("streamSettings", {})
-                        if isinstance(stream_settings, str):
-                            try:
-                                stream_settings_parsed = json.loads(stream_settings)
-                                security = stream_settings_parsed.get('security', 'N/A')
-                                has_reality = bool(stream_settings_parsed.get('realitySettings'))
-                            except:
-                                security = 'N/A'
-                                has_reality = False
-                        else:
-                            security = stream_settings.get('security', 'N/A')
-                            has_reality = bool(stream_settings.get('realitySettings'))
-                        
-                        logger.warning(f"   {idx}. ID={inb_id}, порт={inb_port}, протокол={inb_protocol}, "
-                                     f"remark={inb_remark}, enabled={inb_enable}, "
-                                     f"security={security}, reality={has_reality}")
+        inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
+        if inbound is None:
+            return None
+        inbound_settings = inbound_codec.field(inbound, "settings")
+        index = ClientIndex(inbound_settings.get("clients", []), source=inbounds)
+        self._client_indexes[inbound_id] = index
+        logger.debug(f"Построен индекс клиентов inbound {inbound_id}: {len(index)} шт.")
+        return index
+    
+    async def get_client_traffic(self, inbound_id: int = None) -> Optional[Dict[str, Tuple[int, int]]]:
+        """Счетчики трафика всех клиентов inbound одним запросом
+        
+        Список inbounds уже содержит clientStats (накопленные up/down по email),
+        поэтому отдельный запрос на каждого клиента не нужен.
+        
+        Returns:
+            dict: uuid -> (up, down) в байтах; None, если панель недоступна
+        """
+        inbound_id = inbound_id or self.inbound_id
+        inbounds = await self.get_inbounds(force_refresh=True)
+        if inbounds is None:
+            return None
+        
+        inbound = next((i for i in inbounds if i.get("id") == inbound_id), None)
+        index = await self.get_client_index(inbound_id)
+        if inbound is None or index is None:
+            return None
+        
+        traffic: Dict[str, Tuple[int, int]] = {}
+        for stat in inbound.get("clientStats") or []:
+            client = index.get_by_email(stat.get("email"))
+            if client is not None:
+                traffic[client["id"]] = (int(stat.get("up") or 0), int(stat.get("down") or 0))
+        return traffic
+    
+    async def get_inbound(self, inbound_id: int = None, force_refresh: bool = False) -> Optional[Dict]:
+        """Получение информации о inbound из общего снимка
+        
+        Возвращается копия inbound: список inbounds общий для всех вызовов.
+        
+        Args:
+            force_refresh: загрузить свежий список с панели (нужно перед перезаписью inbound)
+        """
+        inbound_id = inbound_id or self.inbound_id
+        
+        inbounds = await self.get_inbounds(force_refresh=force_refresh)
+        if inbounds is not None:
+            logger.info(f"✅ Получен список inbounds: {len(inbounds)} inbounds")
+            # Ищем нужный inbound по ID
+            for inbound in inbounds:
+                if inbound.get("id") == inbound_id:
+                    # Логируем подробную информацию о найденном inbound
+                    inb_port = inbound.get('port', 'N/A')
+                    inb_protocol = inbound.get('protocol', 'N/A')
+                    inb_remark = inbound.get('remark', 'N/A')
+                    inb_enable = inbound.get('enable', False)
                     
-                    logger.warning(f"💡 Убедитесь, что X3UI_INBOUND_ID в .env соответствует нужному inbound ID")
-            elif result:
-                logger.debug(f"Результат {method} {endpoint}: {result}")
+                    logger.info(f"✅ Найден inbound с ID {inbound_id}:")
+                    logger.info(f"   - Порт: {inb_port}")
+                    logger.info(f"   - Протокол: {inb_protocol}")
+                    logger.info(f"   - Remark: {inb_remark}")
+                    logger.info(f"   - Enabled: {inb_enable}")
+                    
+                    # Логируем streamSettings для отладки
+                    stream_settings = inbound_codec.field(inbound, "streamSettings")
+                    security = stream_settings.get('security', 'N/A')
+                    has_reality = bool(stream_settings.get('realitySettings'))
+                    logger.info(f"   - Security: {security}")
+                    logger.info(f"   - Reality Settings: {has_reality}")
+                    logger.debug(f"📋 streamSettings: security={security}, realitySettings={has_reality}")
+                    return dict(inbound)
+            logger.warning(f"Inbound с ID {inbound_id} не найден в списке из {len(inbounds)} inbounds")
+            # Логируем все доступные inbounds с подробной информацией
+            if inbounds:
+                logger.warning(f"📋 Доступные inbounds ({len(inbounds)} шт.):")
+                for idx, inb in enumerate(inbounds, 1):
+                    inb_id = inb.get('id', 'N/A')
+                    inb_port = inb.get('port', 'N/A')
+                    inb_protocol = inb.get('protocol', 'N/A')
+                    inb_remark = inb.get('remark', 'N/A')
+                    inb_enable = inb.get('enable', False)
+                    
+                    # Проверяем streamSettings для Reality
+                    stream_settings = inbound_codec.field(inb, "streamSettings")
+                    security = stream_settings.get('security', 'N/A')
+                    has_reality = bool(stream_settings.get('realitySettings'))
+                    
+                    logger.warning(f"   {idx}. ID={inb_id}, порт={inb_port}, протокол={inb_protocol}, "
+                                 f"remark={inb_remark}, enabled={inb_enable}, "
+                                 f"security={security}, reality={has_reality}")
+                
+                logger.warning(f"💡 Убедитесь, что X3UI_INBOUND_ID в .env соответствует нужному inbound ID")
         
         return None
     
     async def get_xray_config(self) -> Optional[Dict]:
         """Получение полной конфигурации Xray через API 3x-ui
         
+        Одновременные вызовы разделяют один запрос и один результат (его нельзя изменять).
+        """
+        return await self._singleflight.do(("xray_config_built",), self._get_xray_config)
+    
+    async def _get_xray_config(self) -> Optional[Dict]:
+        """Загрузка конфигурации Xray
+        
         Если прямой endpoint для конфигурации недоступен, собираем конфигурацию из списка inbounds
         """
         try:
-            # Пробуем разные варианты endpoint для получения конфигурации
-            endpoints = [
-                "/panel/api/xray/config",
-                "/xui/api/xray/config",
-                "/api/xray/config"
-            ]
-            
-            for endpoint in endpoints:
-                result = await self._make_request("GET", endpoint)
-                if result:
-                    # Если результат успешный, возвращаем его
-                    if isinstance(result, dict):
-                        # Если это обертка с success, извлекаем данные
-                        if result.get("success") and "obj" in result:
-                            logger.info(f"✅ Конфигурация Xray получена через {endpoint}")
-                            return result.get("obj")
-                        # Если это уже конфигурация напрямую
-                        elif "inbounds" in result:
-                            logger.info(f"✅ Конфигурация Xray получена через {endpoint}")
-                            return result
+            # Прямой endpoint конфигурации есть не во всех версиях 3x-ui (результат поиска кэшируется)
+            result = await self._read_endpoint("xray_config")
+            if isinstance(result, dict):
+                # Если это обертка с success, извлекаем данные
+                if result.get("success") and "obj" in result:
+                    logger.info(f"✅ Конфигурация Xray получена через прямой endpoint")
+                    return result.get("obj")
+                # Если это уже конфигурация напрямую
+                elif "inbounds" in result:
+                    logger.info(f"✅ Конфигурация Xray получена через прямой endpoint")
+                    return result
             
             # Если прямой endpoint недоступен, собираем конфигурацию из списка inbounds
             logger.info("⚠️ Прямой endpoint для конфигурации недоступен, собираем из списка inbounds")
-            inbounds_result = await self._make_request("GET", "/panel/api/inbounds/list")
+            inbounds_result = await self._read_endpoint("inbounds_list")
             if inbounds_result and inbounds_result.get("success"):
                 inbounds = inbounds_result.get("obj", [])
                 # Преобразуем список inbounds в формат конфигурации Xray
-                # Парсим settings и streamSettings из строк JSON
-                parsed_inbounds = []
-                for inbound in inbounds:
-                    parsed_inbound = inbound.copy()
-                    
-                    # Парсим settings
-                    if isinstance(inbound.get("settings"), str):
-                        parsed_inbound["settings"] = json.loads(inbound["settings"])
-                    
-                    # Парсим streamSettings
-                    if isinstance(inbound.get("streamSettings"), str):
-                        parsed_inbound["streamSettings"] = json.loads(inbound["streamSettings"])
-                    
-                    # Парсим sniffing
-                    if isinstance(inbound.get("sniffing"), str):
-                        parsed_inbound["sniffing"] = json.loads(inbound["sniffing"])
-                    
-                    parsed_inbounds.append(parsed_inbound)
+                # settings, streamSettings и sniffing разбираются из строк JSON (один раз на содержимое)
+                parsed_inbounds = [inbound_codec.decode_inbound(inbound) for inbound in inbounds]
                 
                 # Формируем базовую конфигурацию Xray
                 config = {
@@ -397,70 +1014,473 @@ class X3UIService:
             logger.error(traceback.format_exc())
             return None
     
+    async def _after_client_added(
+        self, inbound_id: int, port: int = None, protocol: str = None, uuids: List[str] = None,
+        immediate: bool = False
+    ) -> Tuple[Optional[Dict], List[str]]:
+        """Перезапуск Xray после изменения клиентов и проверка, что параметры Reality не потерялись
+        
+        Args:
+            uuids: если указаны, дополнительно проверяется, что эти клиенты есть в inbound
+            immediate: перезапустить сразу, не дожидаясь окна объединения (вызывающий ждет результата)
+        
+        Returns:
+            tuple: (полная конфигурация Xray или None, список найденных проблем)
+        """
+        problems: List[str] = []
+        
+        # Перезапускаем Xray через API (перезапуск объединяется с соседними изменениями;
+        # если ответа ждет пользователь - сразу, вместе с уже запланированными)
+        if immediate:
+            await self.restart_now()
+        else:
+            await self.schedule_restart()
+        # Ждем немного, чтобы Xray успел перезагрузить конфигурацию
+        await asyncio.sleep(2)
+        # Получаем обновленную конфигурацию
+        config = await self.get_xray_config()
+        
+        if not config:
+            problems.append("не удалось получить конфигурацию Xray")
+        
+        # Проверяем, что параметры Reality сохранились после обновления
+        if config:
+            found_inbound = False
+            # Ищем наш inbound в конфигурации
+            for inbound in config.get("inbounds", []):
+                same_id = inbound.get("id") == inbound_id
+                same_endpoint = port is not None and inbound.get("port") == port and inbound.get("protocol") == protocol
+                if same_id or same_endpoint:
+                    found_inbound = True
+                    
+                    if uuids:
+                        inbound_settings = inbound_codec.field(inbound, "settings")
+                        present = {c.get("id") for c in inbound_settings.get("clients", [])}
+                        for uuid in uuids:
+                            if uuid not in present and uuid in self._removed_while_verifying:
+                                logger.info(f"Клиент {uuid} удален до проверки - пропускаем")
+                            elif uuid not in present:
+                                logger.error(f"❌ Клиент {uuid} не найден в inbound {inbound_id} после добавления!")
+                                problems.append(f"клиент {uuid} отсутствует в inbound {inbound_id}")
+                    
+                    updated_stream_settings = inbound_codec.field(inbound, "streamSettings")
+                    
+                    updated_security = updated_stream_settings.get("security", "")
+                    updated_reality = updated_stream_settings.get("realitySettings", {})
+                    
+                    logger.info(f"🔍 Проверка параметров Reality после обновления:")
+                    logger.info(f"   - security: {updated_security}")
+                    logger.info(f"   - realitySettings присутствует: {bool(updated_reality)}")
+                    if updated_reality:
+                        logger.info(f"   - serverNames: {updated_reality.get('serverNames', [])}")
+                        logger.info(f"   - shortIds: {updated_reality.get('shortIds', [])}")
+                        # На сервере используется privateKey, а не publicKey
+                        has_private_key = bool(updated_reality.get("privateKey"))
+                        has_public_key = bool(updated_reality.get("publicKey"))
+                        has_mldsa65_seed = bool(updated_reality.get("mldsa65Seed"))
+                        logger.info(f"   - privateKey присутствует: {has_private_key}")
+                        logger.info(f"   - publicKey присутствует: {has_public_key}")
+                        logger.info(f"   - mldsa65Seed присутствует: {has_mldsa65_seed}")
+                    
+                    # Предупреждение, если параметры Reality потеряны
+                    if updated_security == "reality" and not updated_reality:
+                        logger.error("❌ ВНИМАНИЕ: security=reality, но realitySettings отсутствует после обновления!")
+                        problems.append("realitySettings отсутствует")
+                    elif updated_security == "reality" and updated_reality:
+                        # Проверяем наличие обязательных параметров
+                        has_key = bool(updated_reality.get("privateKey") or updated_reality.get("publicKey") or updated_reality.get("mldsa65Seed"))
+                        has_short_ids = bool(updated_reality.get("shortIds"))
+                        has_server_names = bool(updated_reality.get("serverNames"))
+                        
+                        if not has_key or not has_short_ids or not has_server_names:
+                            logger.error("❌ ВНИМАНИЕ: realitySettings неполный после обновления!")
+                            logger.error(f"   - ключ (privateKey/publicKey/mldsa65Seed): {has_key}")
+                            logger.error(f"   - shortIds: {has_short_ids}")
+                            logger.error(f"   - serverNames: {has_server_names}")
+                            problems.append("realitySettings неполный")
+                        else:
+                            logger.info("✅ Параметры Reality успешно сохранены")
+                    break
+            
+            if not found_inbound:
+                problems.append(f"inbound {inbound_id} не найден в конфигурации")
+        
+        return config, problems
+    
+    def _spawn_background(self, coro):
+        """Запуск фоновой задачи с сохранением ссылки (отменяется в close())"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+    
+    async def _finish_clients_added(
+        self, clients: List[Dict], inbound_id: int, port: int = None, protocol: str = None, restart: bool = True
+    ) -> Tuple[bool, Optional[Dict]]:
+        """Завершение добавления клиентов после подтверждения панели (один перезапуск на пакет)
+        
+        В режиме быстрого добавления (X3UI_FAST_PROVISION) возвращаемся сразу:
+        перезапуск Xray и проверка выполняются в фоне, а ошибки уходят в метрики и админам.
+        """
+        uuids = [client["id"] for client in clients]
+        index = self._client_indexes.get(inbound_id)
+        if index is not None:
+            for client in clients:
+                index.add(client)
+        self.invalidate_snapshot()
+        
+        if not restart:
+            # Клиенты уже применены к работающему Xray (gRPC API) - панель только сохраняет их
+            return True, None
+        
+        if settings.X3UI_FAST_PROVISION:
+            metrics.inc("x3ui_provision_fast", len(uuids))
+            for uuid in uuids:
+                self._verifying[uuid] = self._verifying.get(uuid, 0) + 1
+                # Клиент добавлен заново - удаление, случившееся раньше, больше не в счет
+                self._removed_while_verifying.discard(uuid)
+            self._spawn_background(self._verify_provision(uuids, inbound_id, port, protocol))
+            return True, None
+        
+        config, _ = await self._after_client_added(inbound_id, port, protocol, immediate=True)
+        return True, config
+    
+    def _note_removed(self, uuid: str):
+        """Клиент удален: если его добавление еще проверяется в фоне, отсутствие не ошибка"""
+        if uuid in self._verifying:
+            self._removed_while_verifying.add(uuid)
+    
+    async def _verify_provision(self, uuids: List[str], inbound_id: int, port: int = None, protocol: str = None):
+        """Фоновый перезапуск Xray и проверка добавленных клиентов
+        
+        Клиенты помечаются в _verifying до запуска задачи (см. _finish_clients_added)
+        и снимаются с отметки здесь по завершении проверки.
+        """
+        try:
+            if not settings.X3UI_VERIFY_PROVISION:
+                if not await self.schedule_restart():
+                    metrics.inc("x3ui_provision_restart_failed")
+                return
+            
+            try:
+                started = time.monotonic()
+                _, problems = await self._after_client_added(inbound_id, port, protocol, uuids=uuids)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка фоновой проверки клиентов {uuids}: {e}")
+                problems = [f"ошибка проверки: {e}"]
+                started = None
+            
+            if not problems:
+                metrics.inc("x3ui_provision_verified", len(uuids))
+                logger.info(f"✅ Фоновая проверка клиентов ({len(uuids)} шт.) пройдена за {time.monotonic() - started:.1f}с")
+                return
+            
+            metrics.inc("x3ui_provision_verify_failed", len(uuids))
+            logger.error(f"❌ Фоновая проверка клиентов {uuids} не пройдена: {'; '.join(problems)}")
+            await notify_admins(
+                f"⚠️ Проверка после добавления клиентов не пройдена\n\n"
+                f"UUID: {', '.join(uuids)}\n"
+                f"Inbound: {inbound_id}\n"
+                f"Проблемы:\n" + "\n".join(f"- {p}" for p in problems)
+            )
+        finally:
+            for uuid in uuids:
+                self._verifying[uuid] -= 1
+                if not self._verifying[uuid]:
+                    del self._verifying[uuid]
+                    self._removed_while_verifying.discard(uuid)
+    
+    @staticmethod
+    def _build_client(uuid: str, email: str) -> Dict:
+        """Описание нового клиента в формате 3x-ui"""
+        return {
+            "id": uuid,
+            "email": email,
+            "enable": True,
+            "expiryTime": 0,
+            "limitIp": 0,
+            "totalGB": 0,
+            "flow": "",  # Для VLESS
+            "tgId": "",
+            "subId": ""
+        }
+    
+    async def _client_exists(self, uuid: str, inbound_id: int) -> bool:
+        """Проверка наличия клиента в inbound по свежим данным панели (для разбора ошибок записи)"""
+        index = await self.get_client_index(inbound_id, force_refresh=True)
+        return index is not None and uuid in index
+    
+    async def _call_client_endpoint(self, capability: str, inbound_id: int, clients: List[Dict] = None, **path_params) -> Optional[Dict]:
+        """Вызов клиентского endpoint 3x-ui (addClient/updateClient/delClient)
+        
+        Тело запроса содержит только изменяемых клиентов, а не весь inbound
+        (addClient принимает сразу несколько клиентов).
+        
+        Returns:
+            Ответ панели или None (если панель не поддерживает endpoint, см. is_endpoint_supported)
+        """
+        payload = None
+        if clients is not None:
+            payload = {
+                "id": inbound_id,
+                "settings": json_dumps({"clients": clients})
+            }
+        return await self._call_endpoint(capability, payload, inbound_id=inbound_id, **path_params)
+    
     async def add_client(self, uuid: str, email: str = None, inbound_id: int = None) -> tuple[bool, Optional[Dict]]:
         """Добавление клиента в inbound
         
+        Используется клиентский endpoint addClient (передается только новый клиент).
+        Если панель его не поддерживает, inbound перезаписывается целиком.
+        
         Returns:
             tuple: (success: bool, config: Optional[Dict]) - успех операции и полная конфигурация Xray
+                (в режиме X3UI_FAST_PROVISION конфигурация не загружается и равна None)
+        """
+        results = await self.add_clients([(uuid, email)], inbound_id)
+        return results.get(uuid, (False, None))
+    
+    async def add_clients(
+        self, entries: List[Tuple[str, Optional[str]]], inbound_id: int = None, restart: bool = True
+    ) -> Dict[str, Tuple[bool, Optional[Dict]]]:
+        """Добавление нескольких клиентов одним запросом к панели
+        
+        Все клиенты передаются одним вызовом addClient (или одной перезаписью inbound,
+        если панель не поддерживает addClient), после чего Xray перезапускается один раз.
+        Уже существующие клиенты и занятые email отсеиваются по индексу клиентов до запроса.
+        
+        Args:
+            entries: список (uuid, email); email может быть None
+            restart: False - без перезапуска Xray (клиенты уже добавлены через gRPC API Xray)
+        
+        Returns:
+            dict: uuid -> (success, config) для каждого клиента
         """
         inbound_id = inbound_id or self.inbound_id
+        clients = [self._build_client(uuid, email or f"user_{uuid[:8]}") for uuid, email in entries]
+        results: Dict[str, Tuple[bool, Optional[Dict]]] = {}
+        
+        try:
+            # Проверка по индексу: без перебора списка клиентов и без заведомо отклоняемых запросов
+            index = await self.get_client_index(inbound_id)
+            if index is not None:
+                pending = []
+                for client in clients:
+                    if client["id"] in index:
+                        logger.info(f"Пользователь {client['id']} уже существует в 3x-ui")
+                        results[client["id"]] = (True, None)
+                    elif index.email_taken(client["email"], client["id"]):
+                        logger.error(f"Email {client['email']} уже занят другим клиентом в 3x-ui")
+                        results[client["id"]] = (False, None)
+                    else:
+                        pending.append(client)
+                clients = pending
+                
+                if not settings.X3UI_FAST_PROVISION and any(ok for ok, _ in results.values()):
+                    config = await self.get_xray_config()
+                    results = {uuid: (ok, config if ok else None) for uuid, (ok, _) in results.items()}
+            
+            if clients:
+                results.update(await self._add_new_clients(clients, inbound_id, restart))
+            return results
+        except Exception as e:
+            logger.error(f"Ошибка добавления клиента в 3x-ui: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            return {client["id"]: results.get(client["id"], (False, None)) for client in clients}
+    
+    async def _add_new_clients(self, clients: List[Dict], inbound_id: int, restart: bool = True) -> Dict[str, Tuple[bool, Optional[Dict]]]:
+        """Отправка новых клиентов в панель (addClient или перезапись inbound)"""
+        uuids = [client["id"] for client in clients]
+        
+        def for_all(outcome: Tuple[bool, Optional[Dict]]) -> Dict[str, Tuple[bool, Optional[Dict]]]:
+            return {uuid: outcome for uuid in uuids}
+        
+        if self.is_endpoint_supported("client_add") is not False:
+            result = await self._call_client_endpoint("client_add", inbound_id, clients)
+            if result and result.get("success"):
+                logger.info(f"✅ Пользователи добавлены в 3x-ui через addClient: {len(uuids)} шт.")
+                return for_all(await self._finish_clients_added(clients, inbound_id, restart=restart))
+            
+            if result:
+                # Панель отклонила добавление (например, клиент или email уже существует)
+                logger.warning(f"⚠️ addClient отклонен для {len(uuids)} клиентов: {result.get('msg', result)}")
+                if len(clients) > 1:
+                    # 3x-ui отклоняет весь пакет из-за одного клиента - добавляем по одному
+                    results = {}
+                    for client in clients:
+                        results.update(await self._add_new_clients([client], inbound_id, restart))
+                    return results
+                
+                uuid = uuids[0]
+                if await self._client_exists(uuid, inbound_id):
+                    logger.info(f"Пользователь {uuid} уже существует в 3x-ui")
+                    if settings.X3UI_FAST_PROVISION:
+                        return for_all((True, None))
+                    return for_all((True, await self.get_xray_config()))
+                return for_all((False, None))
+            
+            if self.is_endpoint_supported("client_add") is not False:
+                logger.error(f"Ошибка добавления пользователей {uuids} в 3x-ui через addClient")
+                return for_all((False, None))
         
-        if not email:
-            email = f"user_{uuid[:8]}"
+        logger.info("Панель не поддерживает addClient, обновляем inbound целиком")
+        return for_all(await self._add_clients_via_inbound_update(clients, inbound_id, restart))
+    
+    async def update_client(self, uuid: str, client: Dict, inbound_id: int = None) -> bool:
+        """Обновление параметров клиента (email, enable, expiryTime и т.д.)
+        
+        Args:
+            client: полное описание клиента в формате 3x-ui (id должен совпадать с uuid)
+        """
+        inbound_id = inbound_id or self.inbound_id
+        client = dict(client, id=uuid)
         
         try:
-            # Получаем текущий inbound
-            inbound = await self.get_inbound(inbound_id)
+            if self.is_endpoint_supported("client_update") is not False:
+                result = await self._call_client_endpoint("client_update", inbound_id, [client], client_id=uuid)
+                if result is not None or self.is_endpoint_supported("client_update") is not False:
+                    if result and result.get("success"):
+                        logger.info(f"✅ Клиент {uuid} обновлен в 3x-ui через updateClient")
+                        index = self._client_indexes.get(inbound_id)
+                        if index is not None:
+                            index.update(client)
+                        self.invalidate_snapshot()
+                        return True
+                    logger.error(f"Ошибка обновления клиента {uuid} в 3x-ui: {result}")
+                    return False
+            
+            logger.info("Панель не поддерживает updateClient, обновляем inbound целиком")
+            return await self._rewrite_inbound_clients(
+                inbound_id,
+                lambda clients: [client if c.get("id") == uuid else c for c in clients]
+            )
+        except Exception as e:
+            logger.error(f"Ошибка обновления клиента в 3x-ui: {e}")
+            return False
+    
+    async def remove_client(self, uuid: str, inbound_id: int = None) -> bool:
+        """Удаление клиента из inbound
+        
+        Используется клиентский endpoint delClient. Если панель его не поддерживает,
+        inbound перезаписывается целиком без этого клиента.
+        """
+        results = await self.remove_clients([uuid], inbound_id)
+        return results.get(uuid, False)
+    
+    async def remove_clients(self, uuids: List[str], inbound_id: int = None, restart: bool = True) -> Dict[str, bool]:
+        """Удаление нескольких клиентов с одним перезапуском Xray
+        
+        delClient удаляет по одному клиенту, поэтому запросы идут последовательно
+        по общему соединению; без delClient все клиенты удаляются одной перезаписью inbound.
+        restart=False - без перезапуска Xray (клиенты уже удалены через gRPC API Xray).
+        
+        Returns:
+            dict: uuid -> успех удаления
+        """
+        inbound_id = inbound_id or self.inbound_id
+        results: Dict[str, bool] = {}
+        removed = False
+        
+        try:
+            if self.is_endpoint_supported("client_delete") is not False:
+                for uuid in uuids:
+                    result = await self._call_client_endpoint("client_delete", inbound_id, client_id=uuid)
+                    if result and result.get("success"):
+                        logger.info(f"✅ Пользователь {uuid} успешно удален из 3x-ui через delClient")
+                        index = self._client_indexes.get(inbound_id)
+                        if index is not None:
+                            index.remove(uuid)
+                        self._note_removed(uuid)
+                        results[uuid] = True
+                        removed = True
+                    elif result:
+                        if not await self._client_exists(uuid, inbound_id):
+                            logger.warning(f"Пользователь {uuid} не найден в 3x-ui")
+                            results[uuid] = True
+                        else:
+                            logger.error(f"Ошибка удаления пользователя из 3x-ui: {result}")
+                            results[uuid] = False
+                    elif self.is_endpoint_supported("client_delete") is not False:
+                        logger.error(f"Ошибка удаления пользователя {uuid} из 3x-ui через delClient")
+                        results[uuid] = False
+                    else:
+                        # Панель не поддерживает delClient - оставшихся удаляем перезаписью inbound
+                        break
+            
+            remaining = [uuid for uuid in uuids if uuid not in results]
+            if remaining:
+                logger.info("Панель не поддерживает delClient, обновляем inbound целиком")
+                remaining_set = set(remaining)
+                found_uuids = set()
+                
+                def without_clients(clients):
+                    kept = [c for c in clients if c.get("id") not in remaining_set]
+                    found_uuids.update(c.get("id") for c in clients if c.get("id") in remaining_set)
+                    return kept if found_uuids else None
+                
+                success = await self._rewrite_inbound_clients(inbound_id, without_clients)
+                for uuid in remaining:
+                    results[uuid] = success
+                    if not success:
+                        logger.error(f"Ошибка удаления пользователя {uuid} из 3x-ui")
+                    elif uuid in found_uuids:
+                        self._note_removed(uuid)
+                        logger.info(f"✅ Пользователь {uuid} успешно удален из 3x-ui")
+                    else:
+                        logger.warning(f"Пользователь {uuid} не найден в 3x-ui")
+                removed = removed or (success and bool(found_uuids))
+            
+            if removed:
+                self.invalidate_snapshot()
+                # Перезапускаем Xray через API (отложенно, один раз на несколько пакетов)
+                if restart:
+                    self.schedule_restart()
+            return results
+        except Exception as e:
+            logger.error(f"Ошибка удаления клиента из 3x-ui: {e}")
+            return {uuid: results.get(uuid, False) for uuid in uuids}
+    
+    async def _add_clients_via_inbound_update(self, new_clients: List[Dict], inbound_id: int, restart: bool = True) -> tuple[bool, Optional[Dict]]:
+        """Добавление клиентов одной перезаписью всего inbound (для панелей без addClient)
+        
+        Returns:
+            tuple: (success: bool, config: Optional[Dict]) - успех операции и полная конфигурация Xray
+        """
+        try:
+            # Получаем текущий inbound (свежий - он будет перезаписан целиком)
+            inbound = await self.get_inbound(inbound_id, force_refresh=True)
             if not inbound:
                 logger.error(f"Inbound {inbound_id} не найден в 3x-ui")
                 return False, None
             
-            # Получаем список клиентов
-            # settings может быть строкой JSON или словарем
-            inbound_settings = inbound.get("settings", {})
-            if isinstance(inbound_settings, str):
-                import json
-                inbound_settings = json.loads(inbound_settings)
-            elif not isinstance(inbound_settings, dict):
-                inbound_settings = {}
-            
+            # Получаем список клиентов (копия разобранного settings - разбор общий для снимка)
+            inbound_settings = inbound_codec.copy_field(inbound, "settings")
             clients = inbound_settings.get("clients", [])
             
-            # Проверяем, нет ли уже такого клиента
-            if any(c.get("id") == uuid for c in clients):
-                logger.info(f"Пользователь {uuid} уже существует в 3x-ui")
+            # Проверяем, нет ли уже таких клиентов
+            existing_ids = {c.get("id") for c in clients}
+            for client in new_clients:
+                if client["id"] in existing_ids:
+                    logger.info(f"Пользователь {client['id']} уже существует в 3x-ui")
+            new_clients = [client for client in new_clients if client["id"] not in existing_ids]
+            uuids = [client["id"] for client in new_clients]
+            if not new_clients:
+                if settings.X3UI_FAST_PROVISION:
+                    return True, None
                 # Возвращаем текущую конфигурацию
                 config = await self.get_xray_config()
                 return True, config
             
-            # Добавляем нового клиента
-            new_client = {
-                "id": uuid,
-                "email": email,
-                "enable": True,
-                "expiryTime": 0,
-                "limitIp": 0,
-                "totalGB": 0,
-                "flow": "",  # Для VLESS
-                "tgId": "",
-                "subId": ""
-            }
-            
-            clients.append(new_client)
+            # Добавляем новых клиентов
+            clients.extend(new_clients)
             
             # Обновляем inbound settings
             inbound_settings["clients"] = clients
             inbound["settings"] = inbound_settings
             
-            # Отправляем обновление
-            # Пробуем разные варианты endpoint для обновления
-            # Пользователь нашел через DevTools: POST /panel/api/inbounds/add (для добавления нового inbound)
-            # Для обновления существующего inbound может быть: POST /panel/api/inbounds/update/{id}
-            update_endpoints = [
-                f"/panel/api/inbounds/update/{inbound_id}",  # С 's' в конце (найден через DevTools)
-                f"/panel/api/inbound/update/{inbound_id}",   # Без 's' (старый вариант)
-            ]
-            
             # Подготавливаем данные для обновления
             # API 3x-ui ожидает settings, streamSettings и sniffing как строки JSON, а не объекты!
             # Поэтому сериализуем их обратно в строки
@@ -476,7 +1496,7 @@ class X3UIService:
                 original_stream_settings_str = stream_settings
                 # Парсим только для проверки и логирования
                 try:
-                    stream_settings = json.loads(stream_settings)
+                    stream_settings = inbound_codec.decode(stream_settings)
                     logger.debug(f"✅ streamSettings распарсен из строки, размер: {len(original_stream_settings_str)} символов")
                 except Exception as e:
                     logger.warning(f"⚠️ Не удалось распарсить streamSettings как JSON: {e}")
@@ -485,7 +1505,7 @@ class X3UIService:
                     stream_settings = {}
             else:
                 # Если объект, сериализуем для проверки
-                original_stream_settings_str = json.dumps(stream_settings, ensure_ascii=False)
+                original_stream_settings_str = json_dumps(stream_settings)
                 logger.debug(f"✅ streamSettings уже объект, размер после сериализации: {len(original_stream_settings_str)} символов")
             
             # Проверяем, что streamSettings содержит все необходимые параметры Reality
@@ -537,7 +1557,7 @@ class X3UIService:
                 logger.info(f"✅ Используем оригинальную строку streamSettings (размер: {len(stream_settings_str)} символов)")
             else:
                 # Если не было оригинальной строки или парсинг не удался, сериализуем объект
-                stream_settings_str = json.dumps(stream_settings, ensure_ascii=False) if stream_settings else "{}"
+                stream_settings_str = json_dumps(stream_settings) if stream_settings else "{}"
                 logger.info(f"✅ Сериализован streamSettings из объекта (размер: {len(stream_settings_str)} символов)")
             
             # Проверяем, что в строке есть все необходимые параметры Reality
@@ -566,10 +1586,10 @@ class X3UIService:
                 sniffing_str = sniffing
             else:
                 # Если объект, сериализуем в строку
-                sniffing_str = json.dumps(sniffing) if sniffing else "{}"
+                sniffing_str = json_dumps(sniffing) if sniffing else "{}"
             
-            # settings также должен быть строкой JSON
-            settings_str = json.dumps(inbound_settings)
+            # settings также должен быть строкой JSON (единственное измененное поле)
+            settings_str = json_dumps(inbound_settings)
             
             # Собираем все поля inbound для обновления
             # ВАЖНО: Сохраняем ВСЕ поля из исходного inbound, чтобы не потерять параметры Reality
@@ -604,184 +1624,129 @@ class X3UIService:
             logger.debug(f"   - streamSettings содержит 'reality': {'reality' in stream_settings_str.lower()}")
             logger.debug(f"   - streamSettings содержит 'security': {'security' in stream_settings_str.lower()}")
             
-            result = None
-            for endpoint in update_endpoints:
-                result = await self._make_request("POST", endpoint, update_data)
-                if result and result.get("success"):
-                    logger.info(f"✅ Обновление выполнено через {endpoint}")
-                    break
-                elif result:
-                    logger.debug(f"Результат {endpoint}: {result}")
+            # Путь обновления inbound различается между версиями 3x-ui (результат поиска кэшируется)
+            result = await self._call_endpoint("inbound_update", update_data, inbound_id=inbound_id)
+            if result and not result.get("success"):
+                logger.debug(f"Результат обновления inbound {inbound_id}: {result}")
             
             if result and result.get("success"):
-                logger.info(f"✅ Пользователь {uuid} успешно добавлен в 3x-ui")
-                # Перезапускаем Xray через API
-                await self.restart_xray()
-                # Ждем немного, чтобы Xray успел перезагрузить конфигурацию
-                import asyncio
-                await asyncio.sleep(2)
-                # Получаем обновленную конфигурацию
-                config = await self.get_xray_config()
-                
-                # Проверяем, что параметры Reality сохранились после обновления
-                if config:
-                    # Ищем наш inbound в конфигурации
-                    for inbound in config.get("inbounds", []):
-                        if inbound.get("port") == update_data.get("port") and inbound.get("protocol") == update_data.get("protocol"):
-                            updated_stream_settings = inbound.get("streamSettings", {})
-                            if isinstance(updated_stream_settings, str):
-                                try:
-                                    updated_stream_settings = json.loads(updated_stream_settings)
-                                except:
-                                    pass
-                            
-                            updated_security = updated_stream_settings.get("security", "")
-                            updated_reality = updated_stream_settings.get("realitySettings", {})
-                            
-                            logger.info(f"🔍 Проверка параметров Reality после обновления:")
-                            logger.info(f"   - security: {updated_security}")
-                            logger.info(f"   - realitySettings присутствует: {bool(updated_reality)}")
-                            if updated_reality:
-                                logger.info(f"   - serverNames: {updated_reality.get('serverNames', [])}")
-                                logger.info(f"   - shortIds: {updated_reality.get('shortIds', [])}")
-                                # На сервере используется privateKey, а не publicKey
-                                has_private_key = bool(updated_reality.get("privateKey"))
-                                has_public_key = bool(updated_reality.get("publicKey"))
-                                has_mldsa65_seed = bool(updated_reality.get("mldsa65Seed"))
-                                logger.info(f"   - privateKey присутствует: {has_private_key}")
-                                logger.info(f"   - publicKey присутствует: {has_public_key}")
-                                logger.info(f"   - mldsa65Seed присутствует: {has_mldsa65_seed}")
-                            
-                            # Предупреждение, если параметры Reality потеряны
-                            if updated_security == "reality" and not updated_reality:
-                                logger.error("❌ ВНИМАНИЕ: security=reality, но realitySettings отсутствует после обновления!")
-                            elif updated_security == "reality" and updated_reality:
-                                # Проверяем наличие обязательных параметров
-                                has_key = bool(updated_reality.get("privateKey") or updated_reality.get("publicKey") or updated_reality.get("mldsa65Seed"))
-                                has_short_ids = bool(updated_reality.get("shortIds"))
-                                has_server_names = bool(updated_reality.get("serverNames"))
-                                
-                                if not has_key or not has_short_ids or not has_server_names:
-                                    logger.error("❌ ВНИМАНИЕ: realitySettings неполный после обновления!")
-                                    logger.error(f"   - ключ (privateKey/publicKey/mldsa65Seed): {has_key}")
-                                    logger.error(f"   - shortIds: {has_short_ids}")
-                                    logger.error(f"   - serverNames: {has_server_names}")
-                                else:
-                                    logger.info("✅ Параметры Reality успешно сохранены")
-                            break
-                
-                return True, config
+                logger.info(f"✅ Пользователи {uuids} успешно добавлены в 3x-ui")
+                return await self._finish_clients_added(
+                    new_clients, inbound_id, update_data.get("port"), update_data.get("protocol"), restart
+                )
             else:
                 logger.error(f"Ошибка добавления пользователя в 3x-ui: {result}")
                 return False, None
-                
+        
         except Exception as e:
             logger.error(f"Ошибка добавления клиента в 3x-ui: {e}")
             import traceback
             logger.error(traceback.format_exc())
             return False, None
     
-    async def remove_client(self, uuid: str, inbound_id: int = None) -> bool:
-        """Удаление клиента из inbound"""
-        inbound_id = inbound_id or self.inbound_id
+    async def _rewrite_inbound_clients(self, inbound_id: int, transform) -> bool:
+        """Перезапись списка клиентов inbound целиком (для панелей без клиентских endpoints)
         
-        try:
-            # Получаем текущий inbound
-            inbound = await self.get_inbound(inbound_id)
-            if not inbound:
-                logger.error(f"Inbound {inbound_id} не найден в 3x-ui")
-                return False
-            
-            # Удаляем клиента
-            clients = inbound.get("settings", {}).get("clients", [])
-            initial_count = len(clients)
-            clients = [c for c in clients if c.get("id") != uuid]
-            
-            if len(clients) == initial_count:
-                logger.warning(f"Пользователь {uuid} не найден в 3x-ui")
-                return True
-            
-            # Обновляем inbound settings
-            inbound_settings = inbound.get("settings", {})
-            if isinstance(inbound_settings, str):
-                import json
-                inbound_settings = json.loads(inbound_settings)
-            elif not isinstance(inbound_settings, dict):
-                inbound_settings = {}
-            
-            inbound_settings["clients"] = clients
-            
-            # Сериализуем settings, streamSettings и sniffing в строки JSON (как в add_client)
-            settings_str = json.dumps(inbound_settings)
-            
-            stream_settings = inbound.get("streamSettings", {})
-            if isinstance(stream_settings, str):
-                stream_settings_str = stream_settings
-            else:
-                stream_settings_str = json.dumps(stream_settings) if stream_settings else "{}"
-            
-            sniffing = inbound.get("sniffing", {})
-            if isinstance(sniffing, str):
-                sniffing_str = sniffing
-            else:
-                sniffing_str = json.dumps(sniffing) if sniffing else "{}"
-            
-            # Подготавливаем данные для обновления
-            update_data = {
-                "id": inbound_id,
-                "settings": settings_str,  # Строка JSON!
-                "streamSettings": stream_settings_str,  # Строка JSON!
-                "sniffing": sniffing_str,  # Строка JSON!
-                "tag": inbound.get("tag", ""),
-                "protocol": inbound.get("protocol", "vmess"),
-                "port": inbound.get("port", 443),
-                "listen": inbound.get("listen", ""),
-                "remark": inbound.get("remark", ""),
-                "enable": inbound.get("enable", True),  # Важно: сохраняем статус включения inbound
-                "expiryTime": inbound.get("expiryTime", 0),
-                "clientStats": inbound.get("clientStats", []),
-                "up": inbound.get("up", 0),
-                "down": inbound.get("down", 0),
-                "total": inbound.get("total", 0)
-            }
-            
-            # Отправляем обновление
-            result = await self._make_request("POST", f"/panel/api/inbound/update/{inbound_id}", update_data)
-            
-            if result and result.get("success"):
-                logger.info(f"✅ Пользователь {uuid} успешно удален из 3x-ui")
-                # Перезапускаем Xray через API
-                await self.restart_xray()
-                return True
-            else:
-                logger.error(f"Ошибка удаления пользователя из 3x-ui: {result}")
-                return False
-                
-        except Exception as e:
-            logger.error(f"Ошибка удаления клиента из 3x-ui: {e}")
+        Args:
+            transform: функция, получающая текущий список клиентов и возвращающая новый
+                (или None, если изменений нет - тогда inbound не отправляется)
+        """
+        # Получаем текущий inbound (свежий - он будет перезаписан целиком)
+        inbound = await self.get_inbound(inbound_id, force_refresh=True)
+        if not inbound:
+            logger.error(f"Inbound {inbound_id} не найден в 3x-ui")
             return False
+        
+        # settings может быть строкой JSON или словарем (копия - разбор общий для снимка)
+        inbound_settings = inbound_codec.copy_field(inbound, "settings")
+        
+        clients = transform(inbound_settings.get("clients", []))
+        if clients is None:
+            return True
+        inbound_settings["clients"] = clients
+        
+        # Сериализуется только измененный settings; streamSettings и sniffing уходят исходными строками
+        settings_str = json_dumps(inbound_settings)
+        stream_settings_str = inbound_codec.encode_field(inbound.get("streamSettings"))
+        sniffing_str = inbound_codec.encode_field(inbound.get("sniffing"))
+        
+        # Подготавливаем данные для обновления
+        update_data = {
+            "id": inbound_id,
+            "settings": settings_str,  # Строка JSON!
+            "streamSettings": stream_settings_str,  # Строка JSON!
+            "sniffing": sniffing_str,  # Строка JSON!
+            "tag": inbound.get("tag", ""),
+            "protocol": inbound.get("protocol", "vmess"),
+            "port": inbound.get("port", 443),
+            "listen": inbound.get("listen", ""),
+            "remark": inbound.get("remark", ""),
+            "enable": inbound.get("enable", True),  # Важно: сохраняем статус включения inbound
+            "expiryTime": inbound.get("expiryTime", 0),
+            "clientStats": inbound.get("clientStats", []),
+            "up": inbound.get("up", 0),
+            "down": inbound.get("down", 0),
+            "total": inbound.get("total", 0)
+        }
+        
+        # Отправляем обновление
+        result = await self._call_endpoint("inbound_update", update_data, inbound_id=inbound_id)
+        if result and result.get("success"):
+            # Индекс отражает записанный список клиентов до следующего обновления снимка
+            self._client_indexes[inbound_id] = ClientIndex(clients, source=self._snapshot)
+            self.invalidate_snapshot()
+            return True
+        
+        logger.error(f"Ошибка обновления inbound {inbound_id} в 3x-ui: {result}")
+        return False
+    
+    def schedule_restart(self) -> asyncio.Future:
+        """Запланировать перезапуск Xray панели (см. RestartScheduler)
+        
+        Returns:
+            Future с результатом перезапуска; ждать его не обязательно
+        """
+        return restart_scheduler.request(*self._restart_target())
+    
+    async def restart_now(self) -> bool:
+        """Перезапуск Xray панели сразу (вместе с уже запланированными изменениями)"""
+        return await restart_scheduler.run_now(*self._restart_target())
+    
+    def _restart_target(self) -> Tuple[str, Callable[[], Awaitable[bool]], str]:
+        """Узел, корутина перезапуска и имя панели для RestartScheduler"""
+        # У всех inbounds панели один Xray - ключ узла без inbound_id
+        return f"3x-ui {self._panel_key}", self.restart_xray, f"3x-ui {self.name}"
+    
+    def add_restart_hook(self, hook: Callable[[], Awaitable]):
+        """Корутина, выполняемая перед каждым перезапуском Xray панели
+        
+        Нужна для изменений, сделанных только в работающем Xray (gRPC API Xray):
+        до перезапуска их нужно записать в панель, иначе перезапуск их потеряет.
+        """
+        hooks = self._restart_hooks.setdefault(self._panel_key, [])
+        if hook not in hooks:
+            hooks.append(hook)
     
     async def restart_xray(self) -> bool:
         """Перезапуск Xray через API 3x-ui"""
+        for hook in self._restart_hooks.get(self._panel_key, []):
+            try:
+                await hook()
+            except Exception as e:
+                logger.error(f"Ошибка подготовки к перезапуску Xray {self.name}: {e}")
+        
         try:
-            # Пробуем разные варианты endpoint для перезапуска Xray
-            endpoints = [
-                "/panel/api/inbounds/restartAll",  # Перезапуск всех inbounds
-                "/panel/api/xray/restart",  # Старый вариант
-                "/xui/api/xray/restart",  # Альтернативный вариант
-                "/api/xray/restart"  # Еще один вариант
-            ]
-            
-            for endpoint in endpoints:
-                result = await self._make_request("POST", endpoint)
-                if result and result.get("success"):
-                    logger.info(f"✅ Xray успешно перезапущен через {endpoint}")
-                    return True
-                elif result:
-                    logger.debug(f"Результат {endpoint}: {result}")
+            # Путь перезапуска различается между версиями 3x-ui (результат поиска кэшируется)
+            result = await self._call_endpoint("restart")
+            if result and result.get("success"):
+                logger.info(f"✅ Xray успешно перезапущен")
+                return True
+            elif result:
+                logger.debug(f"Результат перезапуска Xray: {result}")
             
             # Если ни один endpoint не сработал, выводим предупреждение
-            logger.warning(f"⚠️ Не удалось перезапустить Xray через API. Попробованы endpoints: {endpoints}")
+            candidates = [path for _, path in self.ENDPOINT_CANDIDATES["restart"]]
+            logger.warning(f"⚠️ Не удалось перезапустить Xray через API. Попробованы endpoints: {candidates}")
             logger.warning("💡 Xray может перезапуститься автоматически при обновлении inbound, или перезапустите вручную через панель")
             return False
         except Exception as e:
@@ -795,11 +1760,10 @@ class X3UIService:
         try:
             result = await self._make_request("GET", f"/panel/api/inbound/clientIps/{uuid}")
             if result and result.get("success"):
-                # Получаем клиента из inbound
-                inbound = await self.get_inbound(inbound_id)
-                if inbound:
-                    clients = inbound.get("settings", {}).get("clients", [])
-                    client = next((c for c in clients if c.get("id") == uuid), None)
+                # Получаем клиента из индекса inbound
+                index = await self.get_client_index(inbound_id)
+                if index is not None:
+                    client = index.get(uuid)
                     if client:
                         # Генерируем ссылку vmess
                         # 3x-ui может вернуть готовую ссылку через другой endpoint
@@ -808,3 +1772,7 @@ class X3UIService:
         except Exception as e:
             logger.error(f"Ошибка получения ссылки клиента: {e}")
             return None
+
+
+# Создаем глобальный экземпляр (одна пулированная сессия на процесс)
+x3ui_service = X3UIService()
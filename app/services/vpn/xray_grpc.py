@@ -0,0 +1,351 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple, Union
+from loguru import logger
+from config.settings import settings
+from app.utils.metrics import metrics
+from app.utils.notify import notify_admins
+from app.services.vpn.x3ui_service import X3UIService
+
+# gRPC API Xray (опционально): без grpcio бэкенд недоступен и клиенты меняются через панель
+try:
+    import grpc
+    from grpc import aio as grpc_aio
+    
+    GRPC_AVAILABLE = True
+except ImportError:
+    grpc = None
+    grpc_aio = None
+    GRPC_AVAILABLE = False
+
+ALTER_INBOUND_METHOD = "/xray.app.proxyman.command.HandlerService/AlterInbound"
+ADD_USER_OPERATION = "xray.app.proxyman.command.AddUserOperation"
+REMOVE_USER_OPERATION = "xray.app.proxyman.command.RemoveUserOperation"
+ACCOUNT_TYPES = {
+    "vless": "xray.proxy.vless.Account",
+    "vmess": "xray.proxy.vmess.Account",
+}
+
+
+# ---------- Минимальное кодирование protobuf для HandlerService ----------
+# Сообщений всего несколько и они плоские, поэтому сгенерированный код
+# (protobuf, grpcio-tools) не нужен: поля кодируются вручную.
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _bytes_field(number: int, data: Union[str, bytes]) -> bytes:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return _varint(number << 3 | 2) + _varint(len(data)) + data
+
+
+def _uint_field(number: int, value: int) -> bytes:
+    return _varint(number << 3) + _varint(value) if value else b""
+
+
+def _typed_message(type_name: str, value: bytes) -> bytes:
+    """xray.common.serial.TypedMessage"""
+    return _bytes_field(1, type_name) + _bytes_field(2, value)
+
+
+def encode_add_user(tag: str, uuid: str, email: str, protocol: str = "vless", flow: str = "", level: int = 0) -> bytes:
+    """AlterInboundRequest с AddUserOperation"""
+    if protocol == "vless":
+        account = _bytes_field(1, uuid) + (_bytes_field(2, flow) if flow else b"") + _bytes_field(3, "none")
+    elif protocol == "vmess":
+        account = _bytes_field(1, uuid)
+    else:
+        raise ValueError(f"Протокол {protocol} не поддерживается gRPC API Xray")
+    user = _uint_field(1, level) + _bytes_field(2, email) + _bytes_field(3, _typed_message(ACCOUNT_TYPES[protocol], account))
+    operation = _typed_message(ADD_USER_OPERATION, _bytes_field(1, user))
+    return _bytes_field(1, tag) + _bytes_field(2, operation)
+
+
+def encode_remove_user(tag: str, email: str) -> bytes:
+    """AlterInboundRequest с RemoveUserOperation"""
+    operation = _typed_message(REMOVE_USER_OPERATION, _bytes_field(1, email))
+    return _bytes_field(1, tag) + _bytes_field(2, operation)
+
+
+def decode_message(data: bytes) -> Dict[int, List[Union[int, bytes]]]:
+    """Разбор сообщения protobuf: номер поля -> значения (varint или bytes)"""
+    fields: Dict[int, List[Union[int, bytes]]] = {}
+    position = 0
+    
+    def read_varint() -> int:
+        nonlocal position
+        result, shift = 0, 0
+        while True:
+            byte = data[position]
+            position += 1
+            result |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return result
+            shift += 7
+    
+    while position < len(data):
+        key = read_varint()
+        number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value = read_varint()
+        elif wire_type == 2:
+            length = read_varint()
+            value = data[position:position + length]
+            position += length
+        else:
+            raise ValueError(f"Неподдерживаемый тип поля protobuf: {wire_type}")
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+class XrayGrpcService:
+    """Изменение клиентов через gRPC API Xray (HandlerService.AlterInbound) без перезапуска
+    
+    Клиент добавляется в работающий Xray или удаляется из него сразу, активные
+    подключения остальных пользователей не рвутся. В панель 3x-ui изменения
+    записываются позже пакетом раз в XRAY_GRPC_PERSIST_INTERVAL секунд
+    (add_clients/remove_clients с restart=False) и перед каждым перезапуском Xray
+    панели (хук X3UIService.add_restart_hook), чтобы перезапуск их не потерял. Для каждого UUID сохраняется только последняя операция.
+    Изменение, которое панель не приняла XRAY_GRPC_PERSIST_MAX_ATTEMPTS раз подряд,
+    больше не повторяется: Xray и панель расходятся, админы получают уведомление.
+    """
+    
+    def __init__(self, address: str, inbound_tag: str, panel: X3UIService, protocol: str = "vless", name: str = None):
+        self.address = address
+        self.inbound_tag = inbound_tag
+        self.panel = panel
+        self.protocol = protocol.lower()
+        self.name = name or address
+        
+        self._channel = None
+        self._alter_inbound = None
+        self._flow: Optional[str] = None
+        # uuid -> (действие, email): изменения, еще не записанные в панель
+        self._pending: Dict[str, Tuple[str, Optional[str]]] = {}
+        # uuid -> неудачных попыток записи в панель подряд
+        self._failures: Dict[str, int] = {}
+        # uuid -> (действие, email): изменения, которые панель так и не приняла
+        self._diverged: Dict[str, Tuple[str, Optional[str]]] = {}
+        self._persist_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def is_available(self) -> bool:
+        return GRPC_AVAILABLE and self.protocol in ACCOUNT_TYPES
+    
+    @property
+    def pending_count(self) -> int:
+        """Изменений, еще не записанных в панель"""
+        return len(self._pending)
+    
+    @property
+    def diverged(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        """Изменения, которые есть в Xray, но не записаны в панель (повторы записи прекращены)"""
+        return dict(self._diverged)
+    
+    def _track(self, uuid: str, action: str, email: Optional[str]):
+        """Новая операция клиента: счетчик неудачных записей в панель начинается заново"""
+        self._failures.pop(uuid, None)
+        self._diverged.pop(uuid, None)
+        self._pending[uuid] = (action, email)
+    
+    def _stub(self):
+        if self._channel is None:
+            self._channel = grpc_aio.insecure_channel(self.address)
+            # Сериализаторы не указаны: запросы и ответы передаются как bytes
+            self._alter_inbound = self._channel.unary_unary(ALTER_INBOUND_METHOD)
+        return self._alter_inbound
+    
+    async def _alter(self, request: bytes) -> Optional[str]:
+        """Вызов AlterInbound
+        
+        Returns:
+            None при успехе или текст ошибки Xray (например, "User ... already exists.")
+        
+        Raises:
+            grpc.aio.AioRpcError: Xray недоступен или вызов не прошел по таймауту
+        """
+        try:
+            await self._stub()(request, timeout=settings.XRAY_GRPC_TIMEOUT)
+            return None
+        except grpc_aio.AioRpcError as e:
+            if e.code() in (grpc.StatusCode.UNKNOWN, grpc.StatusCode.INVALID_ARGUMENT, grpc.StatusCode.NOT_FOUND,
+                            grpc.StatusCode.ALREADY_EXISTS):
+                return e.details() or str(e.code())
+            raise
+    
+    @staticmethod
+    def _describe(error: Exception) -> str:
+        if grpc_aio is not None and isinstance(error, grpc_aio.AioRpcError):
+            return f"{error.code().name}: {error.details()}"
+        return str(error) or type(error).__name__
+    
+    async def _default_flow(self) -> str:
+        """flow для новых VLESS-клиентов: как у существующих клиентов inbound"""
+        if self._flow is None:
+            index = await self.panel.get_client_index()
+            if index is None:
+                return ""
+            self._flow = next((c.get("flow") for c in index.clients() if c.get("flow")), "")
+        return self._flow
+    
+    async def _email_for(self, uuid: str) -> str:
+        """Email клиента (Xray удаляет пользователей по email)"""
+        action, email = self._pending.get(uuid, (None, None))
+        if action == "add" and email:
+            return email
+        index = await self.panel.get_client_index()
+        client = index.get(uuid) if index is not None else None
+        if client and client.get("email"):
+            return client["email"]
+        return f"user_{uuid[:8]}"
+    
+    async def add_client(self, uuid: str, email: str = None) -> Tuple[bool, Optional[Dict]]:
+        """Добавление клиента в работающий Xray (аналог X3UIService.add_client)
+        
+        Returns:
+            tuple: (success, None) - конфигурация Xray не загружается
+        """
+        email = email or f"user_{uuid[:8]}"
+        try:
+            flow = await self._default_flow() if self.protocol == "vless" else ""
+            error = await self._alter(encode_add_user(self.inbound_tag, uuid, email, self.protocol, flow))
+        except Exception as e:
+            logger.error(f"Ошибка gRPC API Xray {self.name} при добавлении {uuid}: {self._describe(e)}")
+            metrics.inc("xray_grpc_errors")
+            return False, None
+        
+        if error and "already exists" not in error:
+            logger.error(f"Xray {self.name} отклонил добавление {uuid}: {error}")
+            return False, None
+        
+        if error:
+            logger.info(f"Пользователь {uuid} уже есть в Xray {self.name}")
+        else:
+            logger.info(f"⚡ Пользователь {uuid} добавлен в Xray {self.name} без перезапуска")
+            metrics.inc("xray_grpc_added")
+        self._track(uuid, "add", email)
+        return True, None
+    
+    async def remove_client(self, uuid: str) -> bool:
+        """Удаление клиента из работающего Xray (аналог X3UIService.remove_client)"""
+        try:
+            email = await self._email_for(uuid)
+            error = await self._alter(encode_remove_user(self.inbound_tag, email))
+        except Exception as e:
+            logger.error(f"Ошибка gRPC API Xray {self.name} при удалении {uuid}: {self._describe(e)}")
+            metrics.inc("xray_grpc_errors")
+            return False
+        
+        if error and "not found" not in error:
+            logger.error(f"Xray {self.name} отклонил удаление {uuid}: {error}")
+            return False
+        
+        if error:
+            logger.info(f"Пользователь {uuid} не найден в Xray {self.name}")
+        else:
+            logger.info(f"⚡ Пользователь {uuid} удален из Xray {self.name} без перезапуска")
+            metrics.inc("xray_grpc_removed")
+        self._track(uuid, "remove", None)
+        return True
+    
+    async def persist(self):
+        """Запись накопленных изменений в панель 3x-ui (без перезапуска Xray)"""
+        async with self._persist_lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            
+            adds = [(uuid, email) for uuid, (action, email) in pending.items() if action == "add"]
+            removes = [uuid for uuid, (action, _) in pending.items() if action == "remove"]
+            failed: List[str] = []
+            if adds:
+                results = await self.panel.add_clients(adds, restart=False)
+                failed += [uuid for uuid, _ in adds if not results.get(uuid, (False, None))[0]]
+            if removes:
+                results = await self.panel.remove_clients(removes, restart=False)
+                failed += [uuid for uuid in removes if not results.get(uuid)]
+            
+            for uuid in pending.keys() - set(failed):
+                self._failures.pop(uuid, None)
+            
+            # Неудачные повторяются в следующий раз, если за это время не пришла новая операция,
+            # но не больше XRAY_GRPC_PERSIST_MAX_ATTEMPTS раз
+            first_failed: List[str] = []
+            abandoned: List[str] = []
+            for uuid in failed:
+                if uuid in self._pending:
+                    continue
+                attempts = self._failures.get(uuid, 0) + 1
+                if attempts >= settings.XRAY_GRPC_PERSIST_MAX_ATTEMPTS:
+                    self._failures.pop(uuid, None)
+                    self._diverged[uuid] = pending[uuid]
+                    abandoned.append(uuid)
+                    continue
+                self._failures[uuid] = attempts
+                self._pending[uuid] = pending[uuid]
+                if attempts == 1:
+                    first_failed.append(uuid)
+            
+            saved = len(pending) - len(failed)
+            metrics.inc("xray_grpc_persisted", saved)
+            if failed:
+                metrics.inc("xray_grpc_persist_failed", len(failed))
+            if first_failed:
+                logger.warning(f"⚠️ Не удалось записать в панель {self.panel.name} изменения клиентов (будут повторены): {first_failed}")
+            if abandoned:
+                metrics.inc("xray_grpc_persist_abandoned", len(abandoned))
+                logger.error(
+                    f"❌ Панель {self.panel.name} не приняла изменения клиентов за "
+                    f"{settings.XRAY_GRPC_PERSIST_MAX_ATTEMPTS} попыток, Xray и панель расходятся: {abandoned}"
+                )
+                await notify_admins(
+                    f"⚠️ Панель {self.panel.name} не приняла изменения клиентов Xray {self.name} "
+                    f"за {settings.XRAY_GRPC_PERSIST_MAX_ATTEMPTS} попыток\n\n"
+                    + "\n".join(f"{pending[uuid][0]} {uuid}" for uuid in abandoned[:20])
+                    + (f"\n... и еще {len(abandoned) - 20}" if len(abandoned) > 20 else "")
+                    + "\n\nПосле перезапуска Xray возьмет клиентов из панели - проверьте их вручную"
+                )
+            logger.info(f"💾 Изменения клиентов Xray {self.name} записаны в панель: {saved} из {len(pending)}")
+    
+    def start(self):
+        """Запуск фоновой записи изменений в панель"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.XRAY_GRPC_PERSIST_INTERVAL)
+            try:
+                await self.persist()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка записи изменений клиентов в панель {self.panel.name}: {e}")
+    
+    async def close(self):
+        """Запись оставшихся изменений и закрытие канала"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.persist()
+        except Exception as e:
+            logger.error(f"Ошибка записи изменений клиентов в панель {self.panel.name}: {e}")
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = None
+            self._alter_inbound = None
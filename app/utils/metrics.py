@@ -0,0 +1,78 @@
+"""
+Простые метрики в памяти процесса (счетчики и гистограммы задержек)
+"""
+from bisect import bisect_left
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+
+class LatencyHistogram:
+    """Скользящая гистограмма задержек (последние window наблюдений)
+    
+    Хранит только последние замеры, поэтому распределение отражает текущее
+    состояние, а не среднее за все время работы бота.
+    """
+    
+    # Верхние границы корзин (миллисекунды)
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    
+    def __init__(self, window: int = 256):
+        self._samples: Deque[float] = deque(maxlen=window)
+    
+    def __len__(self) -> int:
+        return len(self._samples)
+    
+    def observe(self, latency: float):
+        """Учет задержки (секунды)"""
+        self._samples.append(latency * 1000)
+    
+    def percentile(self, q: float) -> Optional[float]:
+        """Перцентиль задержки в миллисекундах (q от 0 до 100); None, если замеров нет"""
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        position = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+        return ordered[position]
+    
+    def buckets(self) -> List[Tuple[str, int]]:
+        """Количество замеров по корзинам: [("<=5ms", n), ..., (">10000ms", n)]"""
+        counts = [0] * (len(self.BUCKETS_MS) + 1)
+        for sample in self._samples:
+            counts[bisect_left(self.BUCKETS_MS, sample)] += 1
+        labels = [f"<={bound}ms" for bound in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+        return list(zip(labels, counts))
+
+
+class Metrics:
+    """Счетчики событий для мониторинга (просматриваются админом и в логах)"""
+    
+    def __init__(self):
+        self._counters: Dict[str, int] = defaultdict(int)
+        self._histograms: Dict[str, LatencyHistogram] = {}
+    
+    def inc(self, name: str, value: int = 1):
+        """Увеличение счетчика"""
+        self._counters[name] += value
+    
+    def get(self, name: str) -> int:
+        """Текущее значение счетчика"""
+        return self._counters.get(name, 0)
+    
+    def snapshot(self) -> Dict[str, int]:
+        """Копия всех счетчиков"""
+        return dict(self._counters)
+    
+    def observe(self, name: str, latency: float):
+        """Учет задержки (секунды) в гистограмме name"""
+        self.histogram(name).observe(latency)
+    
+    def histogram(self, name: str) -> LatencyHistogram:
+        """Гистограмма задержек (создается при первом обращении)"""
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = LatencyHistogram()
+        return histogram
+
+
+# Создаем глобальный экземпляр
+metrics = Metrics()
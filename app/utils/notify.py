@@ -0,0 +1,20 @@
+from loguru import logger
+from config.settings import settings
+
+
+async def notify_admins(text: str, parse_mode: str = None):
+    """Отправка уведомления всем администраторам (ошибки отправки только логируются)"""
+    if not settings.ADMIN_IDS:
+        return
+    
+    try:
+        from app.bot.loader import bot
+    except Exception as e:
+        logger.error(f"Не удалось получить бота для уведомления админов: {e}")
+        return
+    
+    for admin_id in settings.ADMIN_IDS:
+        try:
+            await bot.send_message(admin_id, text, parse_mode=parse_mode)
+        except Exception as e:
+            logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
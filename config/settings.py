@@ -34,6 +34,11 @@ class Settings:
     VPS_USERNAME: str = os.getenv("VPS_USERNAME", "root")
     VPS_PASSWORD: str = os.getenv("VPS_PASSWORD", "")
     VPS_SSH_KEY_PATH: str = os.getenv("VPS_SSH_KEY_PATH", "")
+    SSH_EXECUTOR_WORKERS: int = int(os.getenv("SSH_EXECUTOR_WORKERS", "4"))  # Потоков для блокирующих операций SSH/SFTP/sqlite
+    SSH_KEEPALIVE_INTERVAL: int = int(os.getenv("SSH_KEEPALIVE_INTERVAL", "30"))  # Интервал keepalive постоянного SSH-подключения (секунды)
+    SSH_OPERATION_TIMEOUT: float = float(os.getenv("SSH_OPERATION_TIMEOUT", "30"))  # Таймаут одной операции SSH (секунды)
+    SSH_REMOTE_DB_EDIT: bool = os.getenv("SSH_REMOTE_DB_EDIT", "true").lower() == "true"  # Изменять x-ui.db на VPS через python3 вместо скачивания базы
+    SSH_LAYOUT_CACHE_TTL: int = int(os.getenv("SSH_LAYOUT_CACHE_TTL", "3600"))  # Время жизни кэша путей конфигурации Xray и x-ui.db на VPS (секунды)
     
     # 3x-ui API Settings (для работы через API)
     X3UI_API_URL: str = os.getenv("X3UI_API_URL", "http://148.253.213.153:2053")
@@ -41,5 +46,39 @@ class Settings:
     X3UI_PASSWORD: str = os.getenv("X3UI_PASSWORD", "admin")
     X3UI_INBOUND_ID: int = int(os.getenv("X3UI_INBOUND_ID", "1"))  # ID inbound в 3x-ui
     USE_X3UI_API: bool = os.getenv("USE_X3UI_API", "true").lower() == "true"  # Использовать 3x-ui API вместо SSH
+    X3UI_REQUEST_TIMEOUT: int = int(os.getenv("X3UI_REQUEST_TIMEOUT", "60"))  # Общий таймаут запроса (секунды)
+    X3UI_POOL_LIMIT: int = int(os.getenv("X3UI_POOL_LIMIT", "20"))  # Максимум соединений в пуле
+    X3UI_POOL_LIMIT_PER_HOST: int = int(os.getenv("X3UI_POOL_LIMIT_PER_HOST", "10"))  # Максимум соединений к одной панели
+    X3UI_KEEPALIVE_TIMEOUT: int = int(os.getenv("X3UI_KEEPALIVE_TIMEOUT", "60"))  # Время жизни простаивающего соединения (секунды)
+    X3UI_SESSION_TTL: int = int(os.getenv("X3UI_SESSION_TTL", "3600"))  # Срок сессии, если панель не указала Max-Age/Expires (секунды)
+    X3UI_SESSION_REFRESH_MARGIN: int = int(os.getenv("X3UI_SESSION_REFRESH_MARGIN", "60"))  # Перелогин заранее до истечения сессии (секунды)
+    X3UI_ENDPOINTS_CACHE_PATH: str = os.getenv("X3UI_ENDPOINTS_CACHE_PATH", "data/x3ui_endpoints.json")  # Кэш найденных путей API
+    X3UI_ENDPOINT_NEGATIVE_TTL: int = int(os.getenv("X3UI_ENDPOINT_NEGATIVE_TTL", "21600"))  # Сколько помнить, что панель не поддерживает endpoint (секунды)
+    X3UI_FAST_PROVISION: bool = os.getenv("X3UI_FAST_PROVISION", "true").lower() == "true"  # Возвращать ключ сразу после подтверждения панели
+    X3UI_VERIFY_PROVISION: bool = os.getenv("X3UI_VERIFY_PROVISION", "true").lower() == "true"  # Фоновая проверка клиента после быстрого добавления
+    X3UI_BATCH_WINDOW: float = float(os.getenv("X3UI_BATCH_WINDOW", "0.2"))  # Окно объединения изменений клиентов (секунды, 0 - без очереди)
+    X3UI_BATCH_MAX_SIZE: int = int(os.getenv("X3UI_BATCH_MAX_SIZE", "50"))  # Максимум операций в одном пакете
+    BULK_KEYS_BATCH_SIZE: int = int(os.getenv("BULK_KEYS_BATCH_SIZE", "500"))  # Клиентов в одном пакете массовой выдачи ключей (/bulk_keys)
+    X3UI_SNAPSHOT_TTL: int = int(os.getenv("X3UI_SNAPSHOT_TTL", "60"))  # Через сколько снимок inbounds обновляется в фоне (секунды)
+    X3UI_CODEC_CACHE_MB: int = int(os.getenv("X3UI_CODEC_CACHE_MB", "32"))  # Лимит кэша разбора полей inbounds (мегабайты строк JSON)
+    X3UI_BREAKER_FAILURES: int = int(os.getenv("X3UI_BREAKER_FAILURES", "5"))  # Ошибок подряд до открытия circuit breaker
+    X3UI_BREAKER_RECOVERY: float = float(os.getenv("X3UI_BREAKER_RECOVERY", "30"))  # Время отказа без попыток до пробного запроса (секунды)
+    X3UI_READ_TIMEOUT_MIN: float = float(os.getenv("X3UI_READ_TIMEOUT_MIN", "3"))  # Минимальный адаптивный таймаут чтения (секунды)
+    X3UI_READ_MIN_THROUGHPUT: int = int(os.getenv("X3UI_READ_MIN_THROUGHPUT", "1024"))  # Минимальная ожидаемая скорость загрузки ответа панели для таймаута чтения (КБ/с)
+    X3UI_READ_RETRIES: int = int(os.getenv("X3UI_READ_RETRIES", "2"))  # Повторы идемпотентных чтений
+    X3UI_RETRY_BASE_DELAY: float = float(os.getenv("X3UI_RETRY_BASE_DELAY", "0.2"))  # Базовая задержка повтора (секунды)
+    X3UI_RETRY_MAX_DELAY: float = float(os.getenv("X3UI_RETRY_MAX_DELAY", "2"))  # Максимальная задержка повтора (секунды)
+    X3UI_FANOUT_CONCURRENCY: int = int(os.getenv("X3UI_FANOUT_CONCURRENCY", "4"))  # Сколько панелей опрашивается одновременно в админских операциях
+    XRAY_GRPC_ADDRESS: str = os.getenv("XRAY_GRPC_ADDRESS", "")  # Адрес gRPC API Xray панели по умолчанию (например, 127.0.0.1:62789; пусто - без gRPC)
+    XRAY_GRPC_INBOUND_TAG: str = os.getenv("XRAY_GRPC_INBOUND_TAG", "inbound-443")  # Тег inbound в Xray (3x-ui: inbound-<порт>)
+    XRAY_GRPC_TIMEOUT: float = float(os.getenv("XRAY_GRPC_TIMEOUT", "5"))  # Таймаут вызова gRPC API Xray (секунды)
+    XRAY_GRPC_PERSIST_INTERVAL: float = float(os.getenv("XRAY_GRPC_PERSIST_INTERVAL", "30"))  # Интервал записи изменений из gRPC API в панель (секунды)
+    XRAY_GRPC_PERSIST_MAX_ATTEMPTS: int = int(os.getenv("XRAY_GRPC_PERSIST_MAX_ATTEMPTS", "5"))  # Попыток записи изменения клиента в панель, после которых повторы прекращаются и админы получают уведомление
+    XRAY_RESTART_WINDOW: float = float(os.getenv("XRAY_RESTART_WINDOW", "10"))  # Окно объединения перезапусков Xray после последнего изменения (секунды, 0 - сразу)
+    XRAY_RESTART_MAX_DELAY: float = float(os.getenv("XRAY_RESTART_MAX_DELAY", "60"))  # Максимальная задержка перезапуска после первого изменения (секунды)
+    TRAFFIC_SYNC_INTERVAL: int = int(os.getenv("TRAFFIC_SYNC_INTERVAL", "300"))  # Интервал синхронизации трафика клиентов с панелей (секунды)
+    HEALTH_PROBE_INTERVAL: int = int(os.getenv("HEALTH_PROBE_INTERVAL", "30"))  # Интервал проверки панелей и портов серверов (секунды)
+    HEALTH_PROBE_TIMEOUT: float = float(os.getenv("HEALTH_PROBE_TIMEOUT", "5"))  # Таймаут одной проверки (секунды)
+    HEALTH_PROBE_FAILURES: int = int(os.getenv("HEALTH_PROBE_FAILURES", "2"))  # Неудачных проверок подряд до признания цели недоступной
 
 settings = Settings()
\ No newline at end of file
@@ -18,6 +18,7 @@ async def main():
         from app.handlers import register_all_handlers
         from app.utils.system import setup_logging, create_dirs
         from app.services.database import db
+        from app.services.vpn import panel_registry, traffic_sync, health_prober, ssh_pool, restart_scheduler
         from aiogram.types import BotCommand
     except ImportError as e:
         print(f"❌ Ошибка импорта: {e}")
@@ -38,6 +39,16 @@ async def main():
         logger.info("🔧 Инициализация базы данных...")
         await db.init_db()
 
+        # Открываем постоянные HTTP-сессии к панелям 3x-ui
+        logger.info("🔧 Открытие HTTP-сессий панелей 3x-ui...")
+        await panel_registry.start()
+
+        # Фоновая синхронизация трафика клиентов в локальную БД
+        traffic_sync.start()
+
+        # Фоновая проверка доступности панелей и серверов
+        health_prober.start()
+
         # Регистрируем обработчики
         logger.info("📝 Регистрация обработчиков...")
         register_all_handlers(dp)
@@ -153,6 +164,11 @@ async def main():
         raise
     finally:
         logger.info("Завершение работы...")
+        await health_prober.close()
+        await traffic_sync.close()
+        await panel_registry.close()
+        await restart_scheduler.close()
+        await ssh_pool.close()
         await db.close()
 
 
@@ -0,0 +1,183 @@
+"""
+Нагрузочный тест X3UIService на локальной замене панели (scripts/fake_x3ui.py)
+
+Измеряет пропускную способность и задержки (p50/p99) add_client, remove_client
+и get_inbound при разном количестве клиентов в inbound. Боевая панель не используется.
+
+Запуск:
+    python3 scripts/benchmark_x3ui.py
+    python3 scripts/benchmark_x3ui.py --sizes 1000 10000 50000 --ops 200 --concurrency 20 --latency 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List
+
+# Запуск из корня репозитория: python3 scripts/benchmark_x3ui.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+# Кэш endpoints теста не должен смешиваться с кэшем бота
+os.environ.setdefault("X3UI_ENDPOINTS_CACHE_PATH", os.path.join(tempfile.mkdtemp(), "x3ui_endpoints.json"))
+
+from loguru import logger
+
+# Логи сервиса мешают отчету (включаются флагом --verbose)
+logger.remove()
+logger.add(sys.stderr, level="ERROR")
+
+from config.settings import settings
+from app.services.vpn.x3ui_service import X3UIService
+from app.services.vpn.restart_scheduler import restart_scheduler
+from fake_x3ui import FakeX3UIPanel
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Перцентиль (q от 0 до 100) списка задержек"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+async def measure(
+    name: str,
+    operation: Callable[[int], Awaitable[bool]],
+    ops: int,
+    concurrency: int
+) -> Dict:
+    """Выполнение ops операций не более чем по concurrency одновременно"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def run(i: int):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                ok = await operation(i)
+            except Exception as e:
+                logger.debug(f"{name}: {e}")
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run(i) for i in range(ops)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "name": name,
+        "ops": ops,
+        "errors": errors,
+        "throughput": ops / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50) * 1000,
+        "p99": percentile(latencies, 99) * 1000
+    }
+
+
+async def wait_background(service: X3UIService):
+    """Ожидание фоновых задач сервиса (проверка после добавления, перезапуск Xray)"""
+    while service._background_tasks or restart_scheduler.pending():
+        # Запланированные перезапуски выполняются сразу, не дожидаясь окна объединения
+        await restart_scheduler.flush()
+        await asyncio.gather(*list(service._background_tasks), return_exceptions=True)
+
+
+async def bench_size(size: int, args) -> List[Dict]:
+    """Все замеры для inbound с size клиентами"""
+    panel = FakeX3UIPanel(
+        clients=size,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        restart_latency=args.restart_latency / 1000
+    )
+    runner = await panel.serve()
+    service = X3UIService(api_url=panel.url, username="admin", password="admin", inbound_id=1, name=f"bench-{size}")
+    results = []
+    try:
+        await service.start()
+        # Прогрев: авторизация, поиск endpoints, первый снимок inbounds
+        await service.get_inbounds(force_refresh=True)
+
+        uuids = [str(uuid.uuid4()) for _ in range(args.ops)]
+
+        async def get_cached(i: int) -> bool:
+            return await service.get_inbound() is not None
+
+        async def get_fresh(i: int) -> bool:
+            return await service.get_inbound(force_refresh=True) is not None
+
+        async def add(i: int) -> bool:
+            success, _ = await service.add_client(uuids[i], f"user_{uuids[i][:8]}")
+            return success
+
+        async def remove(i: int) -> bool:
+            return await service.remove_client(uuids[i])
+
+        results.append(await measure("get_inbound (снимок)", get_cached, args.ops, args.concurrency))
+        results.append(await measure("get_inbound (с панели)", get_fresh, args.ops, args.concurrency))
+        results.append(await measure("add_client", add, args.ops, args.concurrency))
+        # Фоновые проверки и перезапуски не должны пересекаться с удалением тех же клиентов
+        await wait_background(service)
+        results.append(await measure("remove_client", remove, args.ops, args.concurrency))
+        await wait_background(service)
+    finally:
+        await service.close()
+        await runner.cleanup()
+
+    for result in results:
+        result["size"] = size
+    results.append({"size": size, "requests": sum(panel.requests.values()), "restarts": panel.restarts})
+    return results
+
+
+def print_report(results: List[Dict]):
+    header = f"{'клиентов':>9} | {'операция':<24} | {'ops':>5} | {'ошибок':>6} | {'ops/с':>9} | {'p50, мс':>9} | {'p99, мс':>9}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        if "name" not in result:
+            print(f"{result['size']:>9} | запросов к панели: {result['requests']}, перезапусков Xray: {result['restarts']}")
+            print("-" * len(header))
+            continue
+        print(
+            f"{result['size']:>9} | {result['name']:<24} | {result['ops']:>5} | {result['errors']:>6} | "
+            f"{result['throughput']:>9.1f} | {result['p50']:>9.2f} | {result['p99']:>9.2f}"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест X3UIService на тестовой панели")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="клиентов в inbound")
+    parser.add_argument("--ops", type=int, default=100, help="операций каждого типа")
+    parser.add_argument("--concurrency", type=int, default=10, help="одновременных операций")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа панели (мс)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="разброс задержки (мс)")
+    parser.add_argument("--restart-latency", type=float, default=0.0, help="задержка перезапуска Xray (мс)")
+    parser.add_argument("--no-verify", action="store_true", help="без фоновой проверки после добавления")
+    parser.add_argument("--verbose", action="store_true", help="подробные логи сервиса")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level="DEBUG")
+    if args.no_verify:
+        settings.X3UI_VERIFY_PROVISION = False
+
+    results = []
+    for size in args.sizes:
+        print(f"⏱ {size} клиентов...", file=sys.stderr)
+        results.extend(await bench_size(size, args))
+    print_report(results)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,257 @@
+"""
+Локальная замена панели 3x-ui для нагрузочного тестирования
+
+Реализует авторизацию, список inbounds, обновление inbound, addClient, delClient
+и перезапуск Xray с настраиваемой задержкой и количеством клиентов.
+
+Запуск:
+    python3 scripts/fake_x3ui.py --port 2053 --clients 10000 --latency 20
+    X3UI_API_URL=http://127.0.0.1:2053/panel X3UI_INBOUND_ID=1 python3 main.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from typing import Dict, List, Optional
+from aiohttp import web
+from loguru import logger
+
+SESSION_COOKIE = "3x-ui"
+PANEL_VERSION = "2.4.0"
+
+
+class FakeX3UIPanel:
+    """Панель 3x-ui в памяти процесса с одним VLESS Reality inbound"""
+
+    def __init__(
+        self,
+        base_path: str = "/panel",
+        inbound_id: int = 1,
+        clients: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        restart_latency: float = 0.0,
+        username: str = "admin",
+        password: str = "admin"
+    ):
+        """
+        Args:
+            base_path: WebBasePath панели
+            clients: сколько клиентов создать в inbound при запуске
+            latency, jitter: задержка каждого ответа API и ее случайный разброс (секунды)
+            restart_latency: дополнительная задержка перезапуска Xray (секунды)
+        """
+        self.base_path = "/" + base_path.strip("/") if base_path.strip("/") else ""
+        self.inbound_id = inbound_id
+        self.latency = latency
+        self.jitter = jitter
+        self.restart_latency = restart_latency
+        self.username = username
+        self.password = password
+
+        self._token = uuid.uuid4().hex
+        self.clients: List[Dict] = [self._make_client(f"bench_{i}") for i in range(clients)]
+        self.traffic: Dict[str, List[int]] = {}  # email -> [up, down]
+        self.requests: Dict[str, int] = {}  # счетчики запросов по endpoint
+        self.restarts = 0
+        # Сериализованный settings (клиенты меняются реже, чем читается список)
+        self._settings_raw: Optional[str] = None
+
+    @staticmethod
+    def _make_client(email: str, client_id: str = None) -> Dict:
+        return {
+            "id": client_id or str(uuid.uuid4()),
+            "email": email,
+            "flow": "xtls-rprx-vision",
+            "limitIp": 0,
+            "totalGB": 0,
+            "expiryTime": 0,
+            "enable": True,
+            "tgId": "",
+            "subId": uuid.uuid4().hex[:16],
+            "reset": 0
+        }
+
+    def _changed(self):
+        self._settings_raw = None
+
+    def _settings_json(self) -> str:
+        if self._settings_raw is None:
+            self._settings_raw = json.dumps({"clients": self.clients, "decryption": "none", "fallbacks": []})
+        return self._settings_raw
+
+    def inbound(self) -> Dict:
+        """Inbound в формате ответа /panel/api/inbounds/list"""
+        return {
+            "id": self.inbound_id,
+            "up": 0,
+            "down": 0,
+            "total": 0,
+            "remark": "fake-reality",
+            "enable": True,
+            "expiryTime": 0,
+            "listen": "",
+            "port": 443,
+            "protocol": "vless",
+            "settings": self._settings_json(),
+            "streamSettings": json.dumps({
+                "network": "tcp",
+                "security": "reality",
+                "realitySettings": {
+                    "show": False,
+                    "dest": "www.google.com:443",
+                    "serverNames": ["www.google.com"],
+                    "privateKey": "fake-private-key",
+                    "shortIds": ["a1b2c3d4"],
+                    "settings": {"publicKey": "fake-public-key", "fingerprint": "chrome", "spiderX": "/"}
+                },
+                "tcpSettings": {"header": {"type": "none"}}
+            }),
+            "sniffing": json.dumps({"enabled": True, "destOverride": ["http", "tls", "quic"]}),
+            "tag": "inbound-443",
+            "clientStats": [
+                {
+                    "inboundId": self.inbound_id,
+                    "email": client["email"],
+                    "up": self.traffic.get(client["email"], [0, 0])[0],
+                    "down": self.traffic.get(client["email"], [0, 0])[1],
+                    "enable": True
+                }
+                for client in self.clients
+            ]
+        }
+
+    # ---------- HTTP ----------
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.requests[route] = self.requests.get(route, 0) + 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        is_api = request.path.startswith(f"{self.base_path}/panel/api")
+        if is_api and request.cookies.get(SESSION_COOKIE) != self._token:
+            # Настоящая панель отвечает 404 на запросы без сессии
+            return web.Response(status=404)
+        return await handler(request)
+
+    async def _login_page(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=f'<html><head><script src="/assets/app.js?{PANEL_VERSION}"></script></head></html>',
+            content_type="text/html"
+        )
+
+    async def _login(self, request: web.Request) -> web.Response:
+        try:
+            data = await request.json()
+        except Exception:
+            data = dict(await request.post())
+        if data.get("username") != self.username or data.get("password") != self.password:
+            return web.json_response({"success": False, "msg": "Неверное имя пользователя или пароль"})
+        response = web.json_response({"success": True, "msg": "Вход выполнен"})
+        response.set_cookie(SESSION_COOKIE, self._token, max_age=3600, path="/", httponly=True)
+        return response
+
+    async def _list(self, request: web.Request) -> web.Response:
+        return web.json_response({"success": True, "obj": [self.inbound()]})
+
+    async def _update(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if int(request.match_info["inbound_id"]) != self.inbound_id:
+            return web.json_response({"success": False, "msg": "inbound не найден"})
+        settings = json.loads(data.get("settings") or "{}")
+        self.clients = settings.get("clients", [])
+        self._changed()
+        return web.json_response({"success": True})
+
+    async def _add_client(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if int(data.get("id", 0)) != self.inbound_id:
+            return web.json_response({"success": False, "msg": "inbound не найден"})
+        new_clients = json.loads(data.get("settings") or "{}").get("clients", [])
+        emails = {client["email"] for client in self.clients}
+        for client in new_clients:
+            if client.get("email") in emails:
+                return web.json_response({"success": False, "msg": f"Duplicate email: {client.get('email')}"})
+        self.clients.extend(new_clients)
+        self._changed()
+        return web.json_response({"success": True})
+
+    async def _del_client(self, request: web.Request) -> web.Response:
+        client_id = request.match_info["client_id"]
+        before = len(self.clients)
+        self.clients = [client for client in self.clients if client.get("id") != client_id]
+        if len(self.clients) == before:
+            return web.json_response({"success": False, "msg": "клиент не найден"})
+        self._changed()
+        return web.json_response({"success": True})
+
+    async def _restart(self, request: web.Request) -> web.Response:
+        if self.restart_latency:
+            await asyncio.sleep(self.restart_latency)
+        self.restarts += 1
+        return web.json_response({"success": True})
+
+    def make_app(self) -> web.Application:
+        """aiohttp-приложение панели"""
+        app = web.Application(middlewares=[self._middleware], client_max_size=256 * 1024 * 1024)
+        base = self.base_path
+        app.router.add_get(f"{base}/", self._login_page)
+        app.router.add_post(f"{base}/login", self._login)
+        app.router.add_get(f"{base}/panel/api/inbounds/list", self._list)
+        app.router.add_post(f"{base}/panel/api/inbounds/update/{{inbound_id}}", self._update)
+        app.router.add_post(f"{base}/panel/api/inbounds/addClient", self._add_client)
+        app.router.add_post(f"{base}/panel/api/inbounds/{{inbound_id}}/delClient/{{client_id}}", self._del_client)
+        app.router.add_post(f"{base}/panel/api/inbounds/restartAll", self._restart)
+        return app
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        """Запуск в текущем цикле событий (port=0 - свободный порт, см. self.url)"""
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{bound_port}{self.base_path}"
+        logger.info(f"🧪 Тестовая панель 3x-ui: {self.url} (клиентов: {len(self.clients)})")
+        return runner
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Локальная замена панели 3x-ui")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2053)
+    parser.add_argument("--base-path", default="/panel", help="WebBasePath панели")
+    parser.add_argument("--inbound-id", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=0, help="клиентов в inbound при запуске")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа API (мс)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="разброс задержки (мс)")
+    parser.add_argument("--restart-latency", type=float, default=0.0, help="задержка перезапуска Xray (мс)")
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    args = parser.parse_args()
+
+    panel = FakeX3UIPanel(
+        base_path=args.base_path,
+        inbound_id=args.inbound_id,
+        clients=args.clients,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        restart_latency=args.restart_latency / 1000,
+        username=args.username,
+        password=args.password
+    )
+    runner = await panel.serve(args.host, args.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,111 @@
+"""
+Локальная замена gRPC API Xray (HandlerService.AlterInbound) для тестов
+
+Принимает добавление и удаление пользователей так же, как Xray: ошибка
+"already exists" при повторном добавлении и "not found" при удалении
+неизвестного email. Пользователи хранятся в памяти по тегам inbounds.
+
+Запуск:
+    python3 scripts/fake_xray_grpc.py --port 62789 --tag inbound-443
+    XRAY_GRPC_ADDRESS=127.0.0.1:62789 python3 main.py
+"""
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+from typing import Dict, Iterable
+
+import grpc
+from loguru import logger
+
+# Запуск из корня репозитория: python3 scripts/fake_xray_grpc.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.services.vpn.xray_grpc import (
+    ADD_USER_OPERATION,
+    REMOVE_USER_OPERATION,
+    decode_message,
+)
+
+HANDLER_SERVICE = "xray.app.proxyman.command.HandlerService"
+
+
+class FakeXrayGrpc:
+    """gRPC API Xray в памяти процесса"""
+
+    def __init__(self, tags: Iterable[str] = ("inbound-443",)):
+        # тег inbound -> email -> {"id", "flow", "account_type"}
+        self.users: Dict[str, Dict[str, Dict]] = {tag: {} for tag in tags}
+        self.calls = 0
+
+    async def _alter_inbound(self, request: bytes, context: grpc.aio.ServicerContext) -> bytes:
+        self.calls += 1
+        fields = decode_message(request)
+        tag = fields[1][0].decode()
+        operation = decode_message(fields[2][0])
+        operation_type = operation[1][0].decode()
+        value = operation.get(2, [b""])[0]
+
+        users = self.users.get(tag)
+        if users is None:
+            await context.abort(grpc.StatusCode.UNKNOWN, f"handler not found: {tag}")
+
+        if operation_type == ADD_USER_OPERATION:
+            user = decode_message(decode_message(value)[1][0])
+            email = user[2][0].decode()
+            account = decode_message(user[3][0])
+            account_fields = decode_message(account.get(2, [b""])[0])
+            if email in users:
+                await context.abort(grpc.StatusCode.UNKNOWN, f"User {email} already exists.")
+            users[email] = {
+                "id": account_fields[1][0].decode(),
+                "flow": account_fields.get(2, [b""])[0].decode(),
+                "account_type": account[1][0].decode()
+            }
+        elif operation_type == REMOVE_USER_OPERATION:
+            email = decode_message(value)[1][0].decode()
+            if users.pop(email, None) is None:
+                await context.abort(grpc.StatusCode.UNKNOWN, f"User {email} not found.")
+        else:
+            await context.abort(grpc.StatusCode.UNKNOWN, f"unknown operation: {operation_type}")
+        return b""
+
+    def uuids(self, tag: str = "inbound-443") -> set:
+        """UUID пользователей inbound"""
+        return {user["id"] for user in self.users.get(tag, {}).values()}
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 0) -> grpc.aio.Server:
+        """Запуск в текущем цикле событий (port=0 - свободный порт, см. self.address)"""
+        server = grpc.aio.server()
+        # Сериализаторы не указаны: обработчик получает и возвращает bytes
+        handler = grpc.method_handlers_generic_handler(HANDLER_SERVICE, {
+            "AlterInbound": grpc.unary_unary_rpc_method_handler(self._alter_inbound)
+        })
+        server.add_generic_rpc_handlers((handler,))
+        bound_port = server.add_insecure_port(f"{host}:{port}")
+        await server.start()
+        self.address = f"{host}:{bound_port}"
+        logger.info(f"🧪 Тестовый gRPC API Xray: {self.address} (inbounds: {list(self.users)})")
+        return server
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Локальная замена gRPC API Xray")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=62789)
+    parser.add_argument("--tag", action="append", help="тег inbound (можно несколько раз)")
+    args = parser.parse_args()
+
+    fake = FakeXrayGrpc(args.tag or ["inbound-443"])
+    server = await fake.serve(args.host, args.port)
+    try:
+        await server.wait_for_termination()
+    finally:
+        await server.stop(None)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass